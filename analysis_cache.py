@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+from bullish_signals_indicators import SIGNALS
+
+# Maximum number of entries of each cache. The signals hold one boolean array per indicator
+# and bar, so they are kept for fewer stocks than the (small) analysis results.
+RESULT_CACHE_SIZE = 4096
+SIGNAL_CACHE_SIZE = 64
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded cache evicting the least recently used entry.
+    The first item of every key is the stock symbol, so all the entries of a stock can be
+    dropped at once when its data changes. Each process has its own caches, so analyses
+    running on the process executor only reuse the entries of their own worker.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value of a key, or None on a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used entries beyond max_size.
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, stock):
+        """
+        Drop every entry of a stock.
+
+        Returns:
+        int: The number of dropped entries
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == stock]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the counters of the cache, for monitoring.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+# Results of run_analysis and signals of compute_signals
+result_cache = LRUCache(RESULT_CACHE_SIZE)
+signal_cache = LRUCache(SIGNAL_CACHE_SIZE)
+
+def _normalize_weights(weights):
+    """
+    The weights as a tuple in SIGNALS order, so equal weights give equal keys whatever the order
+    of the dictionary. No weights means a weight of 1 for every indicator, as in calculate_score.
+    """
+    if weights is None:
+        return tuple(1.0 for _ in SIGNALS)
+    return tuple(float(weights[signal]) for signal in SIGNALS)
+
+def signal_key(stock, version, threshold, rsi_threshold):
+    """
+    Key of the signals of a stock: they only depend on its data and the two thresholds.
+
+    Parameters:
+    stock (str): The stock symbol
+    version (str): The data version of the stock (see price_store.data_version)
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+
+    Returns:
+    tuple: The cache key
+    """
+    return (stock, version, float(threshold), float(rsi_threshold))
+
+def result_key(stock, version, threshold, days, rsi_threshold, weights=None, as_of=None):
+    """
+    Key of the analysis result of a stock. The score windows end today, so the date is part of the key.
+
+    Parameters:
+    stock (str): The stock symbol
+    version (str): The data version of the stock (see price_store.data_version)
+    threshold (float): The threshold for the volume spikes indicator
+    days (int): The number of days over which the score is calculated
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    as_of (date): The date the day range ends at. Default is date.today().
+
+    Returns:
+    tuple: The cache key
+    """
+    as_of = (as_of or date.today()).isoformat()
+    return signal_key(stock, version, threshold, rsi_threshold) + (int(days), _normalize_weights(weights), as_of)
+
+def invalidate(stock):
+    """
+    Drop the cached results and signals of a stock, called whenever its stored data changes.
+    The data version in the keys already prevents stale hits, this frees the memory right away.
+    """
+    return result_cache.invalidate(stock) + signal_cache.invalidate(stock)
+
+def cache_stats():
+    """
+    Return the counters of both caches, for monitoring.
+    """
+    return {'results': result_cache.stats(), 'signals': signal_cache.stats()}
@@ -0,0 +1,95 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from stock_functions import run_analysis
+import metrics
+
+# Executors available to the batch engine
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+def analyze_one(stock, threshold=0.05, days=10, rsi_threshold=30, weights_dict=None):
+    """
+    Run the analysis for a single stock and measure its wall time and the time of each of its stages.
+    Any exception is turned into the {'stock', 'error'} result used by run_analysis,
+    so one failing ticker never brings down the whole batch.
+
+    Parameters:
+    stock (str): The stock symbol
+    threshold (float): The threshold for the volume spikes indicator
+    days (int): The number of days over which to calculate the score
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights_dict (dict): The weights for each indicator
+
+    Returns:
+    dict: The analysis result with an extra 'elapsed' key (seconds) and the 'timings' of its stages
+          (stage -> [seconds, count], see metrics.collect_breakdown)
+    """
+    start = time.perf_counter()
+    with metrics.collect_breakdown() as timings:
+        with metrics.timed('run_analysis'):
+            try:
+                result = run_analysis(stock, threshold, days, rsi_threshold, weights_dict)
+            except Exception as e:
+                result = {'stock': stock, 'error': str(e)}
+    result['elapsed'] = time.perf_counter() - start
+    result['timings'] = timings
+    return result
+
+def run_batch_analysis(stocks, threshold=0.05, days=10, rsi_threshold=30, weights_dict=None,
+                       executor='thread', max_workers=None, on_result=None):
+    """
+    Run the analysis for many stocks on a thread or process pool.
+
+    Parameters:
+    stocks (list): The stock symbols to analyze
+    threshold (float): The threshold for the volume spikes indicator
+    days (int): The number of days over which to calculate the score
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights_dict (dict): The weights for each indicator
+    executor (str): 'thread' or 'process'. Default is 'thread'.
+    max_workers (int): The size of the pool. Default is the number of CPUs.
+    on_result (callable): Called as on_result(index, result) as soon as the stock at `index` is done.
+
+    Returns:
+    list: One result per input stock, in input order. Each result carries its wall time
+          under 'elapsed' and failed stocks keep the {'stock', 'error'} format.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor '{executor}', expected one of {sorted(EXECUTORS)}.")
+
+    # Duplicated tickers are analyzed once, as they would write to the same files
+    positions = defaultdict(list)
+    for index, stock in enumerate(stocks):
+        positions[stock].append(index)
+    if not positions:
+        return []
+
+    results = [None] * len(stocks)
+
+    def record(stock, result):
+        for index in positions[stock]:
+            results[index] = dict(result)
+            if on_result:
+                on_result(index, results[index])
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_workers = min(max_workers, len(positions))
+    if max_workers == 1:
+        for stock in positions:
+            record(stock, analyze_one(stock, threshold, days, rsi_threshold, weights_dict))
+    else:
+        with EXECUTORS[executor](max_workers=max_workers) as pool:
+            futures = {pool.submit(analyze_one, stock, threshold, days, rsi_threshold, weights_dict): stock
+                       for stock in positions}
+            for future in as_completed(futures):
+                result = future.result()
+                # The stages timed in the worker processes are added to the metrics of this process
+                if executor == 'process':
+                    metrics.merge_breakdown(result['timings'])
+                record(futures[future], result)
+
+    return results
@@ -1,13 +1,77 @@
-from flask import Flask, render_template, request, redirect, url_for, session
-from stock_functions import run_analysis
+import os
+import time
+import hashlib
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import is_resource_modified
+from flask import Flask, render_template, request, redirect, url_for, session, abort, jsonify, g, Response, send_file
+from jobs import JobQueue
 from backtest_strategy import moving_average_crossover_backtest
-from fundamental_factors import get_news_data, analyze_earnings
+from fundamental_factors import get_fundamentals, get_news_data, load_earnings
+from price_store import has_prices, load_prices, data_version, last_modified
+from stock_functions import ensure_stock_charts, run_analysis, needs_refresh
+from analysis_cache import cache_stats
+import result_store
+import metrics
+from report_export import find_export
+from screener import Screener
+from portfolio_backtest import portfolio_backtest, REBALANCE_FREQUENCIES, SIZINGS
+from price_panel import PricePanel
+import threading
 from json import loads
-import pandas as pd
 
 # Initialize Flask application
 app = Flask(__name__)
 app.secret_key = 'key'  # Important to change if the app is deployed
+app.config['ANALYSIS_EXECUTOR'] = 'thread'  # 'thread' or 'process'
+app.config['ANALYSIS_MAX_WORKERS'] = None  # Defaults to the number of CPUs
+app.config['ANALYSIS_MAX_JOBS'] = 4  # Number of analyses running at the same time
+app.config['REPORT_ROWS_PER_PAGE'] = 50
+app.config['REPORT_FORMAT'] = 'csv'  # Format of the downloadable reports: 'csv' or 'parquet' (needs pyarrow)
+app.config['REPORT_MAX_BYTES'] = 200 * 2 ** 20  # The oldest reports are deleted beyond this total size
+app.config['SCREENER_LOOKBACK'] = 1000  # Bars of each stock loaded by the screener
+app.config['API_PROVIDER_TIMEOUT'] = 10  # Seconds the JSON API waits for the news and earnings providers
+app.config['PROFILE_REQUESTS'] = False  # When True, requests with a 'profile' query parameter are profiled with cProfile
+app.config['PROFILE_DIR'] = 'technical_analysis/profiles'  # Where the profiles are dumped
+
+# Background queue running the analyses submitted by /analyze
+job_queue = JobQueue(max_jobs=app.config['ANALYSIS_MAX_JOBS'], executor=app.config['ANALYSIS_EXECUTOR'],
+                     max_workers=app.config['ANALYSIS_MAX_WORKERS'], export_format=app.config['REPORT_FORMAT'],
+                     export_max_bytes=app.config['REPORT_MAX_BYTES'])
+
+# Threads fetching the news and the earnings of the JSON API, a provider that is too slow keeps
+# its thread until it answers but doesn't hold the response back
+api_fetch_pool = ThreadPoolExecutor(max_workers=8)
+
+# Screener over every stock of the price store, loaded by the first screening
+screener = None
+screener_lock = threading.Lock()
+
+@app.before_request
+def start_request_timer():
+    """
+    Start timing the request, and profiling it when profiling is enabled and asked for.
+    """
+    g.request_start = time.perf_counter()
+    if app.config['PROFILE_REQUESTS'] and 'profile' in request.args:
+        g.profiler = metrics.RequestProfiler(app.config['PROFILE_DIR'])
+        g.profile = g.profiler.start()
+
+@app.teardown_request
+def stop_request_timer(exception=None):
+    """
+    Record the latency of the request as the 'route.{endpoint}' stage and dump its profile, if any.
+    """
+    if 'request_start' in g:
+        metrics.observe(f'route.{request.endpoint}', time.perf_counter() - g.request_start)
+    if 'profile' in g:
+        g.profiler.stop(g.profile, request.endpoint or 'request')
+
+def current_run():
+    """
+    The analysis run of the session, the session only holds its id.
+    """
+    return result_store.get_run(session.get('run_id'))
 
 @app.route('/')
 def index():
@@ -17,8 +81,9 @@ def index():
 @app.route('/analyze', methods=['POST'])
 def analyze():
     """
-    Analyze the stocks based on user input and save the results in a session.
-    Redirect to the report page after analysis.
+    Submit the analysis of the stocks based on user input to the background queue
+    and save the run id in the session. The user inputs are kept in the result store with the run.
+    Redirect to the report page, which shows the results as they arrive.
     """
     # Get user inputs
     threshold = float(request.form['threshold'])
@@ -32,68 +97,382 @@ def analyze():
     # Convert weights to a dictionary
     weights_dict = {key: float(value)/100 for key, value in weights.items()}
 
-    # Save user inputs in session
-    session['threshold'] = threshold
-    session['days'] = days
-    session['rsi_threshold'] = rsi_threshold
-    session['stocks'] = stocks
-    session['initial_capital'] = initial_capital
-    session['weights'] = weights_dict
-
-    stock_analysis = []
-    errors = []
-    # Run analysis for each stock and save the results
-    for stock in stocks:
-        result = run_analysis(stock, threshold, days, rsi_threshold, weights_dict)
-        if 'error' in result:
-            errors.append(result['error'])
-        else:
-            stock_analysis.append(result)
-
-    # Create a DataFrame from the results and save it as a CSV file
-    if stock_analysis:
-        report = pd.DataFrame(stock_analysis)
-        report.to_csv('technical_analysis/bullish_stocks_report.csv', index=False)
-        # Save the report in session
-        session['report'] = report.to_dict('records')
-
-    # Save errors in session
-    session['errors'] = errors
+    # Run the analysis in the background, its report file is written as the stocks are done
+    params = {'threshold': threshold, 'days': days, 'rsi_threshold': rsi_threshold,
+              'initial_capital': initial_capital, 'weights': weights_dict}
+    session.clear()
+    session['run_id'] = job_queue.submit(stocks, params)
 
     # Redirect to the report page
     return redirect(url_for('report'))
 
 @app.route('/backtest/<stock>')
 def backtest(stock):
-    initial_capital = session.get('initial_capital')
-    data = pd.read_csv(f'preprocessed_data/{stock}_data.csv', parse_dates=['date'])
+    run = current_run()
+    initial_capital = run['params']['initial_capital'] if run else 100000
+    data = load_prices(stock, columns=['close', f'{stock}_50_day_ma', f'{stock}_200_day_ma'])
     backtest_results = moving_average_crossover_backtest(data, stock, initial_capital)
-    news_data = get_news_data(stock)
-    analyze_earnings(stock)
+    news_data = get_fundamentals(stock)
     return render_template('backtest.html', backtest_results=backtest_results, stock=stock, news_data=news_data)
 
+@app.route('/portfolio')
+def portfolio():
+    """
+    Backtest a portfolio of the stocks of the session's analysis, sharing its initial capital and following
+    the recommendations its parameters would have made over the history of the stocks.
+    The query parameters are rebalance, sizing, max_positions, max_weight and cost_bps.
+    """
+    run = current_run()
+    if run is None:
+        return redirect(url_for('index'))
+    params = run['params']
+    rebalance = request.args.get('rebalance', 'M')
+    sizing = request.args.get('sizing', 'equal')
+    try:
+        max_positions = request.args.get('max_positions', 20, type=int)
+        max_weight = float(request.args.get('max_weight', 1.0))
+        cost_bps = float(request.args.get('cost_bps', 10))
+    except ValueError:
+        abort(400)
+    if rebalance not in REBALANCE_FREQUENCIES or sizing not in SIZINGS or max_positions < 1:
+        abort(400)
+
+    rows, _ = result_store.get_rows(run['id'])
+    stocks = [row['stock'] for row in rows]
+    results, holdings = None, []
+    if stocks:
+        panel = PricePanel.load(stocks)
+        # The scores are replayed in the request thread, a process pool per request would cost more than it saves
+        results = portfolio_backtest(panel, params['days'], params['threshold'], params['rsi_threshold'], params['weights'],
+                                     params['initial_capital'], rebalance, sizing, max_positions, max_weight, cost_bps, max_workers=1)
+        last_weights = results['weights'].iloc[-1]
+        holdings = [{'stock': stock, 'weight': weight} for stock, weight in last_weights[last_weights > 0].sort_values(ascending=False).items()]
+
+    return render_template('portfolio.html', results=results, holdings=holdings, stocks=stocks, rebalance=rebalance, sizing=sizing,
+                           max_positions=max_positions, max_weight=max_weight, cost_bps=cost_bps,
+                           rebalance_frequencies=REBALANCE_FREQUENCIES, sizings=SIZINGS)
+
+@app.route('/screener')
+def screen_universe():
+    """
+    Score every stock of the price store at once and render the best ones.
+    The query parameters are days, threshold, rsi_threshold, top (the number of stocks shown) and
+    weights[indicator] (in percent, as in the analysis form). 'reload' reloads the stored data.
+    """
+    global screener
+    try:
+        days = request.args.get('days', 10, type=int)
+        threshold = request.args.get('threshold', 0.05, type=float)
+        rsi_threshold = request.args.get('rsi_threshold', 30, type=float)
+        top = request.args.get('top', 50, type=int)
+        weights = {indicator: float(request.args.get(f'weights[{indicator}]', 100)) / 100 for indicator in result_store.SIGNALS}
+    except ValueError:
+        abort(400)
+
+    with screener_lock:
+        if screener is None or 'reload' in request.args:
+            screener = Screener(lookback=app.config['SCREENER_LOOKBACK'])
+        current = screener
+    try:
+        results = current.screen(days=days, threshold=threshold, rsi_threshold=rsi_threshold, weights=weights, top_k=top)
+    except ValueError:
+        abort(400)
+
+    return render_template('screener.html', report=results.to_dict('records'), universe=len(current.stocks),
+                           days=days, threshold=threshold, rsi_threshold=rsi_threshold, top=top)
+
 @app.route('/report')
 def report():
     """
     Render the report page with the analysis results.
+    While the analysis is running the page shows the partial results and polls its progress.
+    The rows are paginated and can be sorted with the 'page', 'sort' and 'order' query parameters.
+    """
+    # Get the analysis run of the session
+    run = current_run()
+    params = run['params'] if run else {}
+    sort = request.args.get('sort', 'position')
+    if sort not in result_store.SORT_COLUMNS:
+        abort(400)
+    descending = request.args.get('order') == 'desc'
+    page = request.args.get('page', 1, type=int)
+    per_page = app.config['REPORT_ROWS_PER_PAGE']
+
+    report, total_rows = result_store.get_rows(run['id'], sort, descending, page, per_page) if run else ([], 0)
+    pages = max(1, -(-total_rows // per_page))
+    errors = run['errors'] if run else []
+    timings = result_store.get_timings(run['id']) if run else []
+    download = run is not None and run['status'] == 'finished' and find_export(run['id']) is not None
+
+    # Render the report page with the results received so far
+    return render_template('report.html', report=report, threshold=params.get('threshold'), days=params.get('days'),
+                           rsi_threshold=params.get('rsi_threshold'), errors=errors, progress=run,
+                           sort=sort, order='desc' if descending else 'asc', page=page, pages=pages, timings=timings, download=download)
+
+@app.route('/report/<run_id>/download')
+def download_report(run_id):
+    """
+    Download the report file of a finished analysis run. Range requests are supported.
     """
-    # Get the analysis results from session
-    threshold = session.get('threshold')
-    days = session.get('days')
-    rsi_threshold = session.get('rsi_threshold')
-    report = session.get('report')
-    errors = session.get('errors', [])
+    try:
+        path = find_export(run_id)
+    except ValueError:
+        abort(404)
+    if path is None:
+        abort(404)
+    extension = os.path.splitext(path)[1]
+    # The reports are relative to the working directory, send_file would resolve them from the app folder
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=f'bullish_stocks_report_{run_id}{extension}', conditional=True)
 
-    # Render the report page with the results
-    return render_template('report.html', report=report, threshold=threshold, days=days, rsi_threshold=rsi_threshold, errors=errors)
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Return the progress of an analysis job as JSON: status, stocks done, errors and ETA.
+    """
+    run = result_store.get_run(job_id)
+    if run is None:
+        abort(404)
+    return jsonify({key: value for key, value in run.items() if key != 'params'})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Expose the stage latency histograms and the analysis cache counters in the Prometheus text format.
+    """
+    stats = cache_stats()
+    extra = {}
+    for counter, metric_type in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('size', 'gauge')):
+        name = f'stock_analysis_cache_{counter}' + ('_total' if metric_type == 'counter' else '')
+        extra[name] = (metric_type, f'{counter.capitalize()} of the analysis caches.',
+                       {(('cache', cache),): values[counter] for cache, values in stats.items()})
+    return Response(metrics.render_prometheus(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats')
+def analysis_cache_stats():
+    """
+    Return the size and the hit/miss counters of the analysis caches as JSON, for monitoring.
+    """
+    return jsonify(cache_stats())
 
 @app.route('/visualization/<stock>')
 def visualization(stock):
     """
     Render the visualization page for a specific stock.
+    The charts are rendered here, the first time they are requested for the current data.
+    The optional 'start' and 'end' query parameters (YYYY-MM-DD) zoom on a date range.
+    """
+    if not has_prices(stock):
+        abort(404)
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    try:
+        chart_id, version = ensure_stock_charts(stock, start, end)
+    except ValueError:
+        abort(400)
+
+    # Render the visualization page with the user inputs of the session's run
+    params = (current_run() or {}).get('params', {})
+    return render_template('visualization.html', stock=stock, chart_id=chart_id, version=version, start=start, end=end, days=params.get('days'), threshold=params.get('threshold'), rsi_threshold=params.get('rsi_threshold'))
+
+def api_error(status, message):
     """
-    # Render the visualization page with the user inputs from session
-    return render_template('visualization.html', stock=stock, days=session.get('days'), threshold=session.get('threshold'), rsi_threshold=session.get('rsi_threshold'))
+    JSON error response of the API.
+    """
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+def api_response(payload, etag=None, last_modified=None, status=200):
+    """
+    JSON response of the API. The ETag defaults to a hash of the body. A client sending back the ETag
+    (If-None-Match) or the Last-Modified date (If-Modified-Since) gets an empty 304 response while they match.
+    """
+    response = jsonify(payload)
+    response.status_code = status
+    response.set_etag(etag or hashlib.sha1(response.get_data()).hexdigest())
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the responses but must check them again before using them
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def not_modified(etag, last_modified=None):
+    """
+    Whether the client already holds the response with this ETag and Last-Modified date,
+    checked before the response is computed.
+    """
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+def api_params(values, weights):
+    """
+    Read the analysis parameters of an API request, with the defaults of the analysis form.
+    The weights are in percent, as in the form. Raises ValueError or TypeError on invalid values.
+
+    Parameters:
+    values (dict): The parameters, from the JSON body or the query string
+    weights (dict): The weights given, by indicator
+
+    Returns:
+    dict: The threshold, days, rsi_threshold, initial_capital and weights of the analysis
+    """
+    unknown = set(weights) - set(result_store.SIGNALS)
+    if unknown:
+        raise ValueError(f"Unknown indicators: {', '.join(sorted(unknown))}")
+    return {
+        'threshold': float(values.get('threshold', 0.05)),
+        'days': int(values.get('days', 10)),
+        'rsi_threshold': float(values.get('rsi_threshold', 30)),
+        'initial_capital': float(values.get('initial_capital', 100000)),
+        'weights': {indicator: float(weights.get(indicator, 100)) / 100 for indicator in result_store.SIGNALS},
+    }
+
+def provider_result(future, deadline, convert):
+    """
+    Wait for a news or earnings fetch until the deadline (a time.monotonic() value) and convert its result.
+    A slow or failing provider gives an error entry instead of failing the whole response.
+    """
+    try:
+        return convert(future.result(timeout=max(0.0, deadline - time.monotonic())))
+    except TimeoutError:
+        return {'error': 'The provider did not answer in time.'}
+    except Exception as exc:
+        return {'error': str(exc)}
+
+@app.route('/api/analyze', methods=['POST'])
+def api_analyze():
+    """
+    Submit an analysis to the background queue. The JSON body holds the stocks (a list or a comma
+    separated string) and optionally threshold, days, rsi_threshold, initial_capital and weights
+    (in percent, by indicator). Answers 202 with the run id and the URLs of its progress and results.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return api_error(400, 'Expected a JSON object.')
+    stocks = body.get('stocks')
+    if isinstance(stocks, str):
+        stocks = stocks.split(',')
+    if not isinstance(stocks, list) or not stocks or not all(isinstance(stock, str) and stock.strip() for stock in stocks):
+        return api_error(400, "'stocks' must be a non empty list of stock symbols.")
+    try:
+        params = api_params(body, body.get('weights') or {})
+    except (TypeError, ValueError, AttributeError) as exc:
+        return api_error(400, f'Invalid analysis parameters: {exc}')
+
+    run_id = job_queue.submit([stock.strip() for stock in stocks], params)
+    response = jsonify({'run_id': run_id, 'progress': url_for('job_status', job_id=run_id), 'results': url_for('api_analysis', run_id=run_id)})
+    response.status_code = 202
+    response.headers['Location'] = url_for('api_analysis', run_id=run_id)
+    return response
+
+@app.route('/api/analyze/<run_id>')
+def api_analysis(run_id):
+    """
+    Return the progress and the results received so far of an analysis run. The rows are arrays in the
+    order of 'columns'. The ETag changes whenever a stock is done.
+    """
+    run = result_store.get_run(run_id)
+    if run is None:
+        return api_error(404, f"Unknown run '{run_id}'.")
+    etag = f"{run_id}-{run['status']}-{run['done']}-{len(run['errors'])}"
+    if not_modified(etag):
+        return api_response({}, etag)
+
+    rows, _ = result_store.get_rows(run_id)
+    return api_response({
+        'run_id': run_id,
+        'status': run['status'],
+        'total': run['total'],
+        'done': run['done'],
+        'errors': run['errors'],
+        'params': run['params'],
+        'columns': result_store.RESULT_COLUMNS,
+        'rows': [[row[column] for column in result_store.RESULT_COLUMNS] for row in rows],
+    }, etag)
+
+@app.route('/api/score/<stock>')
+def api_score(stock):
+    """
+    Return the score of a stored stock. The query parameters are threshold, days, rsi_threshold and
+    weights[indicator] (in percent). The day range of the score ends today, so the ETag and the Last-Modified
+    date follow both the version of the stored data and the date: a client asking again on the same day for
+    unchanged data gets a 304 without the score being computed.
+    """
+    if not has_prices(stock):
+        return api_error(404, f"No data for '{stock}', analyze it first.")
+    try:
+        params = api_params(request.args, {indicator: request.args[f'weights[{indicator}]']
+                                           for indicator in result_store.SIGNALS if f'weights[{indicator}]' in request.args})
+    except (TypeError, ValueError) as exc:
+        return api_error(400, f'Invalid analysis parameters: {exc}')
+    params.pop('initial_capital')
+    today = date.today()
+
+    def version_etag():
+        key = repr((stock, data_version(stock), today.isoformat(), sorted(params.items())))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def score_modified():
+        # The latest of the last change of the data and the start of the day (local time, as date.today())
+        return max(last_modified(stock), datetime.combine(today, datetime.min.time()).astimezone(timezone.utc))
+
+    # Stale data is refreshed by run_analysis, its version is only known after that
+    if not needs_refresh(stock) and not_modified(version_etag(), score_modified()):
+        return api_response({}, version_etag(), score_modified())
+
+    result = run_analysis(stock, params['threshold'], params['days'], params['rsi_threshold'], params['weights'])
+    if 'error' in result:
+        return api_error(502, result['error'])
+    return api_response({
+        'stock': stock,
+        'overall_score': result['overall_score'],
+        'recommendation': result['recommendation'],
+        'scores': {indicator: result[indicator] for indicator in result_store.SIGNALS},
+        'data_version': data_version(stock),
+    }, version_etag(), score_modified())
+
+@app.route('/api/backtest/<stock>')
+def api_backtest(stock):
+    """
+    Return the moving average crossover backtest of a stored stock with its latest news and earnings.
+    The query parameters are initial_capital, news (number of articles, default 10) and earnings (number of
+    quarters, default 8). The news and the earnings are fetched while the backtest runs, and a provider that
+    fails or doesn't answer within API_PROVIDER_TIMEOUT seconds gets an error entry instead of its data.
+    """
+    if not has_prices(stock):
+        return api_error(404, f"No data for '{stock}', analyze it first.")
+    try:
+        initial_capital = float(request.args.get('initial_capital', 100000))
+        news_limit = int(request.args.get('news', 10))
+        earnings_limit = int(request.args.get('earnings', 8))
+    except ValueError:
+        return api_error(400, 'initial_capital, news and earnings must be numbers.')
+
+    deadline = time.monotonic() + app.config['API_PROVIDER_TIMEOUT']
+    news = api_fetch_pool.submit(get_news_data, stock) if news_limit > 0 else None
+    earnings = api_fetch_pool.submit(load_earnings, stock) if earnings_limit > 0 else None
+
+    data = load_prices(stock, columns=['close', f'{stock}_50_day_ma', f'{stock}_200_day_ma'])
+    backtest_results = {key: float(value) for key, value in moving_average_crossover_backtest(data, stock, initial_capital).items()}
+
+    def compact_news(news_data):
+        return [{'title': article.get('title'), 'source': (article.get('source') or {}).get('name'),
+                 'url': article.get('url'), 'published_at': article.get('publishedAt')}
+                for article in news_data.get('articles', [])[:news_limit]]
+
+    def compact_earnings(earnings_data):
+        latest = earnings_data.tail(earnings_limit).iloc[::-1].astype(object)
+        latest = latest.where(latest.notna(), None)
+        return [{column: value.date().isoformat() if hasattr(value, 'date') else value for column, value in row.items()}
+                for row in latest.to_dict('records')]
+
+    payload = {'stock': stock, 'backtest': backtest_results, 'data_version': data_version(stock)}
+    if news is not None:
+        payload['news'] = provider_result(news, deadline, compact_news)
+    if earnings is not None:
+        payload['earnings'] = provider_result(earnings, deadline, compact_earnings)
+    # The news and the earnings change independently of the prices, so the ETag is a hash of the body
+    # and there is no Last-Modified date: the prices alone would hide newer news and earnings
+    return api_response(payload)
 
 if __name__ == '__main__':
     # Run the Flask application
@@ -1,64 +1,116 @@
+import os
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from bullish_signals_indicators import (moving_average_crossover, rsi_oversold, volume_spikes, breakouts,
-                                        find_cup_and_handle, find_ascending_triangle, find_inverse_head_and_shoulders,
-                                        bollinger_bands, exponential_moving_average)
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from bullish_signals_indicators import SIGNALS, compute_signals
+from metrics import timed
 
-def calculate_score(data, stock, days, threshold, rsi_threshold, weights: dict = None):
+def _window_starts(data, days, as_of=None):
+    """
+    Index of the first bar inside each `days` window ending at `as_of`, found with a binary
+    search on the sorted date column.
+    """
+    dates = data['date'].to_numpy(dtype='datetime64[ns]')
+    as_of = pd.Timestamp(as_of if as_of is not None else datetime.today()).to_datetime64().astype('datetime64[ns]')
+    cutoffs = as_of - np.asarray(days, dtype='timedelta64[D]')
+    return np.searchsorted(dates, cutoffs, side='left')
+
+def _last_signal_indices(masks):
+    """
+    Index of the last bar where each signal (in SIGNALS order) was detected, -1 if it never was.
+    """
+    last = np.full(len(SIGNALS), -1)
+    for i, signal in enumerate(SIGNALS):
+        mask = masks[signal]
+        if mask.any():
+            last[i] = len(mask) - 1 - np.argmax(mask[::-1])
+    return last
+
+def weights_vector(weights):
+    """
+    The weights of the signals as an array in SIGNALS order, 1 for every signal when there are none.
+    """
+    if weights is None:
+        return np.ones(len(SIGNALS))
+    return np.array([weights[signal] for signal in SIGNALS], dtype=float)
+
+def calculate_score(data, stock, days, threshold, rsi_threshold, weights: dict = None, as_of=None, signals=None):
     """
     This function calculates a score for a given stock based on the appearance of bullish signals
     throughout a specific day range.
 
     Parameters:
-    data (DataFrame): The stock data
+    data (DataFrame): The stock data, sorted by date
     stock (str): The stock symbol
     days (int): The number of days over which to calculate the score
     threshold (float): The threshold for the volume spikes indicator
     rsi_threshold (float): The threshold for the RSI oversold indicator
     weights (dict): The weights for each indicator
+    as_of (datetime): The date the day range ends at. Default is datetime.today().
+    signals (dict): The signals of compute_signals for the same data and thresholds, e.g. from a cache.
+                    Default computes them.
 
     Returns:
     float: Percentage of the overall score
     dict: The scores for each indicator
     list: The dates where the signals were detected
     """
-    # Calculate the signals for each indicator
-    signals = {
-        'moving_average_crossover': moving_average_crossover(data, stock),
-        'rsi_oversold': rsi_oversold(data, stock, rsi_threshold),
-        'volume_spikes': volume_spikes(data, threshold),
-        'breakouts': breakouts(data),
-        'bollinger_bands': bollinger_bands(data)[0],
-        'exponential_moving_average': exponential_moving_average(data),
-        'cup_and_handle': find_cup_and_handle(data)[0],
-        'ascending_triangle': find_ascending_triangle(data)[0],
-        'inverse_head_and_shoulders': find_inverse_head_and_shoulders(data)[0]
-    }
+    # Calculate the signals for each indicator in a single pass
+    masks = signals if signals is not None else compute_signals(data, stock, volume_threshold=threshold, rsi_threshold=rsi_threshold)
 
-    # Define the current date and the window for the signals
-    current_date = datetime.today()
-    signal_window = timedelta(days=days)
-    
-    # Initialize the overall score and the individual scores
-    overall_score = 0
-    if weights is None:
-        weights = {signal: 1 for signal in signals}
-    individual_scores = {}
-    signal_dates = []
-    
-    # Calculate the scores for each signal
-    for signal, dates in signals.items():
-        score = [1 * weights[signal] if (current_date - date) <= signal_window else 0 for date in dates]
-        if sum(score) != 0: # If there is at least one signal within the window
-            individual_scores[signal] = 1 * weights[signal] # The individual score is 1
-            signal_dates.extend(dates)
-        else:
-            individual_scores[signal] = 0 # If there is not a signal within the window, the individual score is 0
-        overall_score += individual_scores[signal]  # Multiply by the weight
-
-    # Normalize the overall score by the sum of the weights
-    return overall_score / sum(weights.values()), individual_scores, sorted(signal_dates)
+    # Score the signals within the day range
+    with timed('score'):
+        # A signal is within the window if its last appearance is at or after the first bar of the window
+        window_start = _window_starts(data, days, as_of)
+        last_signals = _last_signal_indices(masks)
+
+        # Initialize the overall score and the individual scores
+        if weights is None:
+            weights = {signal: 1 for signal in SIGNALS}
+        individual_scores = {}
+        signal_dates = []
+
+        # Calculate the scores for each signal
+        for signal, last_signal in zip(SIGNALS, last_signals):
+            if last_signal >= window_start and weights[signal] != 0: # If there is at least one signal within the window
+                individual_scores[signal] = 1 * weights[signal] # The individual score is 1
+                signal_dates.extend(data.loc[masks[signal], 'date'].tolist())
+            else:
+                individual_scores[signal] = 0 # If there is not a signal within the window, the individual score is 0
+
+        # Normalize the overall score by the sum of the weights
+        return sum(individual_scores.values()) / sum(weights.values()), individual_scores, sorted(signal_dates)
+
+def score_stocks(data_by_stock, days, threshold, rsi_threshold, weights: dict = None, as_of=None):
+    """
+    This function calculates the overall score of many stocks for many day ranges at once.
+    The signals of each stock are computed once and every day range is answered with a
+    binary search on its dates.
+
+    Parameters:
+    data_by_stock (dict): The stock data (sorted by date) for each stock symbol
+    days (list): The numbers of days over which to calculate the scores
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    as_of (datetime): The date the day ranges end at. Default is datetime.today().
+
+    Returns:
+    numpy.ndarray: The overall scores, one row per stock (in the order of data_by_stock)
+                   and one column per day range
+    """
+    as_of = as_of if as_of is not None else datetime.today()
+    days = np.atleast_1d(days)
+    weights = weights_vector(weights)
+
+    # hits[i, j, k] is True when the signal k of the stock i appears within the day range j
+    hits = np.zeros((len(data_by_stock), len(days), len(SIGNALS)), dtype=bool)
+    for i, (stock, data) in enumerate(data_by_stock.items()):
+        masks = compute_signals(data, stock, volume_threshold=threshold, rsi_threshold=rsi_threshold)
+        hits[i] = _last_signal_indices(masks)[None, :] >= _window_starts(data, days, as_of)[:, None]
+
+    return hits @ weights / weights.sum()
 
 def moving_average_crossover_backtest(data, stock, initial_capital: float = 100000):
     """
@@ -126,4 +178,105 @@ def moving_average_crossover_backtest(data, stock, initial_capital: float = 1000
         'recall': recall
     }
 
-    return results
\ No newline at end of file
+    return results
+
+def _moving_averages(close, windows):
+    """
+    Simple moving averages of the closing prices for several windows at once, computed from a
+    cumulative sum. Returns a (bars x windows) array, NaN until a window is full.
+    """
+    cumsum = np.concatenate([[0.0], np.cumsum(close)])
+    averages = np.full((len(close), len(windows)), np.nan)
+    for j, window in enumerate(windows):
+        if window <= len(close):
+            averages[window - 1:, j] = (cumsum[window:] - cumsum[:-window]) / window
+    return averages
+
+def _sweep_stock(close, pairs):
+    """
+    Runs the moving average crossover backtest of one stock for every (short, long) window pair.
+    Every array has one column per pair.
+
+    Returns:
+    numpy.ndarray: The profit (final portfolio value minus initial capital) of each pair
+    numpy.ndarray: The accuracy, precision and recall of each pair, as a (3 x pairs) array
+    """
+    windows = sorted({window for pair in pairs for window in pair})
+    averages = _moving_averages(close, windows)
+    short_ma = averages[:, [windows.index(short_window) for short_window, _ in pairs]]
+    long_ma = averages[:, [windows.index(long_window) for _, long_window in pairs]]
+
+    # Signals and positions (1 to buy, -1 to sell) for each pair
+    signal = (short_ma > long_ma).astype(float)
+    positions = np.diff(signal, axis=0)
+
+    # The cash spent on the trades plus the value of the holdings at the end
+    profit = signal[-1] * close[-1] - (positions * close[1:, None]).sum(axis=0)
+
+    # Classify the trades by the return of the day they were made
+    trade_return = positions * (close[1:] / close[:-1] - 1)[:, None]
+    true_positive = ((trade_return > 0) & (positions == 1.0)).sum(axis=0)
+    false_positive = ((trade_return < 0) & (positions == 1.0)).sum(axis=0)
+    false_negative = ((trade_return > 0) & (positions == -1.0)).sum(axis=0)
+    true_negative = ((trade_return < 0) & (positions == -1.0)).sum(axis=0)
+    total_trades = true_positive + false_positive + false_negative + true_negative
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = np.nan_to_num(np.array([
+            (true_positive + true_negative) / total_trades,
+            true_positive / (true_positive + false_positive),
+            true_positive / (true_positive + false_negative),
+        ]))
+    return profit, metrics
+
+def moving_average_crossover_sweep(data_by_stock, short_windows=(20, 50), long_windows=(100, 200),
+                                   initial_capitals=(100000,), max_workers=None):
+    """
+    This function runs the moving average crossover backtest for a grid of short/long windows
+    and initial capitals over many stocks. Each stock is evaluated for all the window pairs at once
+    on 2-D arrays, and the stocks are spread over a process pool.
+
+    Parameters:
+    data_by_stock (dict): The stock price data (with a 'close' column) for each stock symbol
+    short_windows (list): The short moving average windows
+    long_windows (list): The long moving average windows, only pairs with short < long are evaluated
+    initial_capitals (list): The initial capitals
+    max_workers (int): The number of processes. Default is the number of CPUs, 1 runs in this process.
+
+    Returns:
+    DataFrame: One row per stock, window pair and initial capital with the final portfolio value,
+               ROI, accuracy, precision, and recall.
+    """
+    pairs = [(short_window, long_window) for short_window in short_windows for long_window in long_windows
+             if short_window < long_window]
+    if not pairs:
+        raise ValueError("At least one short window must be smaller than a long window.")
+    stocks = list(data_by_stock)
+    closes = [data_by_stock[stock]['close'].to_numpy(dtype=float) for stock in stocks]
+
+    if max_workers == 1 or len(stocks) == 1:
+        results = [_sweep_stock(close, pairs) for close in closes]
+    else:
+        # Hand the stocks out in chunks, large universes would otherwise pay one round trip per stock
+        chunksize = max(1, len(closes) // (4 * (max_workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_sweep_stock, closes, [pairs] * len(closes), chunksize=chunksize))
+
+    # The profit doesn't depend on the initial capital, so every capital reuses it
+    capitals = np.asarray(initial_capitals, dtype=float)
+    rows = []
+    for stock, (profit, metrics) in zip(stocks, results):
+        for j, (short_window, long_window) in enumerate(pairs):
+            for capital in capitals:
+                rows.append({
+                    'stock': stock,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                    'initial_capital': capital,
+                    'final_portfolio_value': capital + profit[j],
+                    'roi': profit[j] / capital,
+                    'accuracy': metrics[0, j],
+                    'precision': metrics[1, j],
+                    'recall': metrics[2, j],
+                })
+    return pd.DataFrame(rows)
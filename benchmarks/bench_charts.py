@@ -0,0 +1,42 @@
+"""
+Compares the size and rendering time of the stock charts with and without downsampling.
+
+Run from the project root:
+    python -m benchmarks.bench_charts --bars 10000 20000
+"""
+import os
+import time
+import argparse
+import tempfile
+import stock_functions
+from benchmarks.synthetic import make_ohlcv
+
+def render(data, stock, max_points, directory):
+    """
+    Render the six charts of a stock and return the time it took and the total size of the files.
+    """
+    stock_functions.CHARTS_DIR = directory
+    start = time.perf_counter()
+    stock_functions.visualize_stock_patterns(data, stock, max_points=max_points)
+    stock_functions.visualize_stock(data, stock, max_points=max_points)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if name.startswith(f'{stock}_') and name.endswith('.html'))
+    return elapsed, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bars', type=int, nargs='+', default=[2500, 10000, 40000])
+    parser.add_argument('--max-points', type=int, default=stock_functions.CHART_MAX_POINTS)
+    args = parser.parse_args()
+
+    print(f"{'bars':>8} {'mode':>12} {'time (s)':>10} {'size (KB)':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for bars in args.bars:
+            data = make_ohlcv('SYN', bars)
+            for mode, max_points in (('exact', None), ('downsampled', args.max_points)):
+                elapsed, size = render(data, 'SYN', max_points, directory)
+                print(f'{bars:>8} {mode:>12} {elapsed:>10.3f} {size / 1024:>10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures the startup time of the app: the latency of `import app` in a fresh interpreter,
+and which heavy dependencies it loads.
+
+Run from the project root:
+    python -m benchmarks.bench_startup --runs 5
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Dependencies that should only be loaded by the code paths that use them
+HEAVY_MODULES = ['yfinance', 'ta', 'plotly', 'matplotlib', 'scipy']
+
+SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'loaded': [name for name in %r if name in sys.modules]}))
+""" % HEAVY_MODULES
+
+def measure(runs):
+    """
+    Import the app in `runs` fresh interpreters and return the import times and the heavy modules loaded.
+    """
+    times, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', SCRIPT], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['elapsed'])
+        loaded.update(result['loaded'])
+    return times, sorted(loaded)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, help='Exit with an error if the median import time is above this')
+    args = parser.parse_args()
+
+    times, loaded = measure(args.runs)
+    median = statistics.median(times)
+    print(f"import app: median {median:.3f} s, min {min(times):.3f} s, max {max(times):.3f} s over {args.runs} runs")
+    print(f"heavy modules loaded: {', '.join(loaded) or 'none'}")
+    if args.max_seconds is not None and median > args.max_seconds:
+        sys.exit(f'import app took {median:.3f} s, more than {args.max_seconds} s')
+
+if __name__ == '__main__':
+    main()
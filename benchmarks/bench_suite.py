@@ -0,0 +1,170 @@
+"""
+Benchmark suite of the hot paths: every indicator, the scoring, the moving average crossover backtest and
+the streaming indicators, on synthetic data (no network needed). Reports the best time and the peak memory (tracemalloc) of each case.
+The results can be saved as a baseline and later runs compared to it, failing on slowdowns.
+
+Run from the project root:
+    python -m benchmarks.bench_suite --bars 1000 100000 --universe 1 100 --save baseline.json
+    python -m benchmarks.bench_suite --bars 1000 100000 --universe 1 100 --compare baseline.json
+
+The full range of the suite is --bars 1000 10000 100000 1000000 10000000 --universe 1 100 1000 5000,
+the largest cases need a few GB of memory.
+"""
+import re
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import bullish_signals_indicators as indicators
+from backtest_strategy import calculate_score, score_stocks, moving_average_crossover_backtest
+from streaming_indicators import StreamingSignals
+from price_panel import PricePanel
+from portfolio_backtest import portfolio_backtest
+from benchmarks.synthetic import make_ohlcv
+
+# Indicators benchmarked on their own, by name
+INDICATORS = {
+    'moving_average_crossover': lambda data, stock: indicators.moving_average_crossover(data, stock),
+    'rsi_oversold': lambda data, stock: indicators.rsi_oversold(data, stock),
+    'volume_spikes': lambda data, stock: indicators.volume_spikes(data),
+    'breakouts': lambda data, stock: indicators.breakouts(data),
+    'bollinger_bands': lambda data, stock: indicators.bollinger_bands(data),
+    'exponential_moving_average': lambda data, stock: indicators.exponential_moving_average(data),
+    'cup_and_handle': lambda data, stock: indicators.find_cup_and_handle(data),
+    'ascending_triangle': lambda data, stock: indicators.find_ascending_triangle(data),
+    'inverse_head_and_shoulders': lambda data, stock: indicators.find_inverse_head_and_shoulders(data),
+    'compute_signals': lambda data, stock: indicators.compute_signals(data, stock),
+}
+
+# Parameters of the scoring calls
+DAYS = 10
+THRESHOLD = 0.05
+RSI_THRESHOLD = 30
+
+def measure(function, repeat):
+    """
+    Run a case `repeat` times for its best time, then once more under tracemalloc for its peak memory.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'peak_mb': peak / 2 ** 20}
+
+def series_cases(bars):
+    """
+    The cases of a single stock with `bars` bars.
+    """
+    data = make_ohlcv('SYN', bars)
+    as_of = data['date'].iloc[-1]
+    for name, indicator in INDICATORS.items():
+        yield f'indicator/{name}/{bars}', lambda indicator=indicator: indicator(data, 'SYN')
+    yield f'score/calculate_score/{bars}', lambda: calculate_score(data, 'SYN', DAYS, THRESHOLD, RSI_THRESHOLD, as_of=as_of)
+    yield f'backtest/moving_average_crossover/{bars}', lambda: moving_average_crossover_backtest(data, 'SYN')
+    yield f'streaming/update_many/{bars}', lambda: StreamingSignals().update_many(data)
+
+def universe_cases(tickers, bars):
+    """
+    The cases of a universe of `tickers` stocks with `bars` bars each.
+    """
+    data_by_stock = {f'S{i}': make_ohlcv(f'S{i}', bars, seed=i) for i in range(tickers)}
+    as_of = max(data['date'].iloc[-1] for data in data_by_stock.values())
+
+    def score_each():
+        for stock, data in data_by_stock.items():
+            calculate_score(data, stock, DAYS, THRESHOLD, RSI_THRESHOLD, as_of=as_of)
+
+    def backtest_each():
+        for stock, data in data_by_stock.items():
+            moving_average_crossover_backtest(data, stock)
+
+    yield f'universe/calculate_score/{tickers}x{bars}', score_each
+    yield f'universe/score_stocks/{tickers}x{bars}', lambda: score_stocks(data_by_stock, [DAYS], THRESHOLD, RSI_THRESHOLD, as_of=as_of)
+    yield f'universe/moving_average_crossover/{tickers}x{bars}', backtest_each
+    panel = PricePanel.from_frames(data_by_stock)
+    yield f'universe/portfolio_backtest/{tickers}x{bars}', lambda: portfolio_backtest(panel, DAYS, THRESHOLD, RSI_THRESHOLD, max_workers=1)
+
+def run(bars, universe, universe_bars, repeat, only=None):
+    """
+    Run the suite and return the results of each case by name.
+    """
+    groups = [lambda bars=size: series_cases(bars) for size in bars]
+    groups += [lambda tickers=tickers: universe_cases(tickers, universe_bars) for tickers in universe]
+    # Warm up on a small series, so the lazy imports and the first call costs are not measured
+    for _, function in series_cases(1000):
+        function()
+
+    results = {}
+    for group in groups:
+        # The data of a group is generated when the group starts and released when it ends
+        for name, function in group():
+            if only and not re.search(only, name):
+                continue
+            results[name] = measure(function, repeat)
+            print(f"{name:<60} {results[name]['time']:>10.4f} s {results[name]['peak_mb']:>10.1f} MB", flush=True)
+    return results
+
+def compare(results, baseline, tolerance, memory_tolerance, min_delta):
+    """
+    Compare the results to a baseline.
+
+    Parameters:
+    results (dict): The results of this run
+    baseline (dict): The results of the baseline run
+    tolerance (float): The allowed relative slowdown, e.g. 0.25 for 25%
+    memory_tolerance (float): The allowed relative increase of the peak memory
+    min_delta (float): Slowdowns smaller than this (in seconds) are ignored, as timer noise
+
+    Returns:
+    list: The regressions, as messages
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['time'] > base['time'] * (1 + tolerance) and result['time'] - base['time'] > min_delta:
+            regressions.append(f"{name}: {base['time']:.4f} s -> {result['time']:.4f} s")
+        if result['peak_mb'] > base['peak_mb'] * (1 + memory_tolerance) and result['peak_mb'] - base['peak_mb'] > 1:
+            regressions.append(f"{name}: {base['peak_mb']:.1f} MB -> {result['peak_mb']:.1f} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bars', type=int, nargs='*', default=[1000, 10000, 100000], help='Series lengths of the single stock cases')
+    parser.add_argument('--universe', type=int, nargs='*', default=[1, 100], help='Numbers of tickers of the universe cases')
+    parser.add_argument('--universe-bars', type=int, default=1000, help='Bars per ticker of the universe cases')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the best time is kept')
+    parser.add_argument('--only', help='Only run the cases whose name matches this regular expression')
+    parser.add_argument('--save', help='Save the results as a JSON baseline')
+    parser.add_argument('--compare', help='Compare the results to a JSON baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='Allowed relative increase of the peak memory')
+    parser.add_argument('--min-delta', type=float, default=0.002, help='Slowdowns below this many seconds are ignored')
+    args = parser.parse_args()
+
+    results = run(args.bars, args.universe, args.universe_bars, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance, args.min_delta)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression against {args.compare}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+# Business days from 1980 until the end of the datetime64[ns] range, rounded down
+MAX_DAILY_BARS = 70000
+
+def make_ohlcv(stock='SYN', bars=10000, seed=0, start='1980-01-01', freq=None):
+    """
+    Generates a synthetic daily OHLCV history with the preprocessed columns used by the app
+    ('{stock}_50_day_ma', '{stock}_200_day_ma' and '{stock}_rsi'). No network access is needed.
+
+    Parameters:
+    stock (str): The stock symbol used in the column names.
+    bars (int): The number of bars.
+    seed (int): The seed of the random generator, the same seed gives the same data.
+    start (str): The date of the first bar.
+    freq (str): The spacing of the bars, as a pandas frequency. Default is business days, or minutes
+                when that many business days would not fit in the datetime64[ns] range (about 70k bars).
+
+    Returns:
+    pandas.DataFrame: The synthetic stock data.
+    """
+    rng = np.random.default_rng(seed)
+    if freq is None:
+        freq = 'B' if bars <= MAX_DAILY_BARS else 'min'
+    dates = pd.date_range(start, periods=bars, freq=freq)
+    # Longer histories get a smaller drift and volatility per bar, so the prices stay in a realistic range
+    scale = min(1, MAX_DAILY_BARS / bars)
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0003 * scale, 0.02 * scale ** 0.5, bars)))
+    high = close * (1 + np.abs(rng.normal(0, 0.01, bars)))
+    low = close * (1 - np.abs(rng.normal(0, 0.01, bars)))
+    data = pd.DataFrame({
+        'date': dates,
+        'open': close * (1 + rng.normal(0, 0.005, bars)),
+        'high': high,
+        'low': low,
+        'close': close,
+        'adj_close': close,
+        'volume': rng.lognormal(13, 0.6, bars).round(),
+    })
+
+    # Same moving averages and Wilder RSI as the preprocessing of the downloaded data
+    data[f'{stock}_50_day_ma'] = data['close'].rolling(window=50).mean()
+    data[f'{stock}_200_day_ma'] = data['close'].rolling(window=200).mean()
+    diff = data['close'].diff(1)
+    gains = diff.where(diff > 0, 0.0).ewm(alpha=1 / 14, min_periods=14, adjust=False).mean()
+    losses = (-diff.where(diff < 0, 0.0)).ewm(alpha=1 / 14, min_periods=14, adjust=False).mean()
+    data[f'{stock}_rsi'] = np.where(losses == 0, 100, 100 - (100 / (1 + gains / losses)))
+    return data
@@ -1,5 +1,207 @@
+import numpy as np
 import pandas as pd
-from scipy.signal import find_peaks
+from metrics import timed
+
+# Names of the signals returned by compute_signals, in the order used by the report
+SIGNALS = ['moving_average_crossover', 'rsi_oversold', 'volume_spikes', 'breakouts', 'bollinger_bands',
+           'exponential_moving_average', 'cup_and_handle', 'ascending_triangle', 'inverse_head_and_shoulders']
+# The chart patterns of SIGNALS, found with find_peaks over the whole history rather than bar by bar
+PATTERN_SIGNALS = ['cup_and_handle', 'ascending_triangle', 'inverse_head_and_shoulders']
+
+def find_peaks(values, distance):
+    """
+    scipy.signal.find_peaks, imported on first use as scipy takes a while to load.
+    """
+    from scipy.signal import find_peaks
+    return find_peaks(values, distance=distance)
+
+def _previous(values):
+    """
+    Shift an array by one bar, the first bar has no previous value (NaN).
+    """
+    previous = np.empty(len(values), dtype=float)
+    previous[:1] = np.nan
+    previous[1:] = values[:-1]
+    return previous
+
+def _crosses_above(values, line, previous_values=None):
+    """
+    Mask of the bars where `values` is above `line` and the previous bar was below it.
+    """
+    if previous_values is None:
+        previous_values = _previous(values)
+    return (values > line) & (previous_values < _previous(line))
+
+def _dates(data, mask):
+    """
+    The list of dates (as contained in the 'date' column of the DataFrame) where the mask is True.
+    """
+    return data.loc[mask, 'date'].tolist()
+
+def _pattern_dates(data, left, right):
+    """
+    Convert the start and end indices of the patterns to the (completion dates, (start, end) dates) lists.
+    """
+    dates = data['date']
+    patterns = dates.iloc[right].tolist()
+    return patterns, list(zip(dates.iloc[left].tolist(), patterns))
+
+def _mask(length, indices):
+    mask = np.zeros(length, dtype=bool)
+    mask[indices] = True
+    return mask
+
+# The helpers below take the closing prices both as a Series (for the rolling windows)
+# and as numpy arrays, so compute_signals can share them between the indicators
+
+def _volume_spike_mask(close_prices, previous_close, volume, threshold):
+    avg_volume = volume.rolling(window=50, min_periods=1).mean().to_numpy()
+    return (volume.to_numpy() > threshold * avg_volume) & (close_prices > previous_close)
+
+def _breakout_mask(close_prices, high):
+    high_max = high.rolling(window=50, min_periods=1).max().to_numpy()
+    return close_prices > _previous(high_max)
+
+def _bollinger_bands(close, close_prices, previous_close, window, num_std):
+    rolling_mean = close.rolling(window).mean()
+    rolling_std = close.rolling(window).std()
+    upper_band = rolling_mean + (rolling_std * num_std)
+    lower_band = rolling_mean - (rolling_std * num_std)
+    return _crosses_above(close_prices, lower_band.to_numpy(), previous_close), upper_band, lower_band
+
+def _ema_mask(close, close_prices, previous_close, span):
+    return _crosses_above(close_prices, close.ewm(span=span).mean().to_numpy(), previous_close)
+
+def _segment_mins(values, starts, stop=None):
+    """
+    Minimum of `values` between consecutive sorted start indices, i.e. min(values[starts[i]:starts[i+1]]),
+    the last segment ending at `stop` (default: the end of the array). Computed in one O(n) pass.
+    """
+    values = values[:stop]
+    if len(starts) == 0:
+        return np.empty(0, dtype=values.dtype)
+    return np.minimum.reduceat(values, starts)
+
+def _cup_and_handle_indices(close_prices, peaks):
+    """
+    Start and end indices of the 'Cup and Handle' patterns found over the given peaks.
+    """
+    if len(peaks) < 3:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    left_peak, center_peak, right_peak = peaks[:-2], peaks[1:-1], peaks[2:]
+
+    # Lowest close between each pair of consecutive peaks: the cup bottom is the segment
+    # starting at the left peak and the handle bottom the one starting at the center peak
+    bottoms = _segment_mins(close_prices, peaks[:-1], stop=peaks[-1])
+    cup_bottom, handle_bottom = bottoms[:-1], bottoms[1:]
+
+    # Check if the pattern meets the 'Cup and Handle' criteria
+    found = ((close_prices[left_peak] < close_prices[center_peak]) & (close_prices[right_peak] < close_prices[center_peak])
+             & (handle_bottom > cup_bottom) & (close_prices[right_peak] > close_prices[center_peak] * 0.95))
+    return left_peak[found], right_peak[found]
+
+def _ascending_triangle_indices(close_prices, peaks, troughs):
+    """
+    Start and end indices of the 'Ascending Triangle' patterns found over the given peaks and troughs.
+    """
+    if len(peaks) < 2:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    left_peak, right_peak = peaks[:-1], peaks[1:]
+
+    # Troughs strictly between each pair of consecutive peaks, as [first, last) positions in `troughs`
+    first = np.searchsorted(troughs, left_peak, side='right')
+    last = np.searchsorted(troughs, right_peak, side='left')
+    has_troughs = first < last
+
+    # The pairs don't overlap, so the lowest trough of every pair comes from a single pass
+    min_trough = np.full(len(left_peak), np.nan)
+    if has_troughs.any():
+        min_trough[has_troughs] = _segment_mins(close_prices[troughs], first[has_troughs], stop=last[has_troughs][-1])
+
+    found = has_troughs & (min_trough > close_prices[left_peak] * 0.95)
+    return left_peak[found], right_peak[found]
+
+def _inverse_head_and_shoulders_indices(close_prices, troughs):
+    """
+    Start and end indices of the 'Inverse Head and Shoulders' patterns found over the given troughs.
+    """
+    if len(troughs) < 3:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    left_shoulder, head, right_shoulder = troughs[:-2], troughs[1:-1], troughs[2:]
+
+    # Check if the pattern meets the 'Inverse Head and Shoulders' criteria
+    found = (close_prices[left_shoulder] > close_prices[head]) & (close_prices[right_shoulder] > close_prices[head])
+    return left_shoulder[found], right_shoulder[found]
+
+def last_pattern_indices(close_prices, window=50):
+    """
+    Index of the last bar where each chart pattern was detected, -1 if it never was.
+
+    Parameters:
+    close_prices (numpy.ndarray): The closing prices
+    window (int): The minimum number of data points between peaks and troughs. Default is 50.
+
+    Returns:
+    dict: The index of the last 'cup_and_handle', 'ascending_triangle' and 'inverse_head_and_shoulders' pattern
+    """
+    peaks, _ = find_peaks(close_prices, distance=window)
+    troughs, _ = find_peaks(-close_prices, distance=window)
+    ends = {
+        'cup_and_handle': _cup_and_handle_indices(close_prices, peaks)[1],
+        'ascending_triangle': _ascending_triangle_indices(close_prices, peaks, troughs)[1],
+        'inverse_head_and_shoulders': _inverse_head_and_shoulders_indices(close_prices, troughs)[1],
+    }
+    return {signal: int(end.max()) if len(end) else -1 for signal, end in ends.items()}
+
+def compute_signals(data, stock, volume_threshold=2, rsi_threshold=30, bollinger_window=20, num_std=2,
+                    ema_span=20, pattern_window=50):
+    """
+    Computes every bullish signal of this module in a single pass.
+    The closing prices, their previous values and the peaks and troughs are computed once and
+    shared by all the indicators. The input DataFrame is not modified.
+    Each indicator is timed as the 'indicator.{name}' stage (see metrics).
+
+    Parameters:
+    data (pandas.DataFrame): A DataFrame containing stock data including 'close', 'high' and 'volume' prices
+                             and the '{stock}_50_day_ma', '{stock}_200_day_ma' and '{stock}_rsi' columns.
+    stock (str): The stock symbol to analyze.
+    volume_threshold (float): The multiplier to identify volume spikes. Default is 2.
+    rsi_threshold (float): The RSI threshold to identify oversold conditions. Default is 30.
+    bollinger_window (int): The window size for the Bollinger Bands. Default is 20.
+    num_std (int): The number of standard deviations for the Bollinger Bands. Default is 2.
+    ema_span (int): The span for calculating the EMA. Default is 20.
+    pattern_window (int): The minimum number of data points between peaks and troughs. Default is 50.
+
+    Returns:
+    dict: A boolean numpy array per signal (see SIGNALS), True on the bars where the signal is detected.
+    """
+    close = data['close']
+    close_prices = close.to_numpy(dtype=float)
+    previous_close = _previous(close_prices)
+    length = len(close_prices)
+
+    # Peaks and troughs shared by the chart patterns
+    with timed('indicator.peaks'):
+        peaks, _ = find_peaks(close_prices, distance=pattern_window)
+        troughs, _ = find_peaks(-close_prices, distance=pattern_window)
+
+    indicators = {
+        'moving_average_crossover': lambda: _crosses_above(data[f'{stock}_50_day_ma'].to_numpy(dtype=float),
+                                                           data[f'{stock}_200_day_ma'].to_numpy(dtype=float)),
+        'rsi_oversold': lambda: data[f'{stock}_rsi'].to_numpy(dtype=float) < rsi_threshold,
+        'volume_spikes': lambda: _volume_spike_mask(close_prices, previous_close, data['volume'], volume_threshold),
+        'breakouts': lambda: _breakout_mask(close_prices, data['high']),
+        'bollinger_bands': lambda: _bollinger_bands(close, close_prices, previous_close, bollinger_window, num_std)[0],
+        'exponential_moving_average': lambda: _ema_mask(close, close_prices, previous_close, ema_span),
+        'cup_and_handle': lambda: _mask(length, _cup_and_handle_indices(close_prices, peaks)[1]),
+        'ascending_triangle': lambda: _mask(length, _ascending_triangle_indices(close_prices, peaks, troughs)[1]),
+        'inverse_head_and_shoulders': lambda: _mask(length, _inverse_head_and_shoulders_indices(close_prices, troughs)[1]),
+    }
+    signals = {}
+    for name, indicator in indicators.items():
+        with timed(f'indicator.{name}'):
+            signals[name] = indicator()
+    return signals
 
 def moving_average_crossover(data, stock):
     """
@@ -15,18 +217,13 @@ def moving_average_crossover(data, stock):
           crosses above the 200-day moving average.
     """
 
-    # Extract the 50-day moving average for the given stock
-    fifty_ma = data[f'{stock}_50_day_ma']
-
-    # Extract the 200-day moving average for the given stock
-    two_hundred_ma = data[f'{stock}_200_day_ma']
-
     # Identify where the 50-day MA is greater than the 200-day MA
     # and the previous day it was less than the 200-day MA
-    crossover = (fifty_ma > two_hundred_ma) & (fifty_ma.shift(1) < two_hundred_ma.shift(1))
+    crossover = _crosses_above(data[f'{stock}_50_day_ma'].to_numpy(dtype=float),
+                               data[f'{stock}_200_day_ma'].to_numpy(dtype=float))
 
     # Return the list of dates where the crossover condition is met
-    return data.loc[crossover, 'date'].tolist()
+    return _dates(data, crossover)
 
 def rsi_oversold(data, stock, threshold=30):
     """
@@ -59,15 +256,13 @@ def volume_spikes(data, threshold=2):
     list: A list of dates (as contained in the 'date' column of the DataFrame) when the volume spikes.
     """
 
-    # Calculate the rolling average volume over the past 50 days
-    avg_volume = data['volume'].rolling(window=50, min_periods=1).mean()
-
-    # Identify where the volume is greater than the threshold times the average volume
+    # Identify where the volume is greater than the threshold times the 50-day average volume
     # and the closing price is higher than the previous day's closing price
-    volume_spike = (data['volume'] > threshold * avg_volume) & (data['close'] > data['close'].shift(1))
+    close_prices = data['close'].to_numpy(dtype=float)
+    volume_spike = _volume_spike_mask(close_prices, _previous(close_prices), data['volume'], threshold)
 
     # Return the list of dates where the volume spike condition is met
-    return data.loc[volume_spike, 'date'].tolist()
+    return _dates(data, volume_spike)
 
 def breakouts(data):
     """
@@ -80,14 +275,11 @@ def breakouts(data):
     list: A list of dates (as contained in the 'date' column of the DataFrame) when the breakout occurs.
     """
 
-    # Calculate the highest high over the past 50 days
-    data['high_max'] = data['high'].rolling(window=50, min_periods=1).max()
-
-    # Identify where the closing price is higher than the previous day's highest high
-    breakout = data['close'] > data['high_max'].shift(1)
+    # Identify where the closing price is higher than the previous day's highest high of the past 50 days
+    breakout = _breakout_mask(data['close'].to_numpy(dtype=float), data['high'])
 
     # Return the list of dates where the breakout condition is met
-    return data.loc[breakout, 'date'].tolist()
+    return _dates(data, breakout)
 
 def bollinger_bands(data, window=20, num_std=2):
     """
@@ -105,19 +297,13 @@ def bollinger_bands(data, window=20, num_std=2):
     pandas.Series: The lower Bollinger Band.
     """
 
-    # Calculate the rolling mean and standard deviation
-    rolling_mean = data['close'].rolling(window).mean()
-    rolling_std = data['close'].rolling(window).std()
-
-    # Calculate the upper and lower Bollinger Bands
-    upper_band = rolling_mean + (rolling_std * num_std)
-    lower_band = rolling_mean - (rolling_std * num_std)
-
-    # Identify where the closing price crosses above the lower band
-    bullish_signal = (data['close'] > lower_band) & (data['close'].shift(1) < lower_band.shift(1))
+    # Calculate the Bollinger Bands and identify where the closing price crosses above the lower band
+    close_prices = data['close'].to_numpy(dtype=float)
+    bullish_signal, upper_band, lower_band = _bollinger_bands(data['close'], close_prices, _previous(close_prices),
+                                                              window, num_std)
 
     # Return the list of dates where the bullish signal condition is met and the Bollinger Bands
-    return data.loc[bullish_signal, 'date'].tolist(), upper_band, lower_band
+    return _dates(data, bullish_signal), upper_band, lower_band
 
 def exponential_moving_average(data, span=20):
     """
@@ -132,14 +318,12 @@ def exponential_moving_average(data, span=20):
           crosses above the EMA.
     """
 
-    # Calculate the Exponential Moving Average (EMA)
-    ema = data['close'].ewm(span=span).mean()
-
-    # Identify where the closing price crosses above the EMA
-    bullish_signal = (data['close'] > ema) & (data['close'].shift(1) < ema.shift(1))
+    # Identify where the closing price crosses above the Exponential Moving Average (EMA)
+    close_prices = data['close'].to_numpy(dtype=float)
+    bullish_signal = _ema_mask(data['close'], close_prices, _previous(close_prices), span)
 
     # Return the list of dates where the bullish signal condition is met
-    return data.loc[bullish_signal, 'date'].tolist()
+    return _dates(data, bullish_signal)
 
 def find_cup_and_handle(data, window=50):
     """
@@ -156,26 +340,12 @@ def find_cup_and_handle(data, window=50):
               for each identified pattern.
     """
 
-    patterns = []
-    patterns_between = []
-    close_prices = data['close'].values
+    close_prices = data['close'].to_numpy(dtype=float)
 
     # Identify peaks in the closing prices
     peaks, _ = find_peaks(close_prices, distance=window)
 
-    for i in range(len(peaks) - 2):
-        left_peak, center_peak, right_peak = peaks[i], peaks[i+1], peaks[i+2]
-
-        # Check if the pattern meets the 'Cup and Handle' criteria
-        if close_prices[left_peak] < close_prices[center_peak] and close_prices[right_peak] < close_prices[center_peak]:
-            cup_bottom = close_prices[left_peak:center_peak].min()
-            handle_bottom = close_prices[center_peak:right_peak].min()
-
-            if handle_bottom > cup_bottom and close_prices[right_peak] > close_prices[center_peak] * 0.95:
-                patterns.append(data['date'].iloc[right_peak])
-                patterns_between.append((data['date'].iloc[left_peak], data['date'].iloc[right_peak]))
-
-    return patterns, patterns_between
+    return _pattern_dates(data, *_cup_and_handle_indices(close_prices, peaks))
 
 def find_ascending_triangle(data, window=50):
     """
@@ -192,28 +362,13 @@ def find_ascending_triangle(data, window=50):
               for each identified pattern.
     """
 
-    patterns = []
-    patterns_between = []
-    close_prices = data['close'].values
+    close_prices = data['close'].to_numpy(dtype=float)
 
     # Identify peaks and troughs in the closing prices
     peaks, _ = find_peaks(close_prices, distance=window)
     troughs, _ = find_peaks(-close_prices, distance=window)
 
-    for i in range(len(peaks) - 1):
-        left_peak, right_peak = peaks[i], peaks[i+1]
-        relevant_troughs = [t for t in troughs if left_peak < t < right_peak]
-
-        if not relevant_troughs:
-            continue
-
-        min_trough = min(relevant_troughs, key=lambda x: close_prices[x])
-
-        if close_prices[min_trough] > close_prices[left_peak] * 0.95:
-            patterns.append(data['date'].iloc[right_peak])
-            patterns_between.append((data['date'].iloc[left_peak], data['date'].iloc[right_peak]))
-
-    return patterns, patterns_between
+    return _pattern_dates(data, *_ascending_triangle_indices(close_prices, peaks, troughs))
 
 def find_inverse_head_and_shoulders(data, window=50):
     """
@@ -230,19 +385,9 @@ def find_inverse_head_and_shoulders(data, window=50):
               for each identified pattern.
     """
 
-    patterns = []
-    patterns_between = []
-    close_prices = data['close'].values
+    close_prices = data['close'].to_numpy(dtype=float)
 
     # Identify peaks (inverted, as this is an inverse pattern) in the closing prices
-    peaks, _ = find_peaks(-close_prices, distance=window)
-
-    for i in range(len(peaks) - 2):
-        left_shoulder, head, right_shoulder = peaks[i], peaks[i+1], peaks[i+2]
-
-        # Check if the pattern meets the 'Inverse Head and Shoulders' criteria
-        if close_prices[left_shoulder] > close_prices[head] and close_prices[right_shoulder] > close_prices[head]:
-            patterns.append(data['date'].iloc[right_shoulder])
-            patterns_between.append((data['date'].iloc[left_shoulder], data['date'].iloc[right_shoulder]))
+    troughs, _ = find_peaks(-close_prices, distance=window)
 
-    return patterns, patterns_between
\ No newline at end of file
+    return _pattern_dates(data, *_inverse_head_and_shoulders_indices(close_prices, troughs))
\ No newline at end of file
@@ -0,0 +1,59 @@
+import numpy as np
+
+def minmax_indices(values, max_points, keep=None):
+    """
+    Selects the points to plot from a long series with min/max bucketing.
+    The series is split in equal buckets and the lowest and highest point of each bucket are kept,
+    so peaks and troughs survive the downsampling. The first and last points are always kept.
+
+    Parameters:
+    values (array-like): The values of the series.
+    max_points (int): The target number of points. None keeps every point (exact mode).
+    keep (array-like): Indices that must be kept, e.g. the start and end of the detected patterns.
+
+    Returns:
+    numpy.ndarray: The sorted indices of the points to plot.
+    """
+    values = np.asarray(values, dtype=float)
+    length = len(values)
+    if max_points is None or length <= max_points:
+        return np.arange(length)
+
+    # Two points (min and max) per bucket, the buckets are padded to the same size to reshape them
+    buckets = max(1, max_points // 2)
+    bucket_size = -(-length // buckets)
+    padding = buckets * bucket_size - length
+    lows = np.concatenate([np.where(np.isnan(values), np.inf, values), np.full(padding, np.inf)])
+    highs = np.concatenate([np.where(np.isnan(values), -np.inf, values), np.full(padding, -np.inf)])
+    offsets = np.arange(buckets) * bucket_size
+    mins = offsets + lows.reshape(buckets, bucket_size).argmin(axis=1)
+    maxs = offsets + highs.reshape(buckets, bucket_size).argmax(axis=1)
+
+    kept = [mins, maxs, [0, length - 1]]
+    if keep is not None:
+        kept.append(np.asarray(keep, dtype=int))
+    indices = np.unique(np.concatenate(kept))
+    return indices[indices < length]
+
+def downsample(dates, columns, max_points, keep=None, shared=False):
+    """
+    Downsamples several series that share the same dates for plotting. Each series gets its own
+    points, selected by minmax_indices, and is returned with the matching dates.
+
+    Parameters:
+    dates (array-like): The dates of the series.
+    columns (dict): The values of each series, by name.
+    max_points (int): The target number of points per series. None keeps every point (exact mode).
+    keep (array-like): Indices that must be kept in every series.
+    shared (bool): Whether every series keeps the same points, e.g. for bands filled between each other.
+
+    Returns:
+    dict: A (dates, values) tuple of numpy arrays per series.
+    """
+    dates = np.asarray(dates)
+    columns = {name: np.asarray(values, dtype=float) for name, values in columns.items()}
+    indices = {name: minmax_indices(values, max_points, keep) for name, values in columns.items()}
+    if shared:
+        union = np.unique(np.concatenate(list(indices.values())))
+        indices = {name: union for name in columns}
+    return {name: (dates[indices[name]], values[indices[name]]) for name, values in columns.items()}
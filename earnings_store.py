@@ -0,0 +1,99 @@
+import os
+import time
+import sqlite3
+import pandas as pd
+from contextlib import closing
+
+# SQLite database holding the quarterly earnings of every stock in one normalized table
+DB_PATH = 'fundamental_data/earnings.db'
+
+# Columns of the quarterlyEarnings records of Alpha Vantage
+DATE_COLUMNS = ['fiscalDateEnding', 'reportedDate']
+NUMERIC_COLUMNS = ['reportedEPS', 'estimatedEPS', 'surprise', 'surprisePercentage']
+EARNINGS_COLUMNS = DATE_COLUMNS + NUMERIC_COLUMNS
+
+def _connect():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS earnings (
+        stock TEXT, {', '.join(f'{column} TEXT' for column in DATE_COLUMNS)},
+        {', '.join(f'{column} REAL' for column in NUMERIC_COLUMNS)}, PRIMARY KEY (stock, fiscalDateEnding))''')
+    connection.execute('CREATE TABLE IF NOT EXISTS fetched (stock TEXT PRIMARY KEY, fetched_at REAL)')
+    return connection
+
+def normalize_earnings(data):
+    """
+    Convert the quarterlyEarnings records of Alpha Vantage to typed columns.
+    The dates become datetimes and the numbers floats, the 'None' strings of the API become NaN.
+
+    Parameters:
+    data (DataFrame): The quarterlyEarnings records of a stock
+
+    Returns:
+    DataFrame: The EARNINGS_COLUMNS, sorted by reported date
+    """
+    data = data.reindex(columns=EARNINGS_COLUMNS)
+    for column in DATE_COLUMNS:
+        data[column] = pd.to_datetime(data[column], errors='coerce')
+    for column in NUMERIC_COLUMNS:
+        data[column] = pd.to_numeric(data[column], errors='coerce')
+    return data.sort_values('reportedDate', ignore_index=True)
+
+def save_earnings(stock, data):
+    """
+    Replace the earnings of a stock in the table.
+
+    Parameters:
+    stock (str): The stock symbol
+    data (DataFrame): The quarterlyEarnings records of the stock, raw or normalized
+    """
+    data = normalize_earnings(data)
+    rows = [
+        [stock] + [None if pd.isna(value) else value.strftime('%Y-%m-%d') for value in dates] + [None if pd.isna(value) else float(value) for value in numbers]
+        for dates, numbers in zip(data[DATE_COLUMNS].itertuples(index=False), data[NUMERIC_COLUMNS].itertuples(index=False))
+    ]
+    with closing(_connect()) as connection, connection:
+        connection.execute('DELETE FROM earnings WHERE stock = ?', (stock,))
+        connection.executemany(f'INSERT OR REPLACE INTO earnings (stock, {", ".join(EARNINGS_COLUMNS)}) '
+                               f'VALUES (?, {", ".join("?" * len(EARNINGS_COLUMNS))})', rows)
+        connection.execute('INSERT OR REPLACE INTO fetched (stock, fetched_at) VALUES (?, ?)', (stock, time.time()))
+
+def fetched_at(stock):
+    """
+    Return when the earnings of a stock were saved (a timestamp), or None if they never were.
+    """
+    with closing(_connect()) as connection:
+        row = connection.execute('SELECT fetched_at FROM fetched WHERE stock = ?', (stock,)).fetchone()
+    return row[0] if row else None
+
+def load_earnings(stocks=None):
+    """
+    Load the earnings of some stocks from the table.
+
+    Parameters:
+    stocks (list or str): The stock symbols. Default loads every stock.
+
+    Returns:
+    DataFrame: The 'stock' column and the EARNINGS_COLUMNS, sorted by stock and reported date
+    """
+    if isinstance(stocks, str):
+        stocks = [stocks]
+    if stocks is not None and len(stocks) == 0:
+        # SQLite rejects an empty IN ()
+        data = pd.DataFrame(columns=['stock'] + EARNINGS_COLUMNS)
+        data[DATE_COLUMNS] = data[DATE_COLUMNS].astype('datetime64[ns]')
+        data[NUMERIC_COLUMNS] = data[NUMERIC_COLUMNS].astype(float)
+        return data
+    query = f'SELECT stock, {", ".join(EARNINGS_COLUMNS)} FROM earnings'
+    params = []
+    if stocks is not None:
+        query += f' WHERE stock IN ({", ".join("?" * len(stocks))})'
+        params = list(stocks)
+    query += ' ORDER BY stock, reportedDate'
+
+    with closing(_connect()) as connection:
+        data = pd.read_sql_query(query, connection, params=params)
+    for column in DATE_COLUMNS:
+        data[column] = pd.to_datetime(data[column])
+    return data
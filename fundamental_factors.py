@@ -1,43 +1,213 @@
-import requests
+import os
 import json
+import time
+import hashlib
+import logging
+import threading
+import requests
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.io as pio
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import earnings_store
+
+# The API keys are read on first use from the environment or from this file
+API_KEYS_PATH = 'api_keys.json'
+API_KEY_VARIABLES = {'alphavantage': 'ALPHAVANTAGE_API_KEY', 'newsapi': 'NEWSAPI_API_KEY'}
+_api_keys = None
+
+# Endpoints of the APIs, they can be pointed to another server, e.g. a local stub
+ALPHAVANTAGE_URL = 'https://www.alphavantage.co/query'
+NEWSAPI_URL = 'https://newsapi.org/v2/everything'
+
+# HTTP client settings
+TIMEOUT = (5, 20)  # Connect and read timeouts, in seconds
+RETRIES = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=['GET'])
+
+# On-disk response cache, earnings only change once a quarter while news change all the time
+CACHE_DIR = 'fundamental_data/http_cache'
+EARNINGS_TTL = 24 * 3600  # In seconds
+NEWS_TTL = 3600
+
+# Query parameters holding API keys, left out of the cache keys
+_KEY_PARAMS = {'apikey', 'apiKey'}
+
+_session = None
+_session_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+def get_api_key(name):
+    """
+    Return the key of an API ('alphavantage' or 'newsapi').
+    The environment variable of the key (see API_KEY_VARIABLES) takes precedence over the api_keys.json file,
+    which is only read the first time a key is needed.
+    """
+    global _api_keys
+    if os.environ.get(API_KEY_VARIABLES[name]):
+        return os.environ[API_KEY_VARIABLES[name]]
+    if _api_keys is None:
+        # Open the file and load the keys
+        with open(API_KEYS_PATH, 'r') as f:
+            _api_keys = json.load(f)
+    return _api_keys[name]
+
+def get_session():
+    """
+    The HTTP session shared by every request of this module.
+    It keeps the connections to the APIs open between requests and retries the failed ones with backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=RETRIES)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def _cache_path(url, params):
+    key = json.dumps([url, sorted((name, value) for name, value in params.items() if name not in _KEY_PARAMS)])
+    return os.path.join(CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+def _read_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-from numpy import nan
+def _write_cache(path, data):
+    """
+    Replace the cache entry atomically so concurrent readers never see a half written file.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'fetched_at': time.time(), 'data': data}, f)
+    os.replace(tmp_path, path)
 
-# Open the file and load the keys
-with open('api_keys.json', 'r') as f:
-    api_keys = json.load(f)
+def cached_get_json(url, params, ttl, is_valid=None):
+    """
+    GET a JSON response through the shared session and the on-disk cache.
+    A cached response younger than `ttl` is returned without any request. When the request fails,
+    an older cached response is returned instead if there is one.
 
-# Now api_keys is a dictionary with the keys
-alphavantage_key = api_keys['alphavantage']
-newsapi_key = api_keys['newsapi']
+    Parameters:
+    url (str): The URL to request
+    params (dict): The query parameters
+    ttl (float): How long a response stays fresh, in seconds
+    is_valid (callable): Tells whether a response may be cached, e.g. to skip the rate limit messages
+                         the APIs return with a 200 status. Default caches every response.
+
+    Returns:
+    dict: The JSON response
+    """
+    path = _cache_path(url, params)
+    cached = _read_cache(path)
+    if cached and time.time() - cached['fetched_at'] < ttl:
+        return cached['data']
+
+    try:
+        response = get_session().get(url, params=params, timeout=TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError):
+        if cached:
+            return cached['data']
+        raise
+
+    if is_valid is None or is_valid(data):
+        _write_cache(path, data)
+    return data
+
+def is_cached(url, params, ttl):
+    """
+    Check whether a fresh response to a request is in the on-disk cache, so getting it costs no API call.
+    """
+    cached = _read_cache(_cache_path(url, params))
+    return bool(cached) and time.time() - cached['fetched_at'] < ttl
+
+def earnings_request(stock):
+    """
+    The url, params and ttl of the earnings request of a stock.
+    """
+    return ALPHAVANTAGE_URL, {'function': 'EARNINGS', 'symbol': stock, 'apikey': get_api_key('alphavantage')}, EARNINGS_TTL
+
+def news_request(stock):
+    """
+    The url, params and ttl of the news request of a stock.
+    """
+    return NEWSAPI_URL, {'q': stock, 'apiKey': get_api_key('newsapi')}, NEWS_TTL
 
 def get_earnings_data(stock):
-    url = f'https://www.alphavantage.co/query?function=EARNINGS&symbol={stock}&apikey={alphavantage_key}'
-    response = requests.get(url)
-    data = response.json()
+    data = cached_get_json(*earnings_request(stock), is_valid=lambda data: 'quarterlyEarnings' in data)
+    if 'quarterlyEarnings' not in data:
+        # Alpha Vantage answers rate limits and unknown symbols with a 200 status and a message
+        message = data.get('Note') or data.get('Information') or data.get('Error Message') or 'no quarterlyEarnings'
+        raise ValueError(f'Invalid earnings response for {stock}: {message}')
     data = pd.DataFrame(data['quarterlyEarnings'])
     return data
 
 def get_news_data(stock):
-    url = f'https://newsapi.org/v2/everything?q={stock}&apiKey={newsapi_key}'
-    response = requests.get(url)
-    data = response.json()
+    data = cached_get_json(*news_request(stock), is_valid=lambda data: data.get('status') == 'ok')
     return data
 
+def update_earnings(stock):
+    """
+    Fetch the earnings of a stock and save them, normalized, in the earnings table.
+    """
+    earnings_store.save_earnings(stock, get_earnings_data(stock))
+
+def load_earnings(stock):
+    """
+    Read the earnings of a stock from the earnings table.
+    They are only fetched when the table doesn't hold them or holds them for longer than EARNINGS_TTL.
+    When the fetch fails, the rows the table already holds are returned instead.
+
+    Parameters:
+    stock (str): The stock symbol
+
+    Returns:
+    DataFrame: The normalized earnings of the stock
+    """
+    fetched_at = earnings_store.fetched_at(stock)
+    if fetched_at is None or time.time() - fetched_at >= EARNINGS_TTL:
+        try:
+            update_earnings(stock)
+        except (requests.RequestException, ValueError, KeyError, OSError) as error:
+            if fetched_at is None:
+                raise
+            logger.warning('Could not update the earnings of %s, using the stored ones: %s', stock, error)
+    return earnings_store.load_earnings(stock)
+
+def get_fundamentals(stock):
+    """
+    Fetch the news of a stock and analyze its earnings at the same time, as both wait on a different API.
+
+    Parameters:
+    stock (str): The stock symbol
+
+    Returns:
+    dict: The news data, as returned by get_news_data
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        news = pool.submit(get_news_data, stock)
+        earnings = pool.submit(analyze_earnings, stock)
+        earnings.result()
+        return news.result()
+
 def analyze_earnings(stock):
-    data = get_earnings_data(stock)
-    print(f'DATA: {data}')
-    # Convert the 'reportedDate' column to datetime format
-    data['reportedDate'] = pd.to_datetime(data['reportedDate'])
-    data.replace('None', nan, inplace=True)
+    import plotly.graph_objects as go
+    import plotly.io as pio
 
+    # The earnings table holds the dates as datetimes and the numbers as floats
+    data = load_earnings(stock)
+    data[earnings_store.NUMERIC_COLUMNS] = data[earnings_store.NUMERIC_COLUMNS].fillna(0.0)
 
-    # Convert 'reportedEPS', 'estimatedEPS', 'surprise', and 'surprisePercentage' to float
-    for col in ['reportedEPS', 'estimatedEPS', 'surprise', 'surprisePercentage']:
-        data[col] = pd.to_numeric(data[col], errors='coerce').fillna(0.0)
+    os.makedirs('static/visualizations/fundamental_factors', exist_ok=True)
 
     # Plot the 'reportedEPS' and 'estimatedEPS' over time
     fig1 = go.Figure()
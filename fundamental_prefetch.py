@@ -0,0 +1,110 @@
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import fundamental_factors as ff
+
+# Requests allowed per minute by each API, keep them at or below the quotas of the plans in use
+ALPHAVANTAGE_PER_MINUTE = 5
+NEWSAPI_PER_MINUTE = 30
+
+class TokenBucket:
+    """
+    Async rate limiter: `rate` requests per minute, with bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait until a request is allowed.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def _prefetch(stocks, earnings, news, max_workers):
+    loop = asyncio.get_running_loop()
+    # The blocking requests run on a thread pool, the event loop only schedules them
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+    kinds = {}
+    if earnings:
+        kinds['earnings'] = (ff.earnings_request, ff.update_earnings, TokenBucket(ALPHAVANTAGE_PER_MINUTE))
+    if news:
+        kinds['news'] = (ff.news_request, ff.get_news_data, TokenBucket(NEWSAPI_PER_MINUTE))
+
+    async def fetch(stock, kind):
+        request, fetcher, bucket = kinds[kind]
+        # Building the request can fail too (e.g. no API key), it is reported like a failed fetch
+        try:
+            # Responses still fresh in the on-disk cache don't count against the quotas
+            cached = ff.is_cached(*request(stock))
+            if not cached:
+                await bucket.acquire()
+            await loop.run_in_executor(pool, fetcher, stock)
+            return stock, kind, 'cached' if cached else 'fetched'
+        except Exception as e:
+            return stock, kind, f'error: {e}'
+
+    try:
+        results = await asyncio.gather(*(fetch(stock, kind) for stock in stocks for kind in kinds))
+    finally:
+        pool.shutdown(wait=False)
+
+    report = {stock: {} for stock in stocks}
+    for stock, kind, status in results:
+        report[stock][kind] = status
+    return report
+
+def prefetch_fundamentals(stocks, earnings=True, news=True, max_workers=8):
+    """
+    Fetch the earnings and the news of a whole watchlist ahead of the backtest pages.
+    The earnings are normalized into the earnings table and the news are kept in the on-disk
+    HTTP cache. The requests to each API are rate limited to its per-minute quota.
+
+    Parameters:
+    stocks (list): The stock symbols
+    earnings (bool): Whether to fetch the earnings. Default is True.
+    news (bool): Whether to fetch the news. Default is True.
+    max_workers (int): The number of requests in flight at the same time. Default is 8.
+
+    Returns:
+    dict: The status of each fetch by stock and kind: 'fetched', 'cached' or 'error: ...'
+    """
+    stocks = list(dict.fromkeys(stocks))
+    return asyncio.run(_prefetch(stocks, earnings, news, max_workers))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prefetch the earnings and the news of a watchlist.')
+    parser.add_argument('stocks', nargs='*', help='The stock symbols')
+    parser.add_argument('--file', help='A file with one stock symbol per line (or comma separated)')
+    parser.add_argument('--no-earnings', action='store_true', help="Don't fetch the earnings")
+    parser.add_argument('--no-news', action='store_true', help="Don't fetch the news")
+    parser.add_argument('--workers', type=int, default=8, help='Requests in flight at the same time')
+    args = parser.parse_args()
+
+    stocks = list(args.stocks)
+    if args.file:
+        with open(args.file, 'r') as f:
+            stocks += [stock.strip() for stock in f.read().replace(',', '\n').split() if stock.strip()]
+    if not stocks:
+        parser.error('no stock symbols given')
+
+    report = prefetch_fundamentals(stocks, earnings=not args.no_earnings, news=not args.no_news, max_workers=args.workers)
+    failed = False
+    for stock, statuses in report.items():
+        print(stock, ', '.join(f'{kind}: {status}' for kind, status in statuses.items()))
+        failed = failed or any(status.startswith('error') for status in statuses.values())
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,60 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from analysis_engine import run_batch_analysis
+import result_store
+from report_export import ReportWriter, MAX_EXPORT_BYTES
+
+class JobQueue:
+    """
+    Runs batch analyses in the background, so a request only has to submit them.
+    Each job gets its own pool of `max_workers` workers from run_batch_analysis and up to
+    `max_jobs` jobs run at the same time, so concurrent users don't wait behind each other.
+    The progress and the results of the jobs are kept in the result store, keyed by the job id,
+    and each result is also streamed to the report file of the job (see report_export).
+    """
+
+    def __init__(self, max_jobs=4, executor='thread', max_workers=None, export_format='csv', export_max_bytes=MAX_EXPORT_BYTES):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.export_format = export_format
+        self.export_max_bytes = export_max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='analysis-job')
+
+    def submit(self, stocks, params, on_finish=None):
+        """
+        Queue the analysis of a list of stocks.
+
+        Parameters:
+        stocks (list): The stock symbols to analyze
+        params (dict): The user inputs, with at least 'threshold', 'days', 'rsi_threshold' and 'weights'
+        on_finish (callable): Called with the job id once every stock is done
+
+        Returns:
+        str: The id of the job, which is also its run id in the result store
+        """
+        job_id = uuid.uuid4().hex[:12]
+        result_store.create_run(job_id, dict(params, stocks=stocks), len(stocks))
+        self._pool.submit(self._run, job_id, stocks, params, on_finish)
+        return job_id
+
+    def _run(self, job_id, stocks, params, on_finish):
+        result_store.set_status(job_id, 'running')
+        writer = None
+        try:
+            writer = ReportWriter(job_id, self.export_format, self.export_max_bytes)
+
+            def on_result(index, result):
+                result_store.add_result(job_id, index, result)
+                writer.write(result)
+
+            run_batch_analysis(stocks, params['threshold'], params['days'], params['rsi_threshold'], params['weights'],
+                               executor=self.executor, max_workers=self.max_workers, on_result=on_result)
+            writer.close()
+            if on_finish:
+                on_finish(job_id)
+        except Exception as e:
+            if writer is not None and not writer.closed:
+                writer.abort()
+            result_store.add_error(job_id, str(e))
+        finally:
+            result_store.set_status(job_id, 'finished')
@@ -0,0 +1,143 @@
+import os
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last one catches everything
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+# Latency histogram of each stage, by stage name: bucket counts, sum and count
+_histograms = {}
+_lock = threading.Lock()
+
+# Per-thread timing breakdown, filled while a breakdown is being collected (see collect_breakdown)
+_local = threading.local()
+
+def observe(stage, seconds):
+    """
+    Record the latency of one run of a stage in its histogram.
+
+    Parameters:
+    stage (str): The name of the stage, e.g. 'load_prices' or 'indicator.breakouts'
+    seconds (float): The latency
+    """
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    breakdown = getattr(_local, 'breakdown', None)
+    if breakdown is not None:
+        total = breakdown.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+@contextmanager
+def timed(stage):
+    """
+    Time the code of a `with` block as one run of a stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+@contextmanager
+def collect_breakdown():
+    """
+    Collect the total time and the number of runs of every stage timed by the current thread
+    inside the `with` block, into the yielded dictionary (stage -> [seconds, count]).
+    """
+    previous = getattr(_local, 'breakdown', None)
+    _local.breakdown = breakdown = {}
+    try:
+        yield breakdown
+    finally:
+        _local.breakdown = previous
+
+def merge_breakdown(breakdown):
+    """
+    Record a breakdown collected in another process (e.g. by the process executor) in the histograms
+    of this process. The runs of a stage are recorded with their mean latency.
+    """
+    for stage, (seconds, count) in breakdown.items():
+        for _ in range(count):
+            observe(stage, seconds / count)
+
+def snapshot():
+    """
+    Return a copy of the histograms, by stage name.
+    """
+    with _lock:
+        return {stage: {'buckets': list(histogram['buckets']), 'sum': histogram['sum'], 'count': histogram['count']}
+                for stage, histogram in _histograms.items()}
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus(extra=None):
+    """
+    Render the histograms in the Prometheus text exposition format.
+
+    Parameters:
+    extra (dict): Other metrics to expose, as name -> (type, help text, {labels: value}), the type being
+                  'counter' or 'gauge' and the labels a tuple of (label name, label value) pairs.
+
+    Returns:
+    str: The metrics
+    """
+    lines = [
+        '# HELP stock_analysis_stage_seconds Latency of the stages of the analysis and of the HTTP routes.',
+        '# TYPE stock_analysis_stage_seconds histogram',
+    ]
+    for stage, histogram in sorted(snapshot().items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'stock_analysis_stage_seconds_bucket{{stage="{_label(stage)}",le="{le}"}} {cumulative}')
+        lines.append(f'stock_analysis_stage_seconds_sum{{stage="{_label(stage)}"}} {histogram["sum"]}')
+        lines.append(f'stock_analysis_stage_seconds_count{{stage="{_label(stage)}"}} {histogram["count"]}')
+
+    for name, (metric_type, help_text, values) in (extra or {}).items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in values.items():
+            label_text = ','.join(f'{key}="{_label(label)}"' for key, label in labels)
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+class RequestProfiler:
+    """
+    cProfile capture of single requests. Each profile is dumped to `directory` as
+    '{name}-{timestamp}.prof', to be read with pstats or snakeviz.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, name):
+        """
+        Stop a profile and dump it.
+
+        Returns:
+        str: The path of the profile file
+        """
+        profile.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{threading.get_ident()}.prof')
+        profile.dump_stats(path)
+        return path
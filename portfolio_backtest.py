@@ -0,0 +1,272 @@
+"""
+Portfolio backtest of the recommendations: one capital pool is allocated across many stocks, at every
+rebalancing date, to the stocks whose score (as of the previous bar, see walk_forward) recommends a trade.
+
+The simulation is vectorized over aligned (dates x stocks) matrices. Between two rebalancing dates the
+holdings only drift with the prices, so the value of the portfolio is the value at the last rebalancing
+times the growth of the held weights, computed for every bar at once. Only the value carried from one
+rebalancing to the next is a running product.
+
+Run from the project root over the stocks of the price store:
+    python portfolio_backtest.py AAPL MSFT --rebalance M --sizing equal --max-positions 20 --cost-bps 10
+"""
+import os
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from backtest_strategy import weights_vector
+from walk_forward import window_hits
+from price_panel import PricePanel
+from metrics import timed
+
+# Rebalancing frequencies, as pandas period aliases: every bar, weekly, monthly, quarterly
+REBALANCE_FREQUENCIES = ('D', 'W', 'M', 'Q')
+# Position sizing: the same weight for every selected stock, or weights proportional to their scores
+SIZINGS = ('equal', 'score')
+TRADING_DAYS = 252  # Bars per year, to annualize the volatility and the Sharpe ratio
+
+def _panel_scores(panel, first, last, days, threshold, rsi_threshold, weights, pattern_delay):
+    """
+    The overall scores (as of every bar) of the stocks [first, last) of a panel, as a (dates x stocks) array.
+    """
+    weights = weights_vector(weights)
+    scores = np.full((len(panel.dates), last - first), np.nan)
+    for j, stock in enumerate(panel.stocks[first:last]):
+        hits = window_hits(panel.stock_data(stock), stock, days, threshold, rsi_threshold, pattern_delay)
+        scores[panel.present[:, first + j], j] = hits @ weights / weights.sum()
+    return scores
+
+def _shared_panel_scores(handle, first, last, *arguments):
+    return _panel_scores(PricePanel.attach(handle), first, last, *arguments)
+
+def score_matrices(panel, days, threshold, rsi_threshold, weights: dict = None, pattern_delay=50, max_workers=None):
+    """
+    This function replays the overall scores of the stocks of a price panel over their histories.
+    The worker processes attach the panel through shared memory instead of receiving a copy of the data.
+
+    Parameters:
+    panel (PricePanel): The panel, with the fields used by compute_signals
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    pattern_delay (int): The number of bars before a chart pattern counts (see walk_forward.window_hits)
+    max_workers (int): The number of processes. Default is the number of CPUs, 1 runs in this process.
+
+    Returns:
+    DataFrame: The closing prices, one column per stock, NaN on the dates a stock has no bar
+    DataFrame: The overall scores, same shape
+    """
+    count = len(panel.stocks)
+    arguments = [days, threshold, rsi_threshold, weights, pattern_delay]
+    if max_workers == 1 or count <= 1:
+        scores = _panel_scores(panel, 0, count, *arguments)
+    else:
+        size = max(1, count // (4 * (max_workers or os.cpu_count() or 1)))
+        firsts = list(range(0, count, size))
+        lasts = [min(first + size, count) for first in firsts]
+        with panel.share() as shared, ProcessPoolExecutor(max_workers=max_workers) as pool:
+            scores = np.hstack(list(pool.map(_shared_panel_scores, [shared.handle] * len(firsts), firsts, lasts,
+                                             *[[argument] * len(firsts) for argument in arguments])))
+    close = panel.frame('close')
+    return close, pd.DataFrame(scores, index=close.index, columns=panel.stocks)
+
+def _rebalance_rows(dates, rebalance):
+    """
+    The first bar of every rebalancing period.
+    """
+    if rebalance not in REBALANCE_FREQUENCIES:
+        raise ValueError(f"Unknown rebalancing frequency '{rebalance}', expected one of {REBALANCE_FREQUENCIES}.")
+    periods = pd.DatetimeIndex(dates).to_period(rebalance).asi8
+    return np.flatnonzero(np.concatenate([[True], periods[1:] != periods[:-1]])) if len(periods) else np.empty(0, dtype=int)
+
+def _target_weights(scores, tradable, min_score, max_positions, sizing, max_weight):
+    """
+    The target weights of the stocks at the rebalancing dates: the best `max_positions` stocks above
+    `min_score`, sized equally or by score, each capped at `max_weight` (the rest stays in cash).
+    """
+    eligible = tradable & (scores > min_score)
+    ranked = np.where(eligible, scores, -np.inf)
+    selected = np.zeros_like(eligible)
+    if max_positions is not None:
+        best = np.argsort(-ranked, axis=1, kind='stable')[:, :max_positions]
+        np.put_along_axis(selected, best, True, axis=1)
+        selected &= eligible
+    else:
+        selected = eligible
+
+    size = selected.astype(float) if sizing == 'equal' else np.where(selected, scores, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.nan_to_num(size / size.sum(axis=1, keepdims=True))
+    return np.minimum(weights, max_weight)
+
+def simulate_portfolio(close, scores, initial_capital: float = 100000, rebalance='M', sizing='equal', max_positions=20,
+                       max_weight=1.0, min_score=0.5, cost_bps=10, signal_lag=1, measure_memory=False):
+    """
+    This function simulates a portfolio that, at the first bar of every rebalancing period, invests its value
+    in the stocks recommended by their scores and holds them until the next rebalancing.
+    Trades happen at the closing prices, fractional shares are allowed, and the transaction costs are paid
+    on the traded value. A stock is only bought on a bar where it has a price.
+
+    Parameters:
+    close (DataFrame): The closing prices, one column per stock, indexed by date (see score_matrices)
+    scores (DataFrame): The overall scores, same shape
+    initial_capital (float): The initial capital. Default is 100000.
+    rebalance (str): The rebalancing frequency, one of REBALANCE_FREQUENCIES. Default is monthly.
+    sizing (str): The position sizing, one of SIZINGS. Default is equal weights.
+    max_positions (int): The maximum number of stocks held, the best scores first. None has no limit.
+    max_weight (float): The maximum weight of a stock, the excess stays in cash. Default is 1 (no limit).
+    min_score (float): The score above which a stock is recommended. Default is 0.5, as in the report.
+    cost_bps (float): The transaction costs, in basis points of the traded value. Default is 10.
+    signal_lag (int): The number of bars between a score and the trades it causes. Default is 1, so a
+                      rebalancing only uses the scores known at the previous close.
+    measure_memory (bool): Whether to trace the peak memory of the simulation with tracemalloc. Default is False,
+                           tracing is process-wide: it slows down every thread and concurrent measurements
+                           reset each other's peak, so it is only meant for the command line.
+
+    Returns:
+    dict: The portfolio value of every bar ('values', a Series), the target weights of every rebalancing
+          ('weights', a DataFrame), the final portfolio value, ROI, CAGR, annualized volatility, Sharpe ratio,
+          maximum drawdown, total costs, number of rebalancings, average number of positions, average turnover,
+          and the size of the input matrices and the peak memory of the simulation (in MB, None unless measured)
+    """
+    if sizing not in SIZINGS:
+        raise ValueError(f"Unknown position sizing '{sizing}', expected one of {SIZINGS}.")
+    if max_positions is not None and max_positions < 1:
+        raise ValueError(f"The maximum number of positions must be at least 1, got {max_positions}.")
+    dates = close.index
+    if len(dates) == 0:
+        raise ValueError("There are no prices to backtest.")
+
+    started = measure_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if measure_memory:
+        tracemalloc.reset_peak()
+    peak = None
+    try:
+        with timed('portfolio_backtest'):
+            prices = close.to_numpy(dtype=float)
+            tradable = ~np.isnan(prices)
+            # Held stocks are valued at their last price on the dates they have no bar
+            prices = close.ffill().to_numpy(dtype=float)
+            lagged_scores = np.full(prices.shape, np.nan)
+            lagged_scores[signal_lag:] = scores.to_numpy(dtype=float)[:len(dates) - signal_lag]
+
+            rows = _rebalance_rows(dates, rebalance)
+            targets = _target_weights(lagged_scores[rows], tradable[rows], min_score, max_positions, sizing, max_weight)
+
+            # Growth of the portfolio since the last rebalancing, for every bar: the cash plus the held weights
+            # times the relative prices. The bars before the first rebalancing are all cash.
+            segment = np.searchsorted(rows, np.arange(len(dates)), side='right') - 1
+            invested = segment >= 0
+            segment = np.maximum(segment, 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                relative = np.nan_to_num(prices / prices[rows[segment]], nan=1.0)
+            growth = np.where(invested, 1 - targets[segment].sum(axis=1) + (targets[segment] * relative).sum(axis=1), 1.0)
+            del relative
+
+            # At each rebalancing, the weights of the previous period have drifted with the prices since
+            # the previous rebalancing, and are traded to the new targets
+            with np.errstate(divide='ignore', invalid='ignore'):
+                held = targets[:-1] * np.nan_to_num(prices[rows[1:]] / prices[rows[:-1]], nan=1.0)
+            period_growth = 1 - targets[:-1].sum(axis=1) + held.sum(axis=1)
+            drifted = np.zeros_like(targets)
+            drifted[1:] = held / period_growth[:, None]
+            turnover = np.abs(targets - drifted).sum(axis=1)
+            cost_rate = cost_bps / 10000
+            # Value right after each rebalancing: the value after the previous one, grown over the period, minus the costs
+            carried = np.concatenate([[1.0], period_growth]) * (1 - turnover * cost_rate)
+            after = initial_capital * np.cumprod(carried)
+            values = np.where(invested, after[segment] * growth, initial_capital)
+            costs = after / (1 - turnover * cost_rate) * turnover * cost_rate
+    finally:
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        if started:
+            tracemalloc.stop()
+
+    values = pd.Series(values, index=dates, name='value')
+    returns = values.pct_change().dropna()
+    years = (dates[-1] - dates[0]).days / 365.25
+    final_value = float(values.iloc[-1])
+    volatility = float(returns.std() * np.sqrt(TRADING_DAYS)) if len(returns) > 1 else 0.0
+    return {
+        'values': values,
+        'weights': pd.DataFrame(targets, index=dates[rows], columns=close.columns),
+        'final_portfolio_value': final_value,
+        'roi': (final_value - initial_capital) / initial_capital,
+        'cagr': (final_value / initial_capital) ** (1 / years) - 1 if years > 0 and final_value > 0 else 0.0,
+        'volatility': volatility,
+        'sharpe': float(returns.mean() * TRADING_DAYS / volatility) if volatility > 0 else 0.0,
+        'max_drawdown': float((values / values.cummax() - 1).min()),
+        'total_costs': float(costs.sum()),
+        'rebalances': len(rows),
+        'average_positions': float((targets > 0).sum(axis=1).mean()) if len(rows) else 0.0,
+        'average_turnover': float(turnover.mean()) if len(rows) else 0.0,
+        'peak_memory_mb': peak,
+        'matrix_memory_mb': float(close.memory_usage(deep=False).sum() + scores.memory_usage(deep=False).sum()) / 2 ** 20,
+    }
+
+def portfolio_backtest(panel, days, threshold, rsi_threshold, weights: dict = None, initial_capital: float = 100000,
+                       rebalance='M', sizing='equal', max_positions=20, max_weight=1.0, cost_bps=10, pattern_delay=50,
+                       max_workers=None, measure_memory=False):
+    """
+    This function runs the portfolio backtest of the recommendations of the stocks of a price panel: their scores
+    are replayed over their histories (see score_matrices), then the portfolio is simulated (see simulate_portfolio).
+
+    Parameters:
+    panel (PricePanel): The stocks, with the fields used by compute_signals
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    initial_capital (float): The initial capital. Default is 100000.
+    rebalance (str): The rebalancing frequency, one of REBALANCE_FREQUENCIES. Default is monthly.
+    sizing (str): The position sizing, one of SIZINGS. Default is equal weights.
+    max_positions (int): The maximum number of stocks held. None has no limit.
+    max_weight (float): The maximum weight of a stock. Default is 1 (no limit).
+    cost_bps (float): The transaction costs, in basis points of the traded value. Default is 10.
+    pattern_delay (int): The number of bars before a chart pattern counts (see walk_forward.window_hits)
+    max_workers (int): The number of processes of the score replay. Default is the number of CPUs.
+    measure_memory (bool): Whether to trace the peak memory of the simulation. Default is False.
+
+    Returns:
+    dict: The results of simulate_portfolio
+    """
+    close, scores = score_matrices(panel, days, threshold, rsi_threshold, weights, pattern_delay, max_workers)
+    return simulate_portfolio(close, scores, initial_capital, rebalance, sizing, max_positions, max_weight, cost_bps=cost_bps,
+                              measure_memory=measure_memory)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stocks', nargs='*', help='Stock symbols of the price store. Default is every stored stock.')
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.05)
+    parser.add_argument('--rsi-threshold', type=float, default=30)
+    parser.add_argument('--initial-capital', type=float, default=100000)
+    parser.add_argument('--rebalance', choices=REBALANCE_FREQUENCIES, default='M')
+    parser.add_argument('--sizing', choices=SIZINGS, default='equal')
+    parser.add_argument('--max-positions', type=int, default=20)
+    parser.add_argument('--max-weight', type=float, default=1.0)
+    parser.add_argument('--cost-bps', type=float, default=10)
+    parser.add_argument('--start', help='First date of the backtest. Default is the first stored date.')
+    parser.add_argument('--end', help='Last date of the backtest. Default is the last stored date.')
+    parser.add_argument('--float32', action='store_true', help='Load the prices as float32, halving their memory')
+    parser.add_argument('--workers', type=int, help='Number of processes. Default is the number of CPUs.')
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace the peak memory of the simulation")
+    args = parser.parse_args()
+
+    panel = PricePanel.load(args.stocks or None, start=args.start, end=args.end, dtype='float32' if args.float32 else 'float64')
+    results = portfolio_backtest(panel, args.days, args.threshold, args.rsi_threshold, initial_capital=args.initial_capital,
+                                 rebalance=args.rebalance, sizing=args.sizing, max_positions=args.max_positions,
+                                 max_weight=args.max_weight, cost_bps=args.cost_bps, max_workers=args.workers,
+                                 measure_memory=not args.no_memory)
+    for name, value in results.items():
+        if name not in ('values', 'weights'):
+            print(f'{name}: {value}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import uuid
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from price_store import list_stocks, load_prices
+
+# Fields of the panel named after a column of the price store that includes the stock symbol,
+# the other fields are the columns of the same name ('close', 'high', 'volume', ...)
+FIELD_COLUMNS = {'ma_50': '{stock}_50_day_ma', 'ma_200': '{stock}_200_day_ma', 'rsi': '{stock}_rsi'}
+# Fields used by compute_signals
+SIGNAL_FIELDS = ('close', 'high', 'volume', 'ma_50', 'ma_200', 'rsi')
+
+# Panels attached by this process, by shared memory id, so a worker attaches each panel once
+_attached = {}
+
+def field_column(stock, field):
+    """
+    The column of the price store (and of the stock DataFrames) holding a field of the panel.
+    """
+    return FIELD_COLUMNS.get(field, field).format(stock=stock)
+
+def _date_range(dates, start, end):
+    """
+    The [first, last) rows of the sorted dates between start and end, both included.
+    """
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+    last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+    return first, last
+
+class PricePanel:
+    """
+    Date-aligned (dates x stocks) matrices of some fields of the price store, one matrix per field, NaN on the
+    dates a stock has no bar. Only the fields that are asked for are loaded, optionally as float32 to halve the
+    memory. The panel can be sliced by dates or by blocks of stocks without copying, and shared with worker
+    processes through shared memory (see share and attach).
+
+    The functions that take the data of one stock (compute_signals, calculate_score, ...) get it with
+    stock_data, which returns the bars of the stock with the column names of the price store.
+    """
+
+    def __init__(self, dates, stocks, fields, present, blocks=None):
+        """
+        Parameters:
+        dates (numpy.ndarray): The sorted datetime64[ns] dates of the rows
+        stocks (list): The stock symbols of the columns
+        fields (dict): The (dates x stocks) matrix of each field
+        present (numpy.ndarray): A boolean (dates x stocks) matrix, True where the stock has a bar
+        blocks (list): The shared memory blocks backing the matrices, kept open with the panel
+        """
+        self.dates = dates
+        self.stocks = list(stocks)
+        self.fields = fields
+        self.present = present
+        self._blocks = blocks or []
+        self._columns = {stock: j for j, stock in enumerate(self.stocks)}
+
+    @classmethod
+    def _assemble(cls, stocks, fields, dtype, stock_dates, read_stock):
+        """
+        Build a panel from the dates of each stock and a function reading the values of one stock.
+        The stocks are read one at a time, so only the matrices are held in memory.
+        """
+        dates = np.unique(np.concatenate(stock_dates)) if stock_dates else np.empty(0, dtype='datetime64[ns]')
+        matrices = {field: np.full((len(dates), len(stocks)), np.nan, dtype=dtype) for field in fields}
+        present = np.zeros((len(dates), len(stocks)), dtype=bool)
+        for j, stock in enumerate(stocks):
+            rows = np.searchsorted(dates, stock_dates[j])
+            present[rows, j] = True
+            for field, values in read_stock(j, stock).items():
+                matrices[field][rows, j] = values
+        return cls(dates, stocks, matrices, present)
+
+    @classmethod
+    def load(cls, stocks=None, fields=SIGNAL_FIELDS, start=None, end=None, dtype='float64'):
+        """
+        Load a panel from the price store.
+
+        Parameters:
+        stocks (list): The stock symbols. Default is every stock of the store.
+        fields (list): The fields to load. Default is the fields used by compute_signals.
+        start (datetime): The first date to load. Default is the first stored date.
+        end (datetime): The last date to load. Default is the last stored date.
+        dtype (str): The dtype of the matrices, 'float64' or 'float32'. Default is 'float64'.
+
+        Returns:
+        PricePanel: The panel
+        """
+        stocks = list(stocks) if stocks is not None else list_stocks()
+        # First pass over the dates only, for the rows of each stock in the date range
+        ranges, stock_dates = [], []
+        for stock in stocks:
+            dates = load_prices(stock, columns=[])['date'].to_numpy(dtype='datetime64[ns]')
+            first, last = _date_range(dates, start, end)
+            ranges.append((first, last))
+            # Copied, each memory map keeps a file descriptor open while it is referenced
+            stock_dates.append(np.array(dates[first:last]))
+
+        def read_stock(j, stock):
+            first, last = ranges[j]
+            data = load_prices(stock, columns=[field_column(stock, field) for field in fields])
+            return {field: data[field_column(stock, field)].to_numpy()[first:last] for field in fields}
+
+        return cls._assemble(stocks, list(fields), dtype, stock_dates, read_stock)
+
+    @classmethod
+    def iter_load(cls, stocks=None, chunk_size=500, **kwargs):
+        """
+        Load the panel of a large universe block by block, so only `chunk_size` stocks are held in memory.
+        Each block is aligned on the dates of its own stocks.
+
+        Parameters:
+        stocks (list): The stock symbols. Default is every stock of the store.
+        chunk_size (int): The number of stocks of each block
+        kwargs: The other parameters of load
+
+        Yields:
+        PricePanel: The panel of each block of stocks
+        """
+        stocks = list(stocks) if stocks is not None else list_stocks()
+        for i in range(0, len(stocks), chunk_size):
+            yield cls.load(stocks[i:i + chunk_size], **kwargs)
+
+    @classmethod
+    def from_frames(cls, data_by_stock, fields=SIGNAL_FIELDS, start=None, end=None, dtype='float64'):
+        """
+        Build a panel from the data of each stock (with the column names of the price store), e.g. synthetic data.
+        """
+        stocks = list(data_by_stock)
+        ranges, stock_dates = [], []
+        for stock in stocks:
+            dates = data_by_stock[stock]['date'].to_numpy(dtype='datetime64[ns]')
+            first, last = _date_range(dates, start, end)
+            ranges.append((first, last))
+            stock_dates.append(dates[first:last])
+
+        def read_stock(j, stock):
+            first, last = ranges[j]
+            data = data_by_stock[stock]
+            return {field: data[field_column(stock, field)].to_numpy()[first:last] for field in fields}
+
+        return cls._assemble(stocks, list(fields), dtype, stock_dates, read_stock)
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    @property
+    def nbytes(self):
+        """
+        The memory of the matrices, in bytes.
+        """
+        return sum(matrix.nbytes for matrix in self.fields.values()) + self.present.nbytes + self.dates.nbytes
+
+    def frame(self, field):
+        """
+        The matrix of a field as a DataFrame indexed by date, one column per stock, without copying it.
+        """
+        return pd.DataFrame(self.fields[field], index=pd.DatetimeIndex(self.dates, name='date'), columns=self.stocks, copy=False)
+
+    def stock_data(self, stock):
+        """
+        The bars of one stock as a DataFrame with a 'date' column and the columns of the price store,
+        e.g. 'close' and '{stock}_rsi', ready for compute_signals and the other functions of a single stock.
+        """
+        j = self._columns[stock]
+        rows = self.present[:, j]
+        data = {'date': self.dates[rows]}
+        for field, matrix in self.fields.items():
+            data[field_column(stock, field)] = matrix[rows, j]
+        return pd.DataFrame(data)
+
+    def data_by_stock(self):
+        """
+        The stock_data of every stock, for the functions that take a data_by_stock dictionary.
+        """
+        return {stock: self.stock_data(stock) for stock in self.stocks}
+
+    def _select(self, rows, columns):
+        return PricePanel(self.dates[rows], self.stocks[columns], {field: matrix[rows, columns] for field, matrix in self.fields.items()},
+                          self.present[rows, columns], self._blocks)
+
+    def slice_dates(self, start=None, end=None):
+        """
+        The panel between two dates (both included), as views of the matrices of this panel.
+        """
+        first, last = _date_range(self.dates, start, end)
+        return self._select(slice(first, last), slice(None))
+
+    def chunks(self, chunk_size):
+        """
+        Iterate over blocks of `chunk_size` stocks, as views of the matrices of this panel.
+        """
+        for i in range(0, len(self.stocks), chunk_size):
+            yield self._select(slice(None), slice(i, i + chunk_size))
+
+    def share(self):
+        """
+        Copy the matrices to shared memory, so worker processes can attach the panel without copying it.
+        The blocks live until the returned SharedPricePanel is closed.
+
+        Returns:
+        SharedPricePanel: The shared copy, its `handle` is passed to the workers (see attach)
+        """
+        return SharedPricePanel(self)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attach a panel shared by another process (see share). A process attaches each panel once.
+
+        Parameters:
+        handle (dict): The handle of the SharedPricePanel
+
+        Returns:
+        PricePanel: The panel, backed by the shared memory blocks
+        """
+        panel = _attached.get(handle['id'])
+        if panel is None:
+            blocks, arrays = [], {}
+            for name, (block_name, dtype) in handle['blocks'].items():
+                block = shared_memory.SharedMemory(name=block_name)
+                blocks.append(block)
+                arrays[name] = np.ndarray((len(handle['dates']), len(handle['stocks'])), dtype=dtype, buffer=block.buf)
+            present = arrays.pop('__present__')
+            panel = _attached[handle['id']] = cls(handle['dates'], handle['stocks'], arrays, present, blocks)
+        return panel
+
+class SharedPricePanel:
+    """
+    A copy of a PricePanel in shared memory blocks, one per matrix. Use it as a context manager, or call close,
+    to free the blocks once the workers are done.
+    """
+
+    def __init__(self, panel):
+        self.blocks = []
+        self.handle = {'id': uuid.uuid4().hex, 'dates': panel.dates, 'stocks': panel.stocks, 'blocks': {}}
+        arrays = dict(panel.fields, __present__=panel.present)
+        fields = {}
+        for name, matrix in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+            self.blocks.append(block)
+            shared = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf)
+            shared[...] = matrix
+            fields[name] = shared
+            self.handle['blocks'][name] = (block.name, matrix.dtype.str)
+        present = fields.pop('__present__')
+        self.panel = PricePanel(panel.dates, panel.stocks, fields, present, self.blocks)
+
+    def close(self):
+        _attached.pop(self.handle['id'], None)
+        # The arrays of the panel point into the blocks, they must be released before the blocks are closed
+        self.panel = None
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Views of the matrices are still referenced, the memory is freed once they are gone
+                pass
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
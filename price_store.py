@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import glob
+import shutil
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# Root directory of the store. Every stock gets its own folder:
+#   preprocessed_data/{stock}/meta.json       -> columns, dtypes, row count, current version, last stored date,
+#                                                time of the last change and any state carried between refreshes
+#   preprocessed_data/{stock}/v{n}/{col}.bin  -> one raw little-endian array per column
+STORE_DIR = 'preprocessed_data'
+DATE_COLUMN = 'date'
+
+# Stock symbols as Yahoo Finance writes them, e.g. BRK-B, ^GSPC, EURUSD=X or 7203.T
+SYMBOL_PATTERN = re.compile(r'[A-Za-z0-9.^=-]+')
+
+def is_valid_symbol(stock):
+    """
+    Check whether a stock symbol can name a folder of the store, i.e. it can't point outside of STORE_DIR.
+    """
+    return isinstance(stock, str) and SYMBOL_PATTERN.fullmatch(stock) is not None and stock not in ('.', '..')
+
+def _stock_dir(stock):
+    if not is_valid_symbol(stock):
+        raise ValueError(f"Invalid stock symbol: {stock!r}")
+    return os.path.join(STORE_DIR, stock)
+
+def _meta_path(stock):
+    return os.path.join(_stock_dir(stock), 'meta.json')
+
+def _column_path(stock, version, column):
+    return os.path.join(_stock_dir(stock), f'v{version}', f'{column}.bin')
+
+def _write_meta(stock, meta):
+    """
+    Replace the metadata file atomically so readers never see a half written file.
+    """
+    tmp_path = _meta_path(stock) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, _meta_path(stock))
+
+def _to_storage_array(series):
+    """
+    Convert a column to the array that is written to disk.
+    Dates are kept as int64 nanoseconds, everything else as a numeric array.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype='datetime64[ns]').view('<i8'), 'datetime64[ns]'
+    values = pd.to_numeric(series, errors='coerce').to_numpy()
+    if values.dtype.kind not in 'iuf':
+        values = values.astype('<f8')
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    return values, values.dtype.str
+
+def _last_date(data):
+    if data.empty:
+        return None
+    return pd.Timestamp(data[DATE_COLUMN].max()).isoformat()
+
+def has_prices(stock):
+    """
+    Check whether the store holds data for a stock.
+    """
+    return is_valid_symbol(stock) and os.path.exists(_meta_path(stock))
+
+def list_stocks():
+    """
+    Return the symbols of every stock in the store, sorted.
+    """
+    if not os.path.isdir(STORE_DIR):
+        return []
+    return sorted(stock for stock in os.listdir(STORE_DIR) if has_prices(stock))
+
+def load_meta(stock):
+    """
+    Load the metadata of a stored stock.
+
+    Parameters:
+    stock (str): The stock symbol
+
+    Returns:
+    dict: The column dtypes, the number of rows, the version, the last stored date
+          and the carried state of the stored data
+    """
+    with open(_meta_path(stock), 'r') as f:
+        return json.load(f)
+
+def data_version(stock):
+    """
+    A string that changes whenever the stored data of a stock changes, to key caches on.
+    """
+    meta = load_meta(stock)
+    return f"{meta['version']}-{meta['rows']}"
+
+def last_modified(stock):
+    """
+    When the stored data of a stock last changed, as a UTC datetime, e.g. for HTTP Last-Modified headers.
+    Data stored by previous versions of the app falls back to the modification time of its metadata file.
+    """
+    timestamp = load_meta(stock).get('updated_at') or os.path.getmtime(_meta_path(stock))
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+def update_meta(stock, **fields):
+    """
+    Update some fields of the metadata of a stored stock.
+    """
+    meta = load_meta(stock)
+    meta.update(fields)
+    _write_meta(stock, meta)
+
+def save_prices(data, stock, state=None):
+    """
+    Save the preprocessed data of a stock, replacing any previous version.
+    The columns are written to a new version folder and the metadata is switched
+    to it at the end, so concurrent readers keep using the old files until then.
+    The previous version is kept for the readers that read the old metadata but haven't mapped its files yet,
+    only the versions before it are removed.
+
+    Parameters:
+    data (DataFrame): The preprocessed stock data, including a 'date' column
+    stock (str): The stock symbol
+    state (dict): Any JSON serializable state to keep next to the data, e.g. rolling indicator state
+    """
+    previous = load_meta(stock) if has_prices(stock) else None
+    version = previous['version'] + 1 if previous else 1
+    os.makedirs(os.path.dirname(_column_path(stock, version, DATE_COLUMN)), exist_ok=True)
+
+    columns = {}
+    for column in data.columns:
+        values, dtype = _to_storage_array(data[column])
+        values.tofile(_column_path(stock, version, column))
+        columns[column] = dtype
+
+    _write_meta(stock, {'columns': columns, 'rows': len(data), 'version': version,
+                        'last_date': _last_date(data), 'updated_at': time.time(), 'state': state or {}})
+
+    # Older versions are removed on a best effort basis, they may still be mapped by a reader
+    if previous:
+        for path in glob.glob(os.path.join(_stock_dir(stock), 'v*')):
+            old_version = os.path.basename(path)[1:]
+            if old_version.isdigit() and int(old_version) < previous['version']:
+                shutil.rmtree(path, ignore_errors=True)
+
+def append_prices(data, stock, state=None):
+    """
+    Append new rows to the data of a stored stock.
+    The rows are written at the end of the current column files and only become
+    visible to readers once the metadata is updated.
+
+    Parameters:
+    data (DataFrame): The new rows, with the same columns as the stored data
+    stock (str): The stock symbol
+    state (dict): The state to keep next to the data. Default keeps the stored state.
+    """
+    meta = load_meta(stock)
+    if set(data.columns) != set(meta['columns']):
+        raise ValueError(f"The new rows for {stock} do not have the stored columns.")
+
+    for column, dtype in meta['columns'].items():
+        values, _ = _to_storage_array(data[column])
+        if not dtype.startswith('datetime64'):
+            values = values.astype(dtype, copy=False)
+        path = _column_path(stock, meta['version'], column)
+        with open(path, 'r+b') as f:
+            # Drop any leftover from an interrupted append before writing
+            f.truncate(meta['rows'] * values.itemsize)
+            f.seek(0, os.SEEK_END)
+            values.tofile(f)
+
+    meta['rows'] += len(data)
+    meta['last_date'] = _last_date(data) or meta.get('last_date')
+    meta['updated_at'] = time.time()
+    if state is not None:
+        meta['state'] = state
+    _write_meta(stock, meta)
+
+def load_prices(stock, columns=None):
+    """
+    Load the preprocessed data of a stock.
+    The columns are memory-mapped read-only and wrapped in a DataFrame without copying them.
+
+    Parameters:
+    stock (str): The stock symbol
+    columns (list): The columns to load. Default is all of them. The 'date' column is always loaded.
+
+    Returns:
+    DataFrame: The stock data
+    """
+    meta = load_meta(stock)
+    if columns is None:
+        columns = list(meta['columns'])
+    elif DATE_COLUMN not in columns:
+        columns = [DATE_COLUMN] + list(columns)
+
+    arrays = {}
+    for column in columns:
+        if column not in meta['columns']:
+            raise KeyError(f"Column '{column}' is not stored for {stock}.")
+        dtype = meta['columns'][column]
+        storage_dtype = '<i8' if dtype.startswith('datetime64') else dtype
+        if meta['rows'] == 0:
+            values = np.empty(0, dtype=storage_dtype)
+        else:
+            values = np.memmap(_column_path(stock, meta['version'], column), dtype=storage_dtype,
+                               mode='r', shape=(meta['rows'],))
+        arrays[column] = values.view(dtype) if dtype.startswith('datetime64') else values
+
+    return pd.DataFrame(arrays, copy=False)
+
+def migrate_csv_directory(csv_dir=STORE_DIR, remove=False):
+    """
+    One-shot migration of the '{stock}_data.csv' files written by previous versions of the app.
+
+    Parameters:
+    csv_dir (str): The directory holding the CSV files. Default is the store directory.
+    remove (bool): Whether to delete each CSV file once it has been migrated. Default is False.
+
+    Returns:
+    list: The migrated stock symbols
+    """
+    migrated = []
+    for csv_path in sorted(glob.glob(os.path.join(csv_dir, '*_data.csv'))):
+        stock = os.path.basename(csv_path)[:-len('_data.csv')]
+        data = pd.read_csv(csv_path, parse_dates=[DATE_COLUMN])
+        save_prices(data, stock)
+        if remove:
+            os.remove(csv_path)
+        migrated.append(stock)
+    return migrated
+
+if __name__ == '__main__':
+    # Migrate the CSV files in place
+    for stock in migrate_csv_directory():
+        print(f'Migrated {stock}')
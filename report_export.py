@@ -0,0 +1,160 @@
+import os
+import csv
+import glob
+from result_store import RESULT_COLUMNS
+
+# Directory of the exported reports, one file per analysis run: {run_id}.csv or {run_id}.parquet
+EXPORT_DIR = 'technical_analysis/reports'
+FORMATS = ('csv', 'parquet')
+MAX_EXPORT_BYTES = 200 * 2 ** 20  # The oldest reports are deleted beyond this total size
+PARQUET_BATCH_ROWS = 1000  # Rows per Parquet row group
+
+def parquet_available():
+    """
+    Check whether pyarrow, needed for the Parquet format, is installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def export_path(run_id, export_format):
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown report format '{export_format}', expected one of {FORMATS}.")
+    # Run ids are generated by the job queue, anything else could point outside of the directory
+    if not run_id.isalnum():
+        raise ValueError(f"Invalid run id '{run_id}'.")
+    return os.path.join(EXPORT_DIR, f'{run_id}.{export_format}')
+
+def find_export(run_id):
+    """
+    Return the path of the exported report of a run, or None if there is none (yet).
+    """
+    for export_format in FORMATS:
+        path = export_path(run_id, export_format)
+        if os.path.exists(path):
+            return path
+    return None
+
+def apply_retention(max_bytes=MAX_EXPORT_BYTES, keep=None):
+    """
+    Delete the oldest exported reports until their total size is at most `max_bytes`.
+
+    Parameters:
+    max_bytes (int): The maximum total size of the reports
+    keep (str): The path of a report that is never deleted, e.g. the one just written
+
+    Returns:
+    list: The deleted paths
+    """
+    paths = [path for export_format in FORMATS for path in glob.glob(os.path.join(EXPORT_DIR, f'*.{export_format}'))]
+    files = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    deleted = []
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted.append(path)
+    return deleted
+
+class ReportWriter:
+    """
+    Streams the rows of an analysis run to its report file as the stocks are done.
+    The rows are written to a temporary file, which replaces the final file atomically on close,
+    so a download never gets a partial report and concurrent runs never share a file.
+    The Parquet format falls back to CSV when pyarrow is not installed.
+    """
+
+    def __init__(self, run_id, export_format='csv', max_bytes=MAX_EXPORT_BYTES):
+        if export_format == 'parquet' and not parquet_available():
+            export_format = 'csv'
+        self.path = export_path(run_id, export_format)
+        self.tmp_path = f'{self.path}.tmp'
+        self.export_format = export_format
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.closed = False
+        self._batch = []
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+
+        if export_format == 'csv':
+            self._file = open(self.tmp_path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(RESULT_COLUMNS)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._schema = pa.schema([(column, pa.string() if column in ('stock', 'recommendation') else pa.float64())
+                                      for column in RESULT_COLUMNS])
+            self._writer = pq.ParquetWriter(self.tmp_path, self._schema)
+
+    def write(self, result):
+        """
+        Write the result of one stock. Failed stocks have no row.
+        """
+        if 'error' in result:
+            return
+        row = [result.get(column) for column in RESULT_COLUMNS]
+        self.rows += 1
+        if self.export_format == 'csv':
+            self._writer.writerow(row)
+            self._file.flush()
+        else:
+            self._batch.append(row)
+            if len(self._batch) >= PARQUET_BATCH_ROWS:
+                self._write_batch()
+
+    def _write_batch(self):
+        import pyarrow as pa
+        columns = list(zip(*self._batch))
+        arrays = [pa.array([None if value is None else (value if field.type == pa.string() else float(value)) for value in values],
+                           type=field.type) for field, values in zip(self._schema, columns)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._batch = []
+
+    def close(self):
+        """
+        Finish the report: move it to its final path and apply the retention policy.
+
+        Returns:
+        str: The path of the report
+        """
+        if self.export_format == 'csv':
+            self._file.close()
+        else:
+            if self._batch:
+                self._write_batch()
+            self._writer.close()
+        os.replace(self.tmp_path, self.path)
+        self.closed = True
+        apply_retention(self.max_bytes, keep=self.path)
+        return self.path
+
+    def abort(self):
+        """
+        Drop a report that could not be finished.
+        """
+        try:
+            if self.export_format == 'csv':
+                self._file.close()
+            else:
+                self._writer.close()
+        finally:
+            self.closed = True
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
@@ -0,0 +1,163 @@
+import json
+import time
+import sqlite3
+from contextlib import closing
+from bullish_signals_indicators import SIGNALS
+
+# SQLite database shared by every worker of the app, keyed by run id
+DB_PATH = 'technical_analysis/results.db'
+RUN_TTL = 7 * 24 * 3600  # Runs older than this (in seconds) are deleted
+
+# Columns of a report row, the only ones the rows can be sorted by (plus their position)
+RESULT_COLUMNS = ['stock'] + SIGNALS + ['overall_score', 'recommendation', 'elapsed']
+SORT_COLUMNS = ['position'] + RESULT_COLUMNS
+
+def _connect():
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY, params TEXT, total INTEGER, done INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'queued', created_at REAL, started_at REAL, finished_at REAL)''')
+    connection.execute(f'''CREATE TABLE IF NOT EXISTS rows (
+        run_id TEXT, position INTEGER, stock TEXT, {', '.join(f'{signal} REAL' for signal in SIGNALS)},
+        overall_score REAL, recommendation TEXT, elapsed REAL, PRIMARY KEY (run_id, position))''')
+    connection.execute('CREATE TABLE IF NOT EXISTS errors (run_id TEXT, error TEXT)')
+    connection.execute('''CREATE TABLE IF NOT EXISTS timings (
+        run_id TEXT, stage TEXT, seconds REAL, count INTEGER, PRIMARY KEY (run_id, stage))''')
+    return connection
+
+def create_run(run_id, params, total):
+    """
+    Register a new analysis run and delete the expired ones.
+
+    Parameters:
+    run_id (str): The id of the run
+    params (dict): The user inputs of the run (JSON serializable)
+    total (int): The number of stocks to analyze
+    """
+    now = time.time()
+    with closing(_connect()) as connection, connection:
+        expired = [row['run_id'] for row in connection.execute('SELECT run_id FROM runs WHERE created_at < ?', (now - RUN_TTL,))]
+        for table in ('rows', 'errors', 'timings', 'runs'):
+            connection.executemany(f'DELETE FROM {table} WHERE run_id = ?', [(expired_id,) for expired_id in expired])
+        connection.execute('INSERT INTO runs (run_id, params, total, created_at) VALUES (?, ?, ?, ?)',
+                           (run_id, json.dumps(params), total, now))
+
+def set_status(run_id, status):
+    """
+    Update the status of a run ('queued', 'running' or 'finished') and the matching timestamp.
+    """
+    column = {'running': 'started_at', 'finished': 'finished_at'}.get(status)
+    with closing(_connect()) as connection, connection:
+        if column:
+            connection.execute(f'UPDATE runs SET status = ?, {column} = ? WHERE run_id = ?', (status, time.time(), run_id))
+        else:
+            connection.execute('UPDATE runs SET status = ? WHERE run_id = ?', (status, run_id))
+
+def add_error(run_id, error):
+    """
+    Record an error of a run that is not tied to a stock.
+    """
+    with closing(_connect()) as connection, connection:
+        connection.execute('INSERT INTO errors (run_id, error) VALUES (?, ?)', (run_id, error))
+
+def add_result(run_id, position, result):
+    """
+    Store the result of one stock of a run. Failed stocks only add their error to the run.
+    The time of each stage of the analysis is added to the timing breakdown of the run.
+
+    Parameters:
+    run_id (str): The id of the run
+    position (int): The position of the stock in the input list
+    result (dict): The result of run_analysis
+    """
+    with closing(_connect()) as connection, connection:
+        if 'error' in result:
+            connection.execute('INSERT INTO errors (run_id, error) VALUES (?, ?)', (run_id, result['error']))
+        else:
+            connection.execute(f'INSERT OR REPLACE INTO rows (run_id, position, {", ".join(RESULT_COLUMNS)}) '
+                               f'VALUES (?, ?, {", ".join("?" * len(RESULT_COLUMNS))})',
+                               [run_id, position] + [result.get(column) for column in RESULT_COLUMNS])
+        connection.executemany('INSERT INTO timings (run_id, stage, seconds, count) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT (run_id, stage) DO UPDATE SET seconds = seconds + excluded.seconds, count = count + excluded.count',
+                               [(run_id, stage, seconds, count) for stage, (seconds, count) in result.get('timings', {}).items()])
+        connection.execute('UPDATE runs SET done = done + 1 WHERE run_id = ?', (run_id,))
+
+def get_run(run_id):
+    """
+    Load a run: its user inputs and its progress.
+
+    Parameters:
+    run_id (str): The id of the run
+
+    Returns:
+    dict: The params, status, total, done, errors and estimated time left (eta, in seconds) of the run,
+          or None if the run is unknown
+    """
+    if not run_id:
+        return None
+    with closing(_connect()) as connection:
+        row = connection.execute('SELECT * FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        errors = [error for error, in connection.execute('SELECT error FROM errors WHERE run_id = ? ORDER BY rowid', (run_id,))]
+    if row is None:
+        return None
+
+    eta = None
+    if row['status'] == 'finished':
+        eta = 0.0
+    elif row['started_at'] and row['done']:
+        eta = (time.time() - row['started_at']) / row['done'] * (row['total'] - row['done'])
+    return {
+        'id': row['run_id'],
+        'params': json.loads(row['params']),
+        'status': row['status'],
+        'total': row['total'],
+        'done': row['done'],
+        'errors': errors,
+        'eta': eta,
+    }
+
+def get_rows(run_id, sort='position', descending=False, page=1, per_page=None):
+    """
+    Load the report rows of a run, sorted and paginated.
+
+    Parameters:
+    run_id (str): The id of the run
+    sort (str): The column to sort by, one of SORT_COLUMNS. Default is the input order.
+    descending (bool): Whether to sort in descending order. Default is False.
+    page (int): The page to return, starting at 1. Default is 1.
+    per_page (int): The number of rows per page. Default returns every row.
+
+    Returns:
+    list: The rows of the page, as dictionaries
+    int: The total number of rows of the run
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort by '{sort}'.")
+    query = (f'SELECT {", ".join(RESULT_COLUMNS)} FROM rows WHERE run_id = ? '
+             f'ORDER BY {sort} {"DESC" if descending else "ASC"}, position ASC')
+    params = [run_id]
+    if per_page:
+        query += ' LIMIT ? OFFSET ?'
+        params += [per_page, (max(page, 1) - 1) * per_page]
+
+    with closing(_connect()) as connection:
+        rows = [dict(row) for row in connection.execute(query, params)]
+        total = connection.execute('SELECT COUNT(*) FROM rows WHERE run_id = ?', (run_id,)).fetchone()[0]
+    return rows, total
+
+def get_timings(run_id):
+    """
+    Load the timing breakdown of a run: the total time and the number of runs of each stage
+    of the analysis, summed over its stocks.
+
+    Parameters:
+    run_id (str): The id of the run
+
+    Returns:
+    list: One dictionary per stage (stage, seconds, count), the slowest first
+    """
+    with closing(_connect()) as connection:
+        return [dict(row) for row in connection.execute(
+            'SELECT stage, seconds, count FROM timings WHERE run_id = ? ORDER BY seconds DESC', (run_id,))]
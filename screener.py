@@ -0,0 +1,193 @@
+import threading
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from bullish_signals_indicators import SIGNALS, PATTERN_SIGNALS, last_pattern_indices
+from price_store import list_stocks, load_meta, load_prices
+
+# Bars loaded before the lookback so the rolling windows and the EMA are settled when it starts
+WARMUP_BARS = 250
+
+def _last_hits(mask, valid_from):
+    """
+    Row of the last True value of each column of a 2-D mask, ignoring the rows before `valid_from`
+    of the column, -1 when there is none.
+    """
+    mask = mask & (np.arange(len(mask))[:, None] >= valid_from[None, :])
+    last = len(mask) - 1 - np.argmax(mask[::-1], axis=0)
+    return np.where(mask.any(axis=0), last, -1)
+
+class Screener:
+    """
+    Scores a whole universe of stocks at once.
+    The close, high, volume, moving average and RSI histories of every stock are loaded as aligned
+    (bars x stocks) matrices, the last `lookback` bars of each stock ending on its last bar. The signals
+    are then computed as 2-D array operations across the stocks, except for the chart patterns that are
+    detected stock by stock over their whole history. Only the last bar of each signal is kept, so rescoring
+    the universe with other day ranges, weights or thresholds doesn't touch the price histories again.
+
+    The scores match calculate_score as long as the day range fits in the lookback: older signals of the
+    other indicators are not seen.
+    """
+
+    def __init__(self, stocks=None, lookback=1000, panel=None):
+        """
+        Parameters:
+        stocks (list): The stock symbols of the universe. Default is every stock of the price store,
+                       or of the panel.
+        lookback (int): The number of bars of each stock to screen. None loads the whole histories.
+        panel (PricePanel): A price panel with the fields used by compute_signals to read the stocks from,
+                            e.g. one already loaded or restricted to a date range. Default reads the price store.
+        """
+        if stocks is None:
+            stocks = panel.stocks if panel is not None else list_stocks()
+        self.stocks = list(stocks)
+        self.lookback = lookback
+        self.panel = panel
+        self._threshold_hits = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        bars = None if self.lookback is None else self.lookback + WARMUP_BARS
+        count = len(self.stocks)
+        if self.panel is not None:
+            rows = np.array([self.panel.present[:, self.panel.stocks.index(stock)].sum() for stock in self.stocks], dtype=int)
+        else:
+            rows = np.array([load_meta(stock)['rows'] for stock in self.stocks], dtype=int)
+        loaded = rows if bars is None else np.minimum(rows, bars)
+        length = int(loaded.max()) if count else 0
+
+        # Right-aligned matrices: the last row holds the last bar of every stock, shorter histories
+        # are padded with NaN (NaT for the dates) at the top
+        def matrix(dtype, fill):
+            return np.full((length, count), fill, dtype=dtype)
+
+        self.dates = matrix('datetime64[ns]', np.datetime64('NaT'))
+        close, high, volume, ma_50, ma_200, rsi = (matrix(float, np.nan) for _ in range(6))
+        # First row where the signals of each stock count: after the padding, and after the warmup when truncated
+        self.valid_from = length - loaded + np.where(loaded < rows, WARMUP_BARS, 0)
+        # Last date of each chart pattern, for every stock
+        self._pattern_dates = np.full((count, len(PATTERN_SIGNALS)), np.datetime64('NaT'), dtype='datetime64[ns]')
+
+        # The stocks are copied one at a time, each memory map keeps a file descriptor open until it is released
+        for j, stock in enumerate(self.stocks):
+            columns = ['close', 'high', 'volume', f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi']
+            data = self.panel.stock_data(stock) if self.panel is not None else load_prices(stock, columns=columns)
+            dates = data['date'].to_numpy(dtype='datetime64[ns]')
+            for k, index in enumerate(last_pattern_indices(data['close'].to_numpy(dtype=float)).values()):
+                if index >= 0:
+                    self._pattern_dates[j, k] = dates[index]
+
+            tail = data.iloc[len(data) - loaded[j]:]
+            start = length - loaded[j]
+            self.dates[start:, j] = dates[len(data) - loaded[j]:]
+            close[start:, j] = tail['close'].to_numpy(dtype=float)
+            high[start:, j] = tail['high'].to_numpy(dtype=float)
+            volume[start:, j] = tail['volume'].to_numpy(dtype=float)
+            ma_50[start:, j] = tail[f'{stock}_50_day_ma'].to_numpy(dtype=float)
+            ma_200[start:, j] = tail[f'{stock}_200_day_ma'].to_numpy(dtype=float)
+            rsi[start:, j] = tail[f'{stock}_rsi'].to_numpy(dtype=float)
+            del data, tail
+
+        # Per-stock signals that don't depend on the screening parameters, as last hit rows
+        previous_close = _previous_rows(close)
+        close_frame = pd.DataFrame(close)
+        hits = {}
+        hits['moving_average_crossover'] = _last_hits((ma_50 > ma_200) & (_previous_rows(ma_50) < _previous_rows(ma_200)), self.valid_from)
+        high_max = pd.DataFrame(high).rolling(window=50, min_periods=1).max().to_numpy()
+        hits['breakouts'] = _last_hits(close > _previous_rows(high_max), self.valid_from)
+        lower_band = (close_frame.rolling(20).mean() - close_frame.rolling(20).std() * 2).to_numpy()
+        hits['bollinger_bands'] = _last_hits((close > lower_band) & (previous_close < _previous_rows(lower_band)), self.valid_from)
+        ema = close_frame.ewm(span=20).mean().to_numpy()
+        hits['exponential_moving_average'] = _last_hits((close > ema) & (previous_close < _previous_rows(ema)), self.valid_from)
+        self._hits = hits
+
+        # Inputs of the threshold signals: the volume relative to its 50 bar average on up bars, and the RSI
+        average_volume = pd.DataFrame(volume).rolling(window=50, min_periods=1).mean().to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._volume_ratio = np.where(close > previous_close, volume / average_volume, np.nan)
+        self._rsi = rsi
+
+    def _threshold_last_hits(self, threshold, rsi_threshold):
+        """
+        Last hit rows of the threshold signals, cached by thresholds.
+        """
+        key = (float(threshold), float(rsi_threshold))
+        with self._lock:
+            cached = self._threshold_hits.get(key)
+        if cached is None:
+            with np.errstate(invalid='ignore'):
+                cached = {
+                    'volume_spikes': _last_hits(self._volume_ratio > threshold, self.valid_from),
+                    'rsi_oversold': _last_hits(self._rsi < rsi_threshold, self.valid_from),
+                }
+            with self._lock:
+                self._threshold_hits[key] = cached
+        return cached
+
+    def last_signal_dates(self, threshold=0.05, rsi_threshold=30):
+        """
+        Date of the last bar where each signal was detected, for every stock.
+
+        Parameters:
+        threshold (float): The threshold for the volume spikes indicator
+        rsi_threshold (float): The threshold for the RSI oversold indicator
+
+        Returns:
+        numpy.ndarray: A (stocks x SIGNALS) datetime64[ns] array, NaT where a signal never appeared
+        """
+        hits = dict(self._hits, **self._threshold_last_hits(threshold, rsi_threshold))
+        columns = np.arange(len(self.stocks))
+        dates = np.full((len(self.stocks), len(SIGNALS)), np.datetime64('NaT'), dtype='datetime64[ns]')
+        for k, signal in enumerate(SIGNALS):
+            if signal in PATTERN_SIGNALS:
+                dates[:, k] = self._pattern_dates[:, PATTERN_SIGNALS.index(signal)]
+                continue
+            found = hits[signal] >= 0
+            dates[found, k] = self.dates[hits[signal][found], columns[found]]
+        return dates
+
+    def screen(self, days=10, threshold=0.05, rsi_threshold=30, weights=None, top_k=50, as_of=None):
+        """
+        Score the universe and return its best stocks.
+
+        Parameters:
+        days (int): The number of days over which to calculate the score
+        threshold (float): The threshold for the volume spikes indicator
+        rsi_threshold (float): The threshold for the RSI oversold indicator
+        weights (dict): The weights for each indicator. Default is 1 for every indicator. Raises ValueError
+                        when they sum to 0.
+        top_k (int): The number of stocks to return. None returns every stock.
+        as_of (datetime): The date the day range ends at. Default is datetime.today().
+
+        Returns:
+        DataFrame: The stock, the score of each indicator, the overall score and the recommendation
+                   of the top_k stocks, best first
+        """
+        as_of = pd.Timestamp(as_of if as_of is not None else datetime.today()).to_datetime64().astype('datetime64[ns]')
+        cutoff = as_of - np.timedelta64(int(days), 'D')
+        weights = np.array([1.0 if weights is None else float(weights[signal]) for signal in SIGNALS])
+        # The scores are normalized by the sum of the weights
+        if weights.sum() == 0:
+            raise ValueError("The weights of the indicators sum to 0.")
+
+        # An indicator scores its weight when its last signal is within the day range, as in calculate_score
+        last_dates = self.last_signal_dates(threshold, rsi_threshold)
+        individual_scores = np.where(~np.isnat(last_dates) & (last_dates >= cutoff), weights[None, :], 0.0)
+        overall_scores = individual_scores.sum(axis=1) / weights.sum()
+
+        order = np.argsort(-overall_scores, kind='stable')
+        if top_k is not None:
+            order = order[:top_k]
+        report = pd.DataFrame(individual_scores[order], columns=SIGNALS)
+        report.insert(0, 'stock', np.array(self.stocks, dtype=object)[order])
+        report['overall_score'] = overall_scores[order]
+        report['recommendation'] = np.where(report['overall_score'] > 0.5, 'Trade', "Don't Trade")
+        return report
+
+def _previous_rows(values):
+    """
+    Shift a (bars x stocks) matrix down by one bar, the first bar has no previous value (NaN).
+    """
+    return np.vstack([np.full((1, values.shape[1]), np.nan), values[:-1]])
@@ -1,6 +1,7 @@
 window.onload = function() {
     var table = document.querySelector('.table');
-    if (table) {
+    // Wait for the analysis to finish before suggesting stocks
+    if (table && table.dataset.complete !== 'false') {
         var rows = table.querySelectorAll('tr.table-info');
         var stocks = [];
 
@@ -123,4 +124,25 @@ function calculateTotalWeight() {
     } else {
         document.getElementById('total-weight').innerText = totalWeight + '%';
     }
-}
\ No newline at end of file
+}
+
+// Poll the progress of a running analysis and reload the report when new results arrive
+(function pollAnalysisProgress() {
+    var progress = document.getElementById('job-progress');
+    if (!progress) {
+        return;
+    }
+    fetch(progress.dataset.jobUrl)
+        .then(function (response) { return response.json(); })
+        .then(function (job) {
+            if (job.status === 'finished' || job.done !== parseInt(progress.dataset.done, 10)) {
+                window.location.reload();
+                return;
+            }
+            if (job.eta !== null) {
+                document.getElementById('job-eta').innerText = ', about ' + Math.ceil(job.eta) + ' seconds left';
+            }
+            setTimeout(pollAnalysisProgress, 2000);
+        })
+        .catch(function () { setTimeout(pollAnalysisProgress, 5000); });
+})();
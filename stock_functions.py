@@ -1,67 +1,285 @@
 import os
+import re
+import glob
+import threading
+import numpy as np
 import pandas as pd
-import yfinance as yf
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-import plotly.io as pio
-from ta.momentum import RSIIndicator
-from warnings import filterwarnings
+from collections import defaultdict
+from datetime import datetime, timedelta
 from backtest_strategy import calculate_score, moving_average_crossover_backtest
-from bullish_signals_indicators import find_cup_and_handle, find_ascending_triangle, find_inverse_head_and_shoulders, bollinger_bands
-import matplotlib
-matplotlib.use('Agg')
-# filterwarnings("ignore")
+from bullish_signals_indicators import compute_signals, find_cup_and_handle, find_ascending_triangle, find_inverse_head_and_shoulders, bollinger_bands
+from downsampling import downsample
+from price_store import is_valid_symbol, has_prices, load_prices, load_meta, save_prices, append_prices, update_meta, data_version
+import analysis_cache
+from metrics import timed
 
-# Create directories if they don't exist
-os.makedirs('preprocessed_data', exist_ok=True)
-os.makedirs('static/visualizations', exist_ok=True)
+# yfinance, ta and plotly take a while to load, they are imported in the functions that use them
 
-def download_and_preprocess_stock_data(stock):
+CHARTS_DIR = 'static/visualizations/bullish_signals'
+CHART_MAX_POINTS = 2000  # Target number of points per line of the full history charts
+ZOOMED_CHARTS_PER_STOCK = 8  # Zoomed date ranges of a stock kept on disk, the least recently viewed are removed
+
+RSI_WINDOW = 14  # Window of the RSIIndicator
+REFRESH_INTERVAL = timedelta(hours=6)  # Minimum time between two refreshes of the same stock
+_refresh_locks = defaultdict(threading.RLock)  # One download or refresh at a time per stock
+_chart_locks = defaultdict(threading.Lock)  # One chart rendering at a time per stored stock
+
+def _yf_download(stock, **kwargs):
+    """
+    yfinance.download, the default downloader.
+    """
+    import yfinance as yf
+    return yf.download(stock, **kwargs)
+
+def _complete_bars(data):
+    """
+    Keep only the bars before today, today's bar is still changing while the market is open.
+    """
+    return data[data['date'] < pd.Timestamp.today().normalize()]
+
+def _preprocess(data):
+    """
+    Normalize the column names and types of the data returned by the downloader.
+    """
+    data = data.reset_index()
+    data.columns = data.columns.str.lower().str.replace(' ', '_')
+    data.ffill(inplace=True)
+    data.bfill(inplace=True)
+
+    for col in data.columns:
+        if not pd.api.types.is_datetime64_any_dtype(data[col]):
+            data[col] = pd.to_numeric(data[col], errors='coerce')
+    return data
+
+def _indicator_columns(stock):
+    return [f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi']
+
+def _add_indicators(data, stock):
+    """
+    Calculate the 50-day and 200-day moving averages and the RSI over the whole history.
+    """
+    from ta.momentum import RSIIndicator
+    data[f'{stock}_50_day_ma'] = data['close'].rolling(window=50).mean()
+    data[f'{stock}_200_day_ma'] = data['close'].rolling(window=200).mean()
+    data[f'{stock}_rsi'] = RSIIndicator(close=data['close']).rsi()
+    return data
+
+def _same_bar(stored_bar, new_bar, columns):
+    """
+    Whether a downloaded bar holds the values of the stored one, up to the rounding of the storage.
+    """
+    columns = [column for column in columns if column != 'date']
+    return bool(np.allclose(stored_bar[columns].to_numpy(dtype=float), new_bar[columns].to_numpy(dtype=float), equal_nan=True))
+
+def _rsi_state(close, window=RSI_WINDOW):
+    """
+    Compute the Wilder averages of gains and losses at the last bar, as RSIIndicator does,
+    so the RSI can be carried forward bar by bar.
+    """
+    diff = close.diff(1)
+    up_direction = diff.where(diff > 0, 0.0)
+    down_direction = -diff.where(diff < 0, 0.0)
+    return {
+        'avg_gain': float(up_direction.ewm(alpha=1 / window, adjust=False).mean().iloc[-1]),
+        'avg_loss': float(down_direction.ewm(alpha=1 / window, adjust=False).mean().iloc[-1]),
+        'last_close': float(close.iloc[-1]),
+        'count': len(close),
+    }
+
+def _carry_rsi(close, state, window=RSI_WINDOW):
+    """
+    Continue the RSI over new closing prices from the carried state.
+
+    Returns:
+    list: The RSI of each new bar
+    dict: The state at the last new bar
+    """
+    avg_gain, avg_loss, last_close, count = state['avg_gain'], state['avg_loss'], state['last_close'], state['count']
+    alpha = 1 / window
+    rsi = []
+    for price in close:
+        diff = price - last_close
+        avg_gain = (1 - alpha) * avg_gain + alpha * max(diff, 0.0)
+        avg_loss = (1 - alpha) * avg_loss + alpha * max(-diff, 0.0)
+        last_close = price
+        count += 1
+        if count < window:
+            rsi.append(float('nan'))
+        elif avg_loss == 0:
+            rsi.append(100.0)
+        else:
+            rsi.append(100 - (100 / (1 + avg_gain / avg_loss)))
+    return rsi, {'avg_gain': avg_gain, 'avg_loss': avg_loss, 'last_close': last_close, 'count': count}
+
+def download_and_preprocess_stock_data(stock, downloader=None):
     """
     Download and preprocess stock data from Yahoo Finance.
     Calculate 50-day and 200-day moving averages and RSI.
-    Save the preprocessed data as a CSV file.
-    """
-    try:
-        # Download stock data
-        data = yf.download(stock, period='max').reset_index()
-        if data.empty or 'No timezone found, symbol may be delisted' in data.to_string():
-            raise ValueError(f"The stock ticker symbol {stock} is not valid.")
-        
-        # Preprocess the data
-        data.columns = data.columns.str.lower().str.replace(' ', '_')
-        data.ffill(inplace=True)
-        data.bfill(inplace=True)
-        
-        for col in data.columns:
-            if data[col].dtype != 'datetime64[ns]':
-                data[col] = pd.to_numeric(data[col], errors='coerce')
-        
-        # Calculate moving averages and RSI
-        data[f'{stock}_50_day_ma'] = data['close'].rolling(window=50).mean()
-        data[f'{stock}_200_day_ma'] = data['close'].rolling(window=200).mean()
-        data[f'{stock}_rsi'] = RSIIndicator(close=data['close']).rsi()
-        
-        # Save the preprocessed data
-        data.to_csv(f'preprocessed_data/{stock}_data.csv', index=False)
-        return None  # Indicate success
-    except Exception as e:
-        return str(e)  # Return the error message
-
-def visualize_stock(data, stock):
+    Save the preprocessed data in the price store.
+    The downloader defaults to yfinance.download and can be replaced, e.g. by a local fake.
+    """
+    downloader = downloader or _yf_download
+    # Shares the lock of the refresh, two first downloads of a stock would write the same version folder
+    with _refresh_locks[stock]:
+        try:
+            # The symbol names the folder of the stock in the store
+            if not is_valid_symbol(stock):
+                raise ValueError(f"The stock ticker symbol {stock} is not valid.")
+
+            # Download stock data
+            with timed('download'):
+                data = downloader(stock, period='max')
+            if data.empty or 'No timezone found, symbol may be delisted' in data.to_string():
+                raise ValueError(f"The stock ticker symbol {stock} is not valid.")
+
+            # Preprocess the data
+            data = _complete_bars(_preprocess(data))
+            if data.empty:
+                raise ValueError(f"The stock ticker symbol {stock} has no complete bars yet.")
+
+            # Calculate moving averages and RSI
+            data = _add_indicators(data, stock)
+
+            # Save the preprocessed data along with the RSI state used by the incremental refresh
+            save_prices(data, stock, state={'rsi': _rsi_state(data['close'])})
+            update_meta(stock, refreshed_at=datetime.now().isoformat())
+            analysis_cache.invalidate(stock)
+            return None  # Indicate success
+        except Exception as e:
+            return str(e)  # Return the error message
+
+def needs_refresh(stock, now=None, min_interval=REFRESH_INTERVAL):
+    """
+    Staleness policy of the stored data of a stock.
+    The data is stale when its last bar is older than the previous business day,
+    and it is refreshed at most once every `min_interval` so holidays and delisted
+    tickers don't trigger a download on every analysis.
+
+    Parameters:
+    stock (str): The stock symbol
+    now (datetime): The current time. Default is datetime.now().
+    min_interval (timedelta): The minimum time between two refreshes.
+
+    Returns:
+    bool: Whether the data should be refreshed
+    """
+    now = pd.Timestamp(now or datetime.now())
+    meta = load_meta(stock)
+    if meta.get('refreshed_at') and now - pd.Timestamp(meta['refreshed_at']) < min_interval:
+        return False
+    if not meta.get('last_date'):
+        return True
+    expected_date = now.normalize() - pd.offsets.BDay(1)
+    return pd.Timestamp(meta['last_date']) < expected_date
+
+def refresh_stock_data(stock, downloader=None):
+    """
+    Incrementally update the stored data of a stock.
+    Only the bars from the last stored date (the high-water mark) on are downloaded, and the ones after it appended.
+    The moving averages are computed over the stored tail plus the new bars and the RSI
+    is carried forward from the state saved with the data.
+    The bar of the last stored date is downloaded again: when it changed since it was stored (it was stored
+    before the market closed), it is replaced and the indicators are recomputed over the whole history.
+    The downloader defaults to yfinance.download and can be replaced, e.g. by a local fake.
+
+    Parameters:
+    stock (str): The stock symbol
+    downloader (callable): Called as downloader(stock, start='YYYY-MM-DD')
+
+    Returns:
+    str: The error message, or None on success
+    """
+    downloader = downloader or _yf_download
+    with _refresh_locks[stock]:
+        try:
+            meta = load_meta(stock)
+            bar_columns = [column for column in meta['columns'] if column not in _indicator_columns(stock)]
+            stored = load_prices(stock, columns=bar_columns)
+            last_date = pd.Timestamp(meta['last_date']) if meta.get('last_date') else stored['date'].max()
+
+            # Download only the bars from the high-water mark on
+            with timed('download'):
+                new_data = downloader(stock, start=last_date.strftime('%Y-%m-%d'))
+            new_data = _complete_bars(_preprocess(new_data)) if not new_data.empty else new_data
+            replace_last = False
+            if not new_data.empty:
+                overlap = new_data[new_data['date'] == last_date]
+                replace_last = not overlap.empty and not _same_bar(stored.iloc[-1], overlap.iloc[-1], bar_columns)
+                new_data = new_data[(new_data['date'] >= last_date) if replace_last else (new_data['date'] > last_date)]
+
+            if replace_last:
+                # Same computation as a first download, over the stored bars without the last one plus the new ones
+                data = pd.concat([stored.iloc[:-1], new_data[bar_columns]], ignore_index=True)
+                data = _add_indicators(data, stock)
+                save_prices(data[list(meta['columns'])], stock, state={**meta.get('state', {}), 'rsi': _rsi_state(data['close'])})
+                analysis_cache.invalidate(stock)
+            elif not new_data.empty:
+                # Moving averages over the last 199 stored closes plus the new ones
+                tail = stored['close'].iloc[-199:]
+                closes = pd.concat([tail, new_data['close']], ignore_index=True)
+                new_data[f'{stock}_50_day_ma'] = closes.rolling(window=50).mean().iloc[len(tail):].to_numpy()
+                new_data[f'{stock}_200_day_ma'] = closes.rolling(window=200).mean().iloc[len(tail):].to_numpy()
+
+                # RSI carried forward, the state is rebuilt once for data migrated without it
+                state = meta.get('state', {}).get('rsi') or _rsi_state(stored['close'])
+                new_data[f'{stock}_rsi'], state = _carry_rsi(new_data['close'].to_numpy(), state)
+
+                append_prices(new_data[list(meta['columns'])], stock, state={**meta.get('state', {}), 'rsi': state})
+                analysis_cache.invalidate(stock)
+
+            update_meta(stock, refreshed_at=datetime.now().isoformat())
+            return None  # Indicate success
+        except Exception as e:
+            return str(e)  # Return the error message
+
+def _write_chart(fig, chart_id, name):
+    """
+    Save a chart as an HTML file. The plotly.js bundle is written once to the charts
+    directory and shared by every chart instead of being inlined in each file.
+    """
+    import plotly.io as pio
+    with timed(f'chart.{name}'):
+        pio.write_html(fig, file=f'{CHARTS_DIR}/{chart_id}_{name}.html', auto_open=False, include_plotlyjs='directory')
+
+def _pattern_indices(data, patterns):
+    """
+    Indices of the start and end dates of the patterns, kept when the charts are downsampled.
+    """
+    dates = [date for pattern in patterns for date in pattern]
+    return np.searchsorted(data['date'].to_numpy(), np.array(dates, dtype='datetime64[ns]'))
+
+def _add_pattern_chart(data, patterns, title, name, color, chart_id, max_points):
+    """
+    Plot the close price and highlight the given patterns.
+    """
+    import plotly.graph_objects as go
+    close = downsample(data['date'], {'close': data['close']}, max_points, keep=_pattern_indices(data, patterns))
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=close['close'][0], y=close['close'][1], mode='lines', name='Close Price'))
+    for i, pattern in enumerate(patterns):
+        pattern_data = data[(data['date'] >= pattern[0]) & (data['date'] <= pattern[1])]
+        fig.add_trace(go.Scatter(x=pattern_data['date'], y=pattern_data['close'], mode='lines', name=f'{title} Pattern' if i == 0 else '', line=dict(color=color), showlegend=i == 0))
+    fig.update_layout(title=f'Stock Price with {title} Patterns', xaxis_title='Date', yaxis_title='Close Price')
+    _write_chart(fig, chart_id, name)
+
+def visualize_stock(data, stock, chart_id=None, max_points=CHART_MAX_POINTS):
     """
     Visualize the stock data with Plotly.
     Plot the close price and the 50-day and 200-day moving averages.
-    Save the plot as an HTML file.
+    Save the plot as an HTML file, named after `chart_id` (default: the stock symbol).
+    Each line is downsampled to about `max_points` points, None plots every point.
     """
-    filename = f'static/visualizations/bullish_signals/{stock}_chart.html'
+    import plotly.graph_objects as go
+    chart_id = chart_id or stock
+    series = downsample(data['date'], {'close': data['close'], '50_day_ma': data[f'{stock}_50_day_ma'],
+                                       '200_day_ma': data[f'{stock}_200_day_ma']}, max_points)
 
     fig = go.Figure()
 
     # Add traces for the close price and the moving averages
-    fig.add_trace(go.Scatter(x=data['date'], y=data['close'], mode='lines', name='Close Price'))
-    fig.add_trace(go.Scatter(x=data['date'], y=data[f'{stock}_50_day_ma'], mode='lines', name='50-Day MA'))
-    fig.add_trace(go.Scatter(x=data['date'], y=data[f'{stock}_200_day_ma'], mode='lines', name='200-Day MA'))
+    fig.add_trace(go.Scatter(x=series['close'][0], y=series['close'][1], mode='lines', name='Close Price'))
+    fig.add_trace(go.Scatter(x=series['50_day_ma'][0], y=series['50_day_ma'][1], mode='lines', name='50-Day MA'))
+    fig.add_trace(go.Scatter(x=series['200_day_ma'][0], y=series['200_day_ma'][1], mode='lines', name='200-Day MA'))
 
     # Update layout
     fig.update_layout(
@@ -72,58 +290,46 @@ def visualize_stock(data, stock):
     )
 
     # Save the plot
-    pio.write_html(fig, file=filename, auto_open=False)
+    _write_chart(fig, chart_id, 'chart')
 
-def visualize_stock_patterns(data, stock):
+def visualize_stock_patterns(data, stock, chart_id=None, max_points=CHART_MAX_POINTS):
     """
     Visualize the stock data with Plotly.
     Plot the close price and the bullish patterns (Cup-and-Handle, Ascending Triangle, Inverse Head-and-Shoulders,
-    Bollinger Bands, and RSI). Save the plots as HTML files.
+    Bollinger Bands, and RSI). Save the plots as HTML files, named after `chart_id` (default: the stock symbol).
+    Each line is downsampled to about `max_points` points, keeping the pattern endpoints. None plots every point.
     """
+    chart_id = chart_id or stock
     _, cup_and_handle_patterns = find_cup_and_handle(data)
     _, ascending_triangle_patterns = find_ascending_triangle(data)
     _, inverse_head_and_shoulders_patterns = find_inverse_head_and_shoulders(data)
 
     # Cup-and-Handle patterns
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=data['date'], y=data['close'], mode='lines', name='Close Price'))
-    for i, pattern in enumerate(cup_and_handle_patterns):
-        pattern_data = data[(data['date'] >= pattern[0]) & (data['date'] <= pattern[1])]
-        fig.add_trace(go.Scatter(x=pattern_data['date'], y=pattern_data['close'], mode='lines', name='Cup-and-Handle Pattern' if i == 0 else '', line=dict(color='red'), showlegend=i == 0))
-    fig.update_layout(title='Stock Price with Cup-and-Handle Patterns', xaxis_title='Date', yaxis_title='Close Price')
-    pio.write_html(fig, file=f'static/visualizations/bullish_signals/{stock}_cup_and_handle.html', auto_open=False)
+    _add_pattern_chart(data, cup_and_handle_patterns, 'Cup-and-Handle', 'cup_and_handle', 'red', chart_id, max_points)
 
     # Triangle patterns
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=data['date'], y=data['close'], mode='lines', name='Close Price'))
-    for i, pattern in enumerate(ascending_triangle_patterns):
-        pattern_data = data[(data['date'] >= pattern[0]) & (data['date'] <= pattern[1])]
-        fig.add_trace(go.Scatter(x=pattern_data['date'], y=pattern_data['close'], mode='lines', name='Ascending Triangle Pattern' if i == 0 else '', line=dict(color='#FF4500'), showlegend=i == 0))
-    fig.update_layout(title='Stock Price with Ascending Triangle Patterns', xaxis_title='Date', yaxis_title='Close Price')
-    pio.write_html(fig, file=f'static/visualizations/bullish_signals/{stock}_ascending_triangle.html', auto_open=False)
+    _add_pattern_chart(data, ascending_triangle_patterns, 'Ascending Triangle', 'ascending_triangle', '#FF4500', chart_id, max_points)
 
     # Inverse Head-and-Shoulders patterns
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=data['date'], y=data['close'], mode='lines', name='Close Price'))
-    for i, pattern in enumerate(inverse_head_and_shoulders_patterns):
-        pattern_data = data[(data['date'] >= pattern[0]) & (data['date'] <= pattern[1])]
-        fig.add_trace(go.Scatter(x=pattern_data['date'], y=pattern_data['close'], mode='lines', name='Inverse Head-and-Shoulders Pattern' if i == 0 else '', line=dict(color='blue'), showlegend=i == 0))
-    fig.update_layout(title='Stock Price with Inverse Head-and-Shoulders Patterns', xaxis_title='Date', yaxis_title='Close Price')
-    pio.write_html(fig, file=f'static/visualizations/bullish_signals/{stock}_inverse_head_and_shoulders.html', auto_open=False)
+    _add_pattern_chart(data, inverse_head_and_shoulders_patterns, 'Inverse Head-and-Shoulders', 'inverse_head_and_shoulders', 'blue', chart_id, max_points)
 
     # Bollinger Bands visualization
+    import plotly.graph_objects as go
     _, upper_band, lower_band = bollinger_bands(data)
+    close = downsample(data['date'], {'close': data['close']}, max_points)['close']
+    bands = downsample(data['date'], {'upper': upper_band, 'lower': lower_band}, max_points, shared=True)
 
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=data['date'], y=data['close'], mode='lines', name='Close Price', line=dict(color='black'), line_width=0.5))
-    fig.add_trace(go.Scatter(x=data['date'], y=upper_band, mode='lines', name='Upper Bollinger Band', line=dict(color='green'), line_width=0.6))
-    fig.add_trace(go.Scatter(x=data['date'], y=lower_band, mode='lines', name='Lower Bollinger Band', line=dict(color='green'), line_width=0.6, fill='tonexty'))
+    fig.add_trace(go.Scatter(x=close[0], y=close[1], mode='lines', name='Close Price', line=dict(color='black'), line_width=0.5))
+    fig.add_trace(go.Scatter(x=bands['upper'][0], y=bands['upper'][1], mode='lines', name='Upper Bollinger Band', line=dict(color='green'), line_width=0.6))
+    fig.add_trace(go.Scatter(x=bands['lower'][0], y=bands['lower'][1], mode='lines', name='Lower Bollinger Band', line=dict(color='green'), line_width=0.6, fill='tonexty'))
     fig.update_layout(title='Stock Price with Bollinger Bands', xaxis_title='Date', yaxis_title='Close Price')
-    pio.write_html(fig, file=f'static/visualizations/bullish_signals/{stock}_bollinger_bands.html', auto_open=False)
+    _write_chart(fig, chart_id, 'bollinger_bands')
 
     # RSI visualization
+    rsi = downsample(data['date'], {'rsi': data[f'{stock}_rsi']}, max_points)['rsi']
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=data['date'], y=data[f'{stock}_rsi'], mode='lines', name='RSI'))
+    fig.add_trace(go.Scatter(x=rsi[0], y=rsi[1], mode='lines', name='RSI'))
     # Add overbought level
     fig.add_shape(type="line", x0=data['date'].min(), x1=data['date'].max(), y0=70, y1=70, line=dict(color="Red", width=0.5, dash="dash"))
     fig.add_trace(go.Scatter(x=[data['date'].iloc[-1]], y=[70], mode='lines', line=dict(color="Red", width=0.5), showlegend=True, name='Overbought (70)'))
@@ -132,30 +338,129 @@ def visualize_stock_patterns(data, stock):
     fig.add_shape(type="line", x0=data['date'].min(), x1=data['date'].max(), y0=30, y1=30, line=dict(color="Blue", width=0.5, dash="dash"))
     fig.add_trace(go.Scatter(x=[data['date'].iloc[-1]], y=[30], mode='lines', line=dict(color="Blue", width=0.5), showlegend=True, name='Oversold (30)'))
     fig.update_layout(title='RSI', xaxis_title='Date', yaxis_title='RSI')  # Add range slider
-    pio.write_html(fig, file=f'static/visualizations/bullish_signals/{stock}_rsi.html', auto_open=False)
+    _write_chart(fig, chart_id, 'rsi')
+
+def _zoomed_chart_ids(stock):
+    """
+    The chart ids of the zoomed date ranges of a stock on disk, the most recently viewed first.
+    """
+    if not os.path.isdir(CHARTS_DIR):
+        return []
+    pattern = re.compile(rf'{re.escape(stock)}_(\d{{8}}|start)_(\d{{8}}|end)_version\.txt')
+    paths = [os.path.join(CHARTS_DIR, name) for name in os.listdir(CHARTS_DIR) if pattern.fullmatch(name)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.basename(path)[:-len('_version.txt')] for path in paths]
+
+def _remove_old_zoomed_charts(stock):
+    """
+    Delete the chart files of the zoomed date ranges of a stock, except for the ZOOMED_CHARTS_PER_STOCK most recently viewed.
+    """
+    for chart_id in _zoomed_chart_ids(stock)[ZOOMED_CHARTS_PER_STOCK:]:
+        # The version file goes first, a partly removed range is rendered again when it is viewed
+        for path in [f'{CHARTS_DIR}/{chart_id}_version.txt'] + glob.glob(f'{CHARTS_DIR}/{chart_id}_*.html'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def ensure_stock_charts(stock, start=None, end=None):
+    """
+    Render the charts of a stock if they are missing or older than its stored data.
+    The rendered charts are cached on disk, keyed by the stock, the date range and the version of its data.
+    The full history is downsampled, a zoomed date range is plotted exactly. Only the charts of the
+    ZOOMED_CHARTS_PER_STOCK most recently viewed date ranges of a stock are kept.
+
+    Parameters:
+    stock (str): The stock symbol
+    start (datetime): The first date to plot. Default is the first stored date.
+    end (datetime): The last date to plot. Default is the last stored date.
+
+    Returns:
+    str: The prefix of the chart files
+    str: The data version the charts were rendered from, to use as a cache buster in their URLs
+    """
+    zoomed = start is not None or end is not None
+    chart_id = stock
+    if zoomed:
+        start_label = f'{pd.Timestamp(start):%Y%m%d}' if start is not None else 'start'
+        end_label = f'{pd.Timestamp(end):%Y%m%d}' if end is not None else 'end'
+        chart_id = f'{stock}_{start_label}_{end_label}'
+    version_path = f'{CHARTS_DIR}/{chart_id}_version.txt'
+    # The locks are per stock, so there is one for each stored stock rather than one per date range
+    if not has_prices(stock):
+        raise ValueError(f"There is no data for {stock}.")
+
+    with _chart_locks[stock]:
+        version = data_version(stock)
+        if os.path.exists(version_path):
+            with open(version_path, 'r') as f:
+                if f.read() == version:
+                    if zoomed:
+                        # Marks the range as recently viewed
+                        os.utime(version_path)
+                    return chart_id, version
+
+        os.makedirs(CHARTS_DIR, exist_ok=True)
+        data = load_prices(stock, columns=['close', f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi'])
+        if zoomed:
+            in_range = np.ones(len(data), dtype=bool)
+            if start is not None:
+                in_range &= data['date'] >= pd.Timestamp(start)
+            if end is not None:
+                in_range &= data['date'] <= pd.Timestamp(end)
+            data = data[in_range].reset_index(drop=True)
+            if data.empty:
+                raise ValueError(f"There is no data for {stock} in the selected date range.")
+        max_points = None if zoomed else CHART_MAX_POINTS
+        visualize_stock_patterns(data, stock, chart_id, max_points)
+        visualize_stock(data, stock, chart_id, max_points)
+
+        # Written last, an interrupted rendering is retried on the next request
+        with open(version_path, 'w') as f:
+            f.write(version)
+        if zoomed:
+            _remove_old_zoomed_charts(stock)
+        return chart_id, version
 
 def run_analysis(stock, threshold=0.05, days=10, rsi_threshold=30, weights_dict=None):
     """
     Run the analysis for a specific stock.
-    Download and preprocess the stock data if it doesn't exist.
+    Download and preprocess the stock data if it doesn't exist, or refresh it when it is stale.
     Calculate the score for the stock based on various indicators.
-    Visualize the stock data and the bullish patterns.
-    Return the analysis results.
+    Return the analysis results. The charts are rendered on demand by ensure_stock_charts.
+    The results and the signals are memoized by analysis_cache, keyed by the data version of the stock,
+    so identical analyses of unchanged data are not recomputed.
     """
-    preprocessed_file_path = f'preprocessed_data/{stock}_data.csv'
-    
-    if not os.path.exists(preprocessed_file_path):
-        error = download_and_preprocess_stock_data(stock)
+    if not has_prices(stock):
+        with _refresh_locks[stock]:
+            # Another analysis may have downloaded the stock while this one waited for the lock
+            error = None if has_prices(stock) else download_and_preprocess_stock_data(stock)
         if error:
             return {'stock': stock, 'error': error}
-    
-    data = pd.read_csv(preprocessed_file_path, parse_dates=['date'])
+    elif needs_refresh(stock):
+        # A failed refresh is not fatal, the analysis runs on the stored data
+        refresh_stock_data(stock)
+
+    # Same data and same parameters give the same result
+    version = data_version(stock)
+    key = analysis_cache.result_key(stock, version, threshold, days, rsi_threshold, weights_dict)
+    cached = analysis_cache.result_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+
+    with timed('load_prices'):
+        data = load_prices(stock, columns=['close', 'high', 'volume', f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi'])
+
+    # The signals don't depend on the day range and the weights, so they are shared by the analyses that only change those
+    signals_key = analysis_cache.signal_key(stock, version, threshold, rsi_threshold)
+    signals = analysis_cache.signal_cache.get(signals_key)
+    if signals is None:
+        signals = compute_signals(data, stock, volume_threshold=threshold, rsi_threshold=rsi_threshold)
+        analysis_cache.signal_cache.put(signals_key, signals)
 
-    score, individual_scores, _ = calculate_score(data, stock, days=days, threshold=threshold, rsi_threshold=rsi_threshold, weights=weights_dict)
+    score, individual_scores, _ = calculate_score(data, stock, days=days, threshold=threshold, rsi_threshold=rsi_threshold, weights=weights_dict, signals=signals)
     recommendation = "Trade" if score > 0.5 else "Don't Trade"
 
-    visualize_stock_patterns(data, stock)
-    visualize_stock(data, stock)
     result = {
         'stock': stock,
         'moving_average_crossover': individual_scores['moving_average_crossover'],
@@ -171,4 +476,5 @@ def run_analysis(stock, threshold=0.05, days=10, rsi_threshold=30, weights_dict=
         'recommendation': recommendation
     }
 
+    analysis_cache.result_cache.put(key, dict(result))
     return result
\ No newline at end of file
@@ -0,0 +1,301 @@
+import math
+from collections import deque
+
+# Signals that can be updated bar by bar. The chart patterns need the peaks and troughs of the whole
+# history, and a peak is only confirmed `pattern_window` bars later, so they are left to compute_signals
+STREAMING_SIGNALS = ['moving_average_crossover', 'rsi_oversold', 'volume_spikes', 'breakouts', 'bollinger_bands',
+                     'exponential_moving_average']
+
+NAN = float('nan')
+
+class RollingMean:
+    """
+    Mean of the last `window` values, NaN until `min_periods` values were seen (as pandas rolling().mean()).
+    The running sum is recomputed from the window every `window` values so rounding errors don't accumulate.
+    """
+
+    def __init__(self, window, min_periods=None):
+        self.window = window
+        self.min_periods = window if min_periods is None else min_periods
+        self.values = deque()
+        self.total = 0.0
+        self.updates = 0
+
+    def update(self, value):
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.window:
+            self.total -= self.values.popleft()
+        self.updates += 1
+        if self.updates % self.window == 0:
+            self.total = math.fsum(self.values)
+        return self.value
+
+    @property
+    def value(self):
+        return self.total / len(self.values) if len(self.values) >= self.min_periods else NAN
+
+    def get_state(self):
+        return {'values': list(self.values), 'updates': self.updates}
+
+    def set_state(self, state):
+        self.values = deque(state['values'])
+        self.total = math.fsum(self.values)
+        self.updates = state['updates']
+
+class RollingMax:
+    """
+    Maximum of the last `window` values (as pandas rolling(min_periods=1).max()), kept in a monotonic deque
+    of (index, value) pairs with decreasing values, so each update is amortized O(1).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.candidates = deque()
+        self.index = 0
+
+    def update(self, value):
+        while self.candidates and self.candidates[-1][1] <= value:
+            self.candidates.pop()
+        self.candidates.append((self.index, value))
+        if self.candidates[0][0] <= self.index - self.window:
+            self.candidates.popleft()
+        self.index += 1
+        return self.value
+
+    @property
+    def value(self):
+        return self.candidates[0][1] if self.candidates else NAN
+
+    def get_state(self):
+        return {'candidates': [list(candidate) for candidate in self.candidates], 'index': self.index}
+
+    def set_state(self, state):
+        self.candidates = deque(tuple(candidate) for candidate in state['candidates'])
+        self.index = state['index']
+
+class RollingMeanStd:
+    """
+    Mean and sample standard deviation of the last `window` values, NaN until the window is full
+    (as pandas rolling(window).mean() and .std()). Updated with Welford's algorithm, adding the new value
+    and removing the one leaving the window in a single step. The removals accumulate rounding errors, so the
+    mean and the sum of squares are recomputed from the window every `window` values.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.updates = 0
+
+    def update(self, value):
+        self.values.append(value)
+        if len(self.values) <= self.window:
+            delta = value - self.mean
+            self.mean += delta / len(self.values)
+            self.m2 += delta * (value - self.mean)
+        else:
+            old = self.values.popleft()
+            previous_mean = self.mean
+            self.mean += (value - old) / self.window
+            self.m2 += (value - old) * (value - self.mean + old - previous_mean)
+        self.updates += 1
+        if self.updates % self.window == 0:
+            self.mean = math.fsum(self.values) / len(self.values)
+            self.m2 = math.fsum((kept - self.mean) ** 2 for kept in self.values)
+        return self.value
+
+    @property
+    def value(self):
+        if len(self.values) < self.window:
+            return NAN, NAN
+        return self.mean, math.sqrt(max(self.m2, 0.0) / (self.window - 1))
+
+    def get_state(self):
+        return {'values': list(self.values), 'mean': self.mean, 'm2': self.m2, 'updates': self.updates}
+
+    def set_state(self, state):
+        self.values = deque(state['values'])
+        self.mean, self.m2 = state['mean'], state['m2']
+        self.updates = state.get('updates', len(self.values))
+
+class AdjustedEMA:
+    """
+    Exponential moving average with the adjusted weights of pandas ewm(span=span).mean():
+    the weighted sum and the sum of the weights are both decayed at each value.
+    """
+
+    def __init__(self, span):
+        self.decay = 1 - 2 / (span + 1)
+        self.weighted_sum = 0.0
+        self.weights = 0.0
+
+    def update(self, value):
+        self.weighted_sum = value + self.decay * self.weighted_sum
+        self.weights = 1 + self.decay * self.weights
+        return self.value
+
+    @property
+    def value(self):
+        return self.weighted_sum / self.weights if self.weights else NAN
+
+    def get_state(self):
+        return {'weighted_sum': self.weighted_sum, 'weights': self.weights}
+
+    def set_state(self, state):
+        self.weighted_sum, self.weights = state['weighted_sum'], state['weights']
+
+class WilderRSI:
+    """
+    RSI with Wilder's smoothing of the gains and losses, as ta's RSIIndicator (and stock_functions._carry_rsi).
+    NaN until `window` values were seen.
+    """
+
+    def __init__(self, window=14):
+        self.window = window
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.last_close = None
+        self.count = 0
+
+    def update(self, close):
+        # The first bar has no change, it counts as neither a gain nor a loss
+        diff = 0.0 if self.last_close is None else close - self.last_close
+        alpha = 1 / self.window
+        self.avg_gain = (1 - alpha) * self.avg_gain + alpha * max(diff, 0.0)
+        self.avg_loss = (1 - alpha) * self.avg_loss + alpha * max(-diff, 0.0)
+        self.last_close = close
+        self.count += 1
+        return self.value
+
+    @property
+    def value(self):
+        if self.count < self.window:
+            return NAN
+        if self.avg_loss == 0:
+            return 100.0
+        return 100 - (100 / (1 + self.avg_gain / self.avg_loss))
+
+    def get_state(self):
+        return {'avg_gain': self.avg_gain, 'avg_loss': self.avg_loss, 'last_close': self.last_close, 'count': self.count}
+
+    def set_state(self, state):
+        self.avg_gain, self.avg_loss = state['avg_gain'], state['avg_loss']
+        self.last_close, self.count = state['last_close'], state['count']
+
+def _crosses_above(value, line, previous_value, previous_line):
+    # NaN compares as False, as in bullish_signals_indicators._crosses_above
+    return value > line and previous_value < previous_line
+
+class StreamingSignals:
+    """
+    Incremental version of compute_signals for live bars: keeps the rolling state of every indicator
+    (running sums for the 50 and 200 bar moving averages, Wilder RSI, EMA, Welford mean and variance
+    for the Bollinger Bands, monotonic deque for the 50 bar high) and updates it in O(1) per bar.
+    The moving averages and the RSI are computed from the closing prices, like the preprocessing of
+    the downloaded data. The chart patterns are not included (see STREAMING_SIGNALS).
+
+    Usage:
+        signals = StreamingSignals()
+        signals.update_many(history)  # Replays the stored bars to build the state
+        signals.update(close, high, volume)  # Then one call per new bar
+    """
+
+    def __init__(self, volume_threshold=2, rsi_threshold=30, bollinger_window=20, num_std=2, ema_span=20, rsi_window=14):
+        """
+        Parameters:
+        volume_threshold (float): The multiplier to identify volume spikes. Default is 2.
+        rsi_threshold (float): The RSI threshold to identify oversold conditions. Default is 30.
+        bollinger_window (int): The window size for the Bollinger Bands. Default is 20.
+        num_std (int): The number of standard deviations for the Bollinger Bands. Default is 2.
+        ema_span (int): The span for calculating the EMA. Default is 20.
+        rsi_window (int): The window of the RSI. Default is 14.
+        """
+        self.volume_threshold = volume_threshold
+        self.rsi_threshold = rsi_threshold
+        self.num_std = num_std
+        self.ma_50 = RollingMean(50)
+        self.ma_200 = RollingMean(200)
+        self.rsi = WilderRSI(rsi_window)
+        self.average_volume = RollingMean(50, min_periods=1)
+        self.high_max = RollingMax(50)
+        self.bands = RollingMeanStd(bollinger_window)
+        self.ema = AdjustedEMA(span=ema_span)
+        # Values of the previous bar, for the crossings
+        self.previous = {'close': NAN, 'ma_50': NAN, 'ma_200': NAN, 'lower_band': NAN, 'ema': NAN}
+
+    def update(self, close, high, volume):
+        """
+        Ingest one bar.
+
+        Parameters:
+        close (float): The closing price of the bar
+        high (float): The high of the bar
+        volume (float): The volume of the bar
+
+        Returns:
+        dict: Whether each signal of STREAMING_SIGNALS is detected on this bar
+        """
+        close, high, volume = float(close), float(high), float(volume)
+        previous = self.previous
+
+        ma_50, ma_200 = self.ma_50.update(close), self.ma_200.update(close)
+        rsi = self.rsi.update(close)
+        average_volume = self.average_volume.update(volume)
+        # The breakout compares the close to the highest high of the 50 bars before this one
+        previous_high_max = self.high_max.value
+        self.high_max.update(high)
+        mean, std = self.bands.update(close)
+        lower_band = mean - std * self.num_std
+        ema = self.ema.update(close)
+
+        signals = {
+            'moving_average_crossover': _crosses_above(ma_50, ma_200, previous['ma_50'], previous['ma_200']),
+            'rsi_oversold': rsi < self.rsi_threshold,
+            'volume_spikes': volume > self.volume_threshold * average_volume and close > previous['close'],
+            'breakouts': close > previous_high_max,
+            'bollinger_bands': _crosses_above(close, lower_band, previous['close'], previous['lower_band']),
+            'exponential_moving_average': _crosses_above(close, ema, previous['close'], previous['ema']),
+        }
+        self.previous = {'close': close, 'ma_50': ma_50, 'ma_200': ma_200, 'lower_band': lower_band, 'ema': ema}
+        return signals
+
+    def update_many(self, data):
+        """
+        Ingest a batch of bars, e.g. the stored history.
+
+        Parameters:
+        data (pandas.DataFrame): The bars, with 'close', 'high' and 'volume' columns
+
+        Returns:
+        dict: A boolean list per signal of STREAMING_SIGNALS, True on the bars where the signal is detected
+        """
+        signals = {name: [] for name in STREAMING_SIGNALS}
+        for close, high, volume in zip(data['close'].tolist(), data['high'].tolist(), data['volume'].tolist()):
+            for name, detected in self.update(close, high, volume).items():
+                signals[name].append(detected)
+        return signals
+
+    @property
+    def values(self):
+        """
+        The current indicator values: moving averages, RSI, lower Bollinger Band and EMA.
+        """
+        return dict(self.previous, rsi=self.rsi.value)
+
+    def get_state(self):
+        """
+        The state of every indicator as a JSON serializable dictionary, e.g. to keep with the price store
+        (see price_store.save_prices) and resume the stream after a restart.
+        """
+        return {
+            'indicators': {name: getattr(self, name).get_state()
+                           for name in ('ma_50', 'ma_200', 'rsi', 'average_volume', 'high_max', 'bands', 'ema')},
+            'previous': self.previous,
+        }
+
+    def set_state(self, state):
+        for name, indicator_state in state['indicators'].items():
+            getattr(self, name).set_state(indicator_state)
+        self.previous = dict(state['previous'])
@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+# The modules of the app live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import price_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    An empty price store in a temporary directory.
+    """
+    monkeypatch.setattr(price_store, 'STORE_DIR', str(tmp_path / 'preprocessed_data'))
+    return tmp_path / 'preprocessed_data'
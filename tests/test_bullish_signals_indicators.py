@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import pytest
+from bullish_signals_indicators import (SIGNALS, PATTERN_SIGNALS, find_peaks, _segment_mins, _cup_and_handle_indices,
+                                        _ascending_triangle_indices, _inverse_head_and_shoulders_indices, last_pattern_indices, compute_signals,
+                                        find_cup_and_handle, find_ascending_triangle, find_inverse_head_and_shoulders)
+
+# The pattern finders as they were before they were vectorized, scanning the peaks and troughs one by one
+
+
+def loop_cup_and_handle(close_prices, peaks):
+    left, right = [], []
+    for i in range(len(peaks) - 2):
+        left_peak, center_peak, right_peak = peaks[i], peaks[i+1], peaks[i+2]
+        if close_prices[left_peak] < close_prices[center_peak] and close_prices[right_peak] < close_prices[center_peak]:
+            cup_bottom = close_prices[left_peak:center_peak].min()
+            handle_bottom = close_prices[center_peak:right_peak].min()
+            if handle_bottom > cup_bottom and close_prices[right_peak] > close_prices[center_peak] * 0.95:
+                left.append(left_peak)
+                right.append(right_peak)
+    return np.array(left, dtype=int), np.array(right, dtype=int)
+
+
+def loop_ascending_triangle(close_prices, peaks, troughs):
+    left, right = [], []
+    for i in range(len(peaks) - 1):
+        left_peak, right_peak = peaks[i], peaks[i+1]
+        relevant_troughs = [t for t in troughs if left_peak < t < right_peak]
+        if not relevant_troughs:
+            continue
+        min_trough = min(relevant_troughs, key=lambda x: close_prices[x])
+        if close_prices[min_trough] > close_prices[left_peak] * 0.95:
+            left.append(left_peak)
+            right.append(right_peak)
+    return np.array(left, dtype=int), np.array(right, dtype=int)
+
+
+def loop_inverse_head_and_shoulders(close_prices, troughs):
+    left, right = [], []
+    for i in range(len(troughs) - 2):
+        left_shoulder, head, right_shoulder = troughs[i], troughs[i+1], troughs[i+2]
+        if close_prices[left_shoulder] > close_prices[head] and close_prices[right_shoulder] > close_prices[head]:
+            left.append(left_shoulder)
+            right.append(right_shoulder)
+    return np.array(left, dtype=int), np.array(right, dtype=int)
+
+
+def random_closes(bars, seed):
+    rng = np.random.default_rng(seed)
+    return 100 * np.exp(np.cumsum(rng.normal(0, 0.02, bars)))
+
+
+def assert_same_patterns(found, expected):
+    np.testing.assert_array_equal(found[0], expected[0])
+    np.testing.assert_array_equal(found[1], expected[1])
+
+
+SERIES = [(bars, seed) for bars in (0, 1, 2, 3, 10, 60, 500, 3000) for seed in range(3)]
+WINDOWS = [1, 2, 5, 20, 50]
+
+
+@pytest.mark.parametrize('bars, seed', SERIES)
+@pytest.mark.parametrize('window', WINDOWS)
+def test_pattern_indices_match_the_loops(bars, seed, window):
+    close_prices = random_closes(bars, seed)
+    peaks, _ = find_peaks(close_prices, distance=window)
+    troughs, _ = find_peaks(-close_prices, distance=window)
+
+    assert_same_patterns(_cup_and_handle_indices(close_prices, peaks), loop_cup_and_handle(close_prices, peaks))
+    assert_same_patterns(_ascending_triangle_indices(close_prices, peaks, troughs), loop_ascending_triangle(close_prices, peaks, troughs))
+    assert_same_patterns(_inverse_head_and_shoulders_indices(close_prices, troughs), loop_inverse_head_and_shoulders(close_prices, troughs))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pattern_indices_with_flat_prices(seed):
+    # Rounded prices give equal closes, and plateaus that find_peaks reports once
+    close_prices = np.round(random_closes(2000, seed), 0)
+    peaks, _ = find_peaks(close_prices, distance=5)
+    troughs, _ = find_peaks(-close_prices, distance=5)
+    assert_same_patterns(_cup_and_handle_indices(close_prices, peaks), loop_cup_and_handle(close_prices, peaks))
+    assert_same_patterns(_ascending_triangle_indices(close_prices, peaks, troughs), loop_ascending_triangle(close_prices, peaks, troughs))
+    assert_same_patterns(_inverse_head_and_shoulders_indices(close_prices, troughs), loop_inverse_head_and_shoulders(close_prices, troughs))
+
+
+def test_pattern_indices_of_handmade_patterns():
+    # Cup between the peaks at 2 and 6, handle between 6 and 8
+    close_prices = np.array([1, 2, 5, 3, 1, 4, 6, 4, 5.9, 1.0])
+    peaks = np.array([2, 6, 8])
+    assert_same_patterns(_cup_and_handle_indices(close_prices, peaks), (np.array([2]), np.array([8])))
+    # No trough between the peaks: no triangle
+    assert_same_patterns(_ascending_triangle_indices(close_prices, peaks, np.array([], dtype=int)), (np.array([]), np.array([])))
+    # Shoulders at 1 and 7 above the head at 4
+    troughs = np.array([1, 4, 7])
+    assert_same_patterns(_inverse_head_and_shoulders_indices(close_prices, troughs), (np.array([1]), np.array([7])))
+
+
+@pytest.mark.parametrize('bars, seed', [(0, 0), (1, 0), (100, 1), (3000, 2)])
+def test_segment_mins_match_the_slices(bars, seed):
+    values = random_closes(bars, seed)
+    rng = np.random.default_rng(seed)
+    for _ in range(20):
+        stop = int(rng.integers(0, bars + 1))
+        starts = np.unique(rng.integers(0, stop, size=min(stop, 10))) if stop else np.array([], dtype=int)
+        ends = list(starts[1:]) + [stop]
+        expected = [values[start:end].min() for start, end in zip(starts, ends)]
+        np.testing.assert_array_equal(_segment_mins(values, starts, stop=stop), expected)
+
+
+@pytest.mark.parametrize('bars, seed', [(0, 0), (30, 1), (500, 2), (3000, 3)])
+def test_last_pattern_indices_match_the_loops(bars, seed):
+    close_prices = random_closes(bars, seed)
+    peaks, _ = find_peaks(close_prices, distance=50)
+    troughs, _ = find_peaks(-close_prices, distance=50)
+    ends = {
+        'cup_and_handle': loop_cup_and_handle(close_prices, peaks)[1],
+        'ascending_triangle': loop_ascending_triangle(close_prices, peaks, troughs)[1],
+        'inverse_head_and_shoulders': loop_inverse_head_and_shoulders(close_prices, troughs)[1],
+    }
+    assert last_pattern_indices(close_prices) == {signal: int(end.max()) if len(end) else -1 for signal, end in ends.items()}
+
+
+@pytest.mark.parametrize('bars', [0, 3, 400, 3000])
+def test_pattern_finders_and_signals_agree(bars):
+    close_prices = random_closes(bars, bars)
+    data = pd.DataFrame({
+        'date': pd.bdate_range('2000-01-01', periods=bars),
+        'close': close_prices,
+        'high': close_prices * 1.01,
+        'volume': np.ones(bars),
+        'SYN_50_day_ma': close_prices,
+        'SYN_200_day_ma': close_prices,
+        'SYN_rsi': np.full(bars, 50.0),
+    })
+    signals = compute_signals(data, 'SYN')
+    for name, finder in [('cup_and_handle', find_cup_and_handle), ('ascending_triangle', find_ascending_triangle),
+                         ('inverse_head_and_shoulders', find_inverse_head_and_shoulders)]:
+        dates, patterns = finder(data)
+        assert dates == data.loc[signals[name], 'date'].tolist()
+        assert all(start <= end for start, end in patterns)
+
+
+def test_pattern_signals_are_the_patterns_of_signals():
+    assert set(PATTERN_SIGNALS) <= set(SIGNALS)
+    assert list(last_pattern_indices(random_closes(500, 0))) == PATTERN_SIGNALS
@@ -0,0 +1,229 @@
+import json
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import pytest
+import requests
+from urllib3.util.retry import Retry
+import earnings_store
+import fundamental_factors as ff
+
+NEWS = {'status': 'ok', 'totalResults': 1, 'articles': [{'title': 'Results', 'source': {'name': 'Wire'}}]}
+EARNINGS = {'symbol': 'SYN', 'quarterlyEarnings': [
+    {'fiscalDateEnding': '2024-03-31', 'reportedDate': '2024-04-25', 'reportedEPS': '1.1', 'estimatedEPS': '1.0',
+     'surprise': '0.1', 'surprisePercentage': '10'},
+    {'fiscalDateEnding': '2023-12-31', 'reportedDate': '2024-01-25', 'reportedEPS': '0.9', 'estimatedEPS': 'None',
+     'surprise': 'None', 'surprisePercentage': 'None'},
+]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers each path with the scripted responses of the server, in order, the last one repeated.
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        started = time.monotonic()
+        with self.server.lock:
+            script = self.server.responses[path]
+            status, body, delay = script.pop(0) if len(script) > 1 else script[0]
+        time.sleep(delay)
+        # Recorded before answering, the client may move on as soon as it has the response
+        with self.server.lock:
+            self.server.requests.append((path, started, time.monotonic()))
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.responses = {'/query': [(200, EARNINGS, 0)], '/v2/everything': [(200, NEWS, 0)]}
+
+    def script(self, path, *responses):
+        """
+        Responses as (status, body) or (status, body, delay in seconds) tuples.
+        """
+        self.responses[path] = [response + (0,) if len(response) == 2 else response for response in responses]
+
+    def hits(self, path):
+        with self.lock:
+            return sum(1 for requested, _, _ in self.requests if requested == path)
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    monkeypatch.setattr(ff, 'ALPHAVANTAGE_URL', url + '/query')
+    monkeypatch.setattr(ff, 'NEWSAPI_URL', url + '/v2/everything')
+    monkeypatch.setattr(ff, 'CACHE_DIR', str(tmp_path / 'http_cache'))
+    monkeypatch.setattr(earnings_store, 'DB_PATH', str(tmp_path / 'earnings.db'))
+    monkeypatch.setenv('ALPHAVANTAGE_API_KEY', 'test')
+    monkeypatch.setenv('NEWSAPI_API_KEY', 'test')
+    # A new session, so the retry settings of each test apply
+    monkeypatch.setattr(ff, '_session', None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def age_cache(url, params, seconds):
+    """
+    Make the cached response of a request older by some seconds.
+    """
+    path = ff._cache_path(url, params)
+    with open(path, 'r') as f:
+        entry = json.load(f)
+    entry['fetched_at'] -= seconds
+    with open(path, 'w') as f:
+        json.dump(entry, f)
+
+
+def test_news_cache_hit_within_ttl(stub):
+    assert ff.get_news_data('SYN') == NEWS
+    assert ff.get_news_data('SYN') == NEWS
+    assert stub.hits('/v2/everything') == 1
+    assert ff.is_cached(*ff.news_request('SYN'))
+
+
+def test_api_keys_are_not_part_of_the_cache_key(stub, monkeypatch):
+    ff.get_news_data('SYN')
+    monkeypatch.setenv('NEWSAPI_API_KEY', 'another key')
+    ff.get_news_data('SYN')
+    assert stub.hits('/v2/everything') == 1
+
+
+def test_news_refetched_after_expiry(stub):
+    ff.get_news_data('SYN')
+    url, params, ttl = ff.news_request('SYN')
+    age_cache(url, params, ttl - 60)
+    ff.get_news_data('SYN')
+    assert stub.hits('/v2/everything') == 1
+
+    updated = dict(NEWS, totalResults=2)
+    stub.script('/v2/everything', (200, updated))
+    age_cache(url, params, 60)
+    assert ff.get_news_data('SYN') == updated
+    assert stub.hits('/v2/everything') == 2
+    assert not ff.is_cached(url, dict(params, q='OTHER'), ttl)
+
+
+def test_expired_response_used_when_the_api_fails(stub, monkeypatch):
+    monkeypatch.setattr(ff, 'RETRIES', Retry(total=1, backoff_factor=0, status_forcelist=(503,), allowed_methods=['GET']))
+    ff.get_news_data('SYN')
+    url, params, ttl = ff.news_request('SYN')
+    age_cache(url, params, ttl + 1)
+    stub.script('/v2/everything', (503, {'status': 'error'}))
+    assert ff.get_news_data('SYN') == NEWS
+
+
+def test_invalid_responses_are_not_cached(stub):
+    # NewsAPI reports its rate limits with an error status in the body
+    stub.script('/v2/everything', (200, {'status': 'error', 'code': 'rateLimited'}), (200, NEWS))
+    assert ff.get_news_data('SYN')['status'] == 'error'
+    assert ff.get_news_data('SYN') == NEWS
+    assert stub.hits('/v2/everything') == 2
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retried_statuses(stub, status):
+    stub.script('/v2/everything', (status, {'status': 'error'}), (200, NEWS))
+    assert ff.get_news_data('SYN') == NEWS
+    assert stub.hits('/v2/everything') == 2
+
+
+def test_retries_give_up(stub, monkeypatch):
+    monkeypatch.setattr(ff, 'RETRIES', Retry(total=2, backoff_factor=0, status_forcelist=(503,), allowed_methods=['GET']))
+    stub.script('/v2/everything', (503, {'status': 'error'}))
+    with pytest.raises(requests.RequestException):
+        ff.get_news_data('SYN')
+    assert stub.hits('/v2/everything') == 3
+
+
+def test_timeout(stub, monkeypatch):
+    monkeypatch.setattr(ff, 'TIMEOUT', (1, 0.2))
+    monkeypatch.setattr(ff, 'RETRIES', Retry(total=1, backoff_factor=0, allowed_methods=['GET']))
+    stub.script('/v2/everything', (200, NEWS, 1))
+    started = time.monotonic()
+    with pytest.raises(requests.RequestException):
+        ff.get_news_data('SYN')
+    # Two attempts of 0.2 seconds, not the delay of the server
+    assert time.monotonic() - started < 0.9
+
+
+def test_earnings_table_cached_within_ttl(stub):
+    earnings = ff.load_earnings('SYN')
+    assert list(earnings['reportedEPS']) == [0.9, 1.1]
+    ff.load_earnings('SYN')
+    assert stub.hits('/query') == 1
+
+
+def test_earnings_refetched_after_expiry(stub, monkeypatch):
+    ff.load_earnings('SYN')
+    fetched_at = earnings_store.fetched_at('SYN')
+    monkeypatch.setattr(earnings_store, 'fetched_at', lambda stock: fetched_at - ff.EARNINGS_TTL)
+    # The HTTP cache has the same TTL, its entry expires with the table
+    age_cache(*ff.earnings_request('SYN')[:2], ff.EARNINGS_TTL)
+    ff.load_earnings('SYN')
+    assert stub.hits('/query') == 2
+
+
+def test_fundamentals_fetched_concurrently(stub, tmp_path, monkeypatch):
+    # analyze_earnings writes its charts relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    stub.script('/query', (200, EARNINGS, 0.5))
+    stub.script('/v2/everything', (200, NEWS, 0.5))
+    assert ff.get_fundamentals('SYN') == NEWS
+    assert os.path.exists(tmp_path / 'static' / 'visualizations' / 'fundamental_factors')
+
+    (earnings_path, earnings_start, earnings_end), = [request for request in stub.requests if request[0] == '/query']
+    (news_path, news_start, news_end), = [request for request in stub.requests if request[0] == '/v2/everything']
+    # Each request started before the other one was answered
+    assert earnings_start < news_end and news_start < earnings_end
+
+
+def test_stale_earnings_used_when_the_api_fails(stub, monkeypatch):
+    ff.load_earnings('SYN')
+    fetched_at = earnings_store.fetched_at('SYN')
+    monkeypatch.setattr(earnings_store, 'fetched_at', lambda stock: fetched_at - ff.EARNINGS_TTL)
+    age_cache(*ff.earnings_request('SYN')[:2], ff.EARNINGS_TTL)
+    # Alpha Vantage reports its rate limits with a 200 status and a note
+    stub.script('/query', (200, {'Note': 'Thank you for using Alpha Vantage! Our standard API rate limit is 25 requests per day.'}))
+    earnings = ff.load_earnings('SYN')
+    assert stub.hits('/query') == 2
+    assert list(earnings['reportedEPS']) == [0.9, 1.1]
+
+
+def test_earnings_error_without_stored_rows(stub):
+    stub.script('/query', (200, {'Information': 'The API rate limit was reached.'}))
+    with pytest.raises(ValueError, match='rate limit'):
+        ff.load_earnings('SYN')
+    assert earnings_store.fetched_at('SYN') is None
+
+
+def test_loading_the_earnings_of_no_stocks(stub):
+    ff.load_earnings('SYN')
+    earnings = earnings_store.load_earnings([])
+    assert earnings.empty
+    assert list(earnings.columns) == ['stock'] + earnings_store.EARNINGS_COLUMNS
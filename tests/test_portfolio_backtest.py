@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from portfolio_backtest import simulate_portfolio
+
+
+def matrices(bars=60, stocks=5, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-01-01', periods=bars)
+    columns = [f'S{i}' for i in range(stocks)]
+    close = pd.DataFrame(100 * np.exp(np.cumsum(rng.normal(0, 0.01, (bars, stocks)), axis=0)), index=dates, columns=columns)
+    # Every stock recommended, the first ones with the best scores
+    scores = pd.DataFrame(np.tile(np.linspace(0.9, 0.6, stocks), (bars, 1)), index=dates, columns=columns)
+    return close, scores
+
+
+@pytest.mark.parametrize('max_positions, held', [(None, 5), (2, 2), (1, 1), (10, 5)])
+def test_max_positions(max_positions, held):
+    close, scores = matrices()
+    # The first rebalancing has no score yet, it stays in cash
+    weights = simulate_portfolio(close, scores, max_positions=max_positions)['weights'].iloc[1:]
+    assert ((weights > 0).sum(axis=1) == held).all()
+    if max_positions is not None and max_positions < 5:
+        assert list(weights.columns[(weights > 0).any()]) == list(close.columns[:max_positions])
+
+
+@pytest.mark.parametrize('max_positions', [0, -1])
+def test_max_positions_below_one_is_rejected(max_positions):
+    close, scores = matrices()
+    with pytest.raises(ValueError):
+        simulate_portfolio(close, scores, max_positions=max_positions)
@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import price_store
+from stock_functions import download_and_preprocess_stock_data
+
+
+def prices(bars, offset=0.0):
+    return pd.DataFrame({'date': pd.bdate_range('2024-01-01', periods=bars), 'close': np.arange(bars) + offset})
+
+
+def versions(store, stock='SYN'):
+    return sorted(name for name in os.listdir(store / stock) if name.startswith('v'))
+
+
+def test_previous_version_is_kept_for_readers(store):
+    price_store.save_prices(prices(5), 'SYN')
+    # A reader that read the metadata of version 1 before the next save
+    meta = price_store.load_meta('SYN')
+    price_store.save_prices(prices(6, 1.0), 'SYN')
+    assert versions(store) == ['v1', 'v2']
+    path = price_store._column_path('SYN', meta['version'], 'close')
+    np.testing.assert_array_equal(np.memmap(path, dtype=meta['columns']['close'], mode='r', shape=(meta['rows'],)), np.arange(5.0))
+
+    # Only the versions before the previous one are removed
+    price_store.save_prices(prices(7, 2.0), 'SYN')
+    assert versions(store) == ['v2', 'v3']
+    np.testing.assert_array_equal(price_store.load_prices('SYN')['close'], np.arange(7) + 2.0)
+
+
+@pytest.mark.parametrize('stock', ['AAPL', 'BRK-B', 'BRK.B', '^GSPC', 'EURUSD=X', '7203.T'])
+def test_valid_symbols(store, stock):
+    assert price_store.is_valid_symbol(stock)
+    price_store.save_prices(prices(3), stock)
+    assert price_store.has_prices(stock)
+    assert stock in price_store.list_stocks()
+
+
+@pytest.mark.parametrize('stock', ['', '.', '..', '../SYN', 'SYN/..', '/tmp/SYN', 'SYN\\..', 'a b', 'C:SYN', None])
+def test_invalid_symbols_stay_out_of_the_store(store, tmp_path, stock):
+    assert not price_store.is_valid_symbol(stock)
+    assert not price_store.has_prices(stock)
+    with pytest.raises(ValueError):
+        price_store.save_prices(prices(3), stock)
+    with pytest.raises(ValueError):
+        price_store.load_prices(stock)
+    assert os.listdir(tmp_path) == []
+
+
+def test_invalid_symbol_is_not_downloaded(store):
+    def downloader(stock, **kwargs):
+        raise AssertionError('The symbol should be rejected before downloading')
+
+    assert 'not valid' in download_and_preprocess_stock_data('../SYN', downloader=downloader)
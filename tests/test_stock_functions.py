@@ -0,0 +1,278 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta
+import price_store
+import stock_functions
+from stock_functions import download_and_preprocess_stock_data, refresh_stock_data, needs_refresh, REFRESH_INTERVAL
+
+INDICATORS = ['SYN_50_day_ma', 'SYN_200_day_ma', 'SYN_rsi']
+
+
+def make_history(bars, seed=0, start='2020-01-01'):
+    """
+    A daily history shaped like the result of yfinance.download.
+    """
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, bars)))
+    return pd.DataFrame({
+        'Open': close * (1 + rng.normal(0, 0.005, bars)),
+        'High': close * 1.01,
+        'Low': close * 0.99,
+        'Close': close,
+        'Adj Close': close,
+        'Volume': rng.integers(10 ** 5, 10 ** 6, bars),
+    }, index=pd.bdate_range(start, periods=bars, name='Date'))
+
+
+class FakeDownloader:
+    """
+    Local replacement of yfinance.download serving a fixed history, records the calls.
+    """
+
+    def __init__(self, history, ignore_start=False):
+        self.history = history
+        self.ignore_start = ignore_start
+        self.calls = []
+
+    def __call__(self, stock, period=None, start=None):
+        self.calls.append({'period': period, 'start': start})
+        if start is None or self.ignore_start:
+            return self.history.copy()
+        return self.history[self.history.index >= pd.Timestamp(start)].copy()
+
+
+def stored(stock='SYN'):
+    return price_store.load_prices(stock).copy()
+
+
+def full_recompute(history, stock='SYN'):
+    """
+    The data a first download of the whole history stores.
+    """
+    download_and_preprocess_stock_data(stock, downloader=FakeDownloader(history))
+    return stored(stock)
+
+
+@pytest.mark.parametrize('initial_bars', [150, 199, 200, 450])
+def test_incremental_refresh_matches_full_recompute(store, initial_bars):
+    history = make_history(600)
+    assert download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(history.iloc[:initial_bars])) is None
+    downloader = FakeDownloader(history)
+    assert refresh_stock_data('SYN', downloader=downloader) is None
+
+    # Only the bars from the high-water mark on are downloaded
+    assert downloader.calls == [{'period': None, 'start': f'{history.index[initial_bars - 1]:%Y-%m-%d}'}]
+    refreshed = stored()
+    expected = full_recompute(history, stock='FULL').rename(columns=lambda column: column.replace('FULL', 'SYN'))
+    assert len(refreshed) == len(history)
+    pd.testing.assert_series_equal(refreshed['date'], expected['date'])
+    for column in INDICATORS:
+        np.testing.assert_allclose(refreshed[column], expected[column], rtol=1e-9, equal_nan=True)
+
+
+def test_refresh_keeps_carrying_the_rsi(store):
+    history = make_history(400)
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(history.iloc[:300]))
+    # Several small refreshes carry the RSI state from one to the next
+    for end in (310, 311, 350, 400):
+        assert refresh_stock_data('SYN', downloader=FakeDownloader(history.iloc[:end])) is None
+    expected = full_recompute(history, stock='FULL')
+    np.testing.assert_allclose(stored()['SYN_rsi'], expected['FULL_rsi'], rtol=1e-9, equal_nan=True)
+
+
+def test_refresh_without_new_bars_keeps_the_data(store):
+    history = make_history(300)
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(history))
+    version = price_store.data_version('SYN')
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(history)) is None
+    assert price_store.data_version('SYN') == version
+    assert len(stored()) == 300
+
+
+def test_overlapping_bars_are_not_duplicated(store):
+    history = make_history(500)
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(history.iloc[:400]))
+    # A downloader returning the whole history, whatever the start date
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(history, ignore_start=True)) is None
+    refreshed = stored()
+    assert refreshed['date'].is_unique and refreshed['date'].is_monotonic_increasing
+    pd.testing.assert_series_equal(refreshed['date'], full_recompute(history, stock='FULL')['date'])
+
+
+def test_changed_last_bar_is_replaced(store):
+    history = make_history(500)
+    # The last stored bar was downloaded before the market closed, with another close and volume
+    partial = history.iloc[:400].copy()
+    partial.iloc[-1, partial.columns.get_loc('Close')] *= 0.97
+    partial.iloc[-1, partial.columns.get_loc('Volume')] //= 3
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(partial))
+    version = price_store.data_version('SYN')
+
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(history)) is None
+    refreshed = stored()
+    expected = full_recompute(history, stock='FULL')
+    assert len(refreshed) == len(history)
+    assert price_store.data_version('SYN') != version
+    np.testing.assert_array_equal(refreshed['close'], expected['close'])
+    for column in INDICATORS:
+        np.testing.assert_allclose(refreshed[column], expected[column.replace('SYN', 'FULL')], rtol=1e-9, equal_nan=True)
+
+    # The next refresh carries the RSI from the replaced bar
+    longer = make_history(520)
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(longer)) is None
+    np.testing.assert_allclose(stored()['SYN_rsi'], full_recompute(longer, stock='FULL')['FULL_rsi'], rtol=1e-9, equal_nan=True)
+
+
+def test_changed_last_bar_alone_is_replaced(store):
+    history = make_history(300)
+    partial = history.copy()
+    partial.iloc[-1, partial.columns.get_loc('Close')] *= 1.02
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(partial))
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(history)) is None
+    refreshed = stored()
+    assert len(refreshed) == 300
+    assert refreshed['close'].iloc[-1] == history['Close'].iloc[-1]
+
+
+def test_todays_bar_is_not_stored(store):
+    history = make_history(300)
+    history.index = pd.date_range(end=pd.Timestamp.today().normalize(), periods=300, name='Date')
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(history))
+    assert len(stored()) == 299
+    assert refresh_stock_data('SYN', downloader=FakeDownloader(history)) is None
+    assert len(stored()) == 299
+
+
+def test_failed_download_is_reported(store):
+    error = download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(make_history(0)))
+    assert 'not valid' in error
+    assert not price_store.has_prices('SYN')
+
+
+def stored_with(last_date, refreshed_at=None):
+    price_store.save_prices(pd.DataFrame({'date': pd.to_datetime([last_date]), 'close': [1.0]}), 'SYN')
+    if refreshed_at is not None:
+        price_store.update_meta('SYN', refreshed_at=refreshed_at.isoformat())
+
+
+# Monday 2024-06-10, the previous business day is Friday 2024-06-07
+MONDAY = datetime(2024, 6, 10, 10)
+
+
+@pytest.mark.parametrize('last_date, stale', [
+    ('2024-06-07', False),  # The previous business day
+    ('2024-06-10', False),
+    ('2024-06-06', True),
+    ('2024-05-31', True),
+])
+def test_needs_refresh_follows_business_days(store, last_date, stale):
+    stored_with(last_date)
+    assert needs_refresh('SYN', now=MONDAY) is stale
+
+
+def test_needs_refresh_over_the_weekend(store):
+    stored_with('2024-06-07')
+    assert not needs_refresh('SYN', now=datetime(2024, 6, 9, 12))
+    assert not needs_refresh('SYN', now=datetime(2024, 6, 10, 12))
+    assert needs_refresh('SYN', now=datetime(2024, 6, 11, 12))
+
+
+def test_needs_refresh_waits_for_the_refresh_interval(store):
+    stored_with('2024-05-31', refreshed_at=MONDAY - REFRESH_INTERVAL + timedelta(minutes=1))
+    assert not needs_refresh('SYN', now=MONDAY)
+    stored_with('2024-05-31', refreshed_at=MONDAY - REFRESH_INTERVAL)
+    assert needs_refresh('SYN', now=MONDAY)
+    assert not needs_refresh('SYN', now=MONDAY, min_interval=REFRESH_INTERVAL * 2)
+
+
+def test_needs_refresh_without_last_date(store):
+    price_store.save_prices(pd.DataFrame({'date': pd.to_datetime([]), 'close': []}), 'SYN')
+    assert needs_refresh('SYN', now=MONDAY)
+
+
+def test_concurrent_first_downloads_download_once(store, monkeypatch):
+    history = make_history(300)
+    downloader = FakeDownloader(history)
+
+    def slow_download(stock, **kwargs):
+        time.sleep(0.2)
+        return downloader(stock, **kwargs)
+
+    monkeypatch.setattr(stock_functions, '_yf_download', slow_download)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(stock_functions.run_analysis('SYN'))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(downloader.calls) == 1
+    assert all('error' not in result for result in results)
+    assert price_store.load_meta('SYN')['version'] == 1
+
+
+
+@pytest.fixture
+def charts(store, tmp_path, monkeypatch):
+    """
+    The charts directory in a temporary directory, with a fake rendering writing empty chart files.
+    Returns the directory and the list of the rendered chart ids.
+    """
+    charts_dir = tmp_path / 'charts'
+    rendered = []
+    monkeypatch.setattr(stock_functions, 'CHARTS_DIR', str(charts_dir))
+
+    def visualize_stock(data, stock, chart_id=None, max_points=None):
+        rendered.append(chart_id)
+        (charts_dir / f'{chart_id}_chart.html').write_text('')
+
+    def visualize_stock_patterns(data, stock, chart_id=None, max_points=None):
+        for name in ('cup_and_handle', 'rsi'):
+            (charts_dir / f'{chart_id}_{name}.html').write_text('')
+
+    monkeypatch.setattr(stock_functions, 'visualize_stock', visualize_stock)
+    monkeypatch.setattr(stock_functions, 'visualize_stock_patterns', visualize_stock_patterns)
+    download_and_preprocess_stock_data('SYN', downloader=FakeDownloader(make_history(300)))
+    return charts_dir, rendered
+
+
+def test_zoomed_charts_are_capped_per_stock(charts, monkeypatch):
+    charts_dir, rendered = charts
+    monkeypatch.setattr(stock_functions, 'ZOOMED_CHARTS_PER_STOCK', 3)
+    stock_functions.ensure_stock_charts('SYN')
+    chart_ids = [f'SYN_202002{day:02d}_end' for day in range(3, 8)]
+
+    def view(i, mtime):
+        assert stock_functions.ensure_stock_charts('SYN', start=f'2020-02-{3 + i:02d}')[0] == chart_ids[i]
+        # Distinct modification times, the views are quicker than the resolution of the clock
+        os.utime(charts_dir / f'{chart_ids[i]}_version.txt', (mtime, mtime))
+
+    rendered.clear()
+    for i in range(3):
+        view(i, i)
+    # Viewing the first range again doesn't render it and keeps it
+    view(0, 3)
+    assert rendered == chart_ids[:3]
+    view(3, 4)
+    view(4, 5)
+
+    assert stock_functions._zoomed_chart_ids('SYN') == [chart_ids[4], chart_ids[3], chart_ids[0]]
+    files = sorted(path.name for path in charts_dir.iterdir())
+    expected = ['SYN_chart.html', 'SYN_cup_and_handle.html', 'SYN_rsi.html', 'SYN_version.txt']
+    for chart_id in (chart_ids[0], chart_ids[3], chart_ids[4]):
+        expected += [f'{chart_id}_chart.html', f'{chart_id}_cup_and_handle.html', f'{chart_id}_rsi.html', f'{chart_id}_version.txt']
+    # The full history charts are never removed
+    assert files == sorted(expected)
+
+
+def test_chart_locks_are_per_stock(charts):
+    for day in range(1, 20):
+        stock_functions.ensure_stock_charts('SYN', start=f'2020-03-{day:02d}', end='2020-06-30')
+    assert 'SYN' in stock_functions._chart_locks
+    assert not any(key.startswith('SYN_') for key in stock_functions._chart_locks)
+    with pytest.raises(ValueError):
+        stock_functions.ensure_stock_charts('OTHER', start='2020-03-01')
+    assert 'OTHER' not in stock_functions._chart_locks
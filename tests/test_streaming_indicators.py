@@ -0,0 +1,155 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic import make_ohlcv
+from bullish_signals_indicators import compute_signals
+from stock_functions import _add_indicators
+from streaming_indicators import (STREAMING_SIGNALS, StreamingSignals, RollingMean, RollingMax, RollingMeanStd,
+                                  AdjustedEMA, WilderRSI)
+
+
+def json_round_trip(state):
+    return json.loads(json.dumps(state))
+
+
+def replay(data, splits=(), one_by_one=False, **kwargs):
+    """
+    Stream the bars of the data, saving the state to JSON and restoring it in a new instance at each split.
+
+    Returns:
+    dict: A boolean array per signal of STREAMING_SIGNALS
+    StreamingSignals: The instance holding the state after the last bar
+    """
+    signals = {name: [] for name in STREAMING_SIGNALS}
+    streaming = StreamingSignals(**kwargs)
+    bounds = [0] + list(splits) + [len(data)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start:
+            restored = StreamingSignals(**kwargs)
+            restored.set_state(json_round_trip(streaming.get_state()))
+            streaming = restored
+        chunk = data.iloc[start:end]
+        if one_by_one:
+            for close, high, volume in zip(chunk['close'], chunk['high'], chunk['volume']):
+                for name, detected in streaming.update(close, high, volume).items():
+                    signals[name].append(detected)
+        else:
+            for name, detected in streaming.update_many(chunk).items():
+                signals[name].extend(detected)
+    return {name: np.array(detected, dtype=bool) for name, detected in signals.items()}, streaming
+
+
+def assert_same_signals(streamed, batch):
+    for name in STREAMING_SIGNALS:
+        np.testing.assert_array_equal(streamed[name], batch[name], err_msg=name)
+
+
+@pytest.mark.parametrize('bars, seed', [(1, 0), (2, 0), (30, 1), (250, 2), (3000, 3), (20000, 4)])
+def test_replay_matches_compute_signals(bars, seed):
+    data = make_ohlcv('SYN', bars, seed=seed)
+    streamed, _ = replay(data)
+    assert_same_signals(streamed, compute_signals(data, 'SYN'))
+
+
+def test_replay_of_no_bars():
+    streamed, _ = replay(pd.DataFrame({'close': [], 'high': [], 'volume': []}))
+    assert all(len(detected) == 0 for detected in streamed.values())
+
+
+@pytest.mark.parametrize('splits', [(1,), (13,), (199, 200, 201), (1000, 1001, 2500)])
+def test_replay_with_saved_states_matches_compute_signals(splits):
+    data = make_ohlcv('SYN', 3000, seed=5)
+    streamed, _ = replay(data, splits=splits)
+    assert_same_signals(streamed, compute_signals(data, 'SYN'))
+
+
+def test_bar_by_bar_matches_compute_signals():
+    data = make_ohlcv('SYN', 1500, seed=6)
+    streamed, _ = replay(data, splits=(700,), one_by_one=True)
+    assert_same_signals(streamed, compute_signals(data, 'SYN'))
+
+
+def test_replay_with_other_parameters():
+    data = make_ohlcv('SYN', 2000, seed=7)
+    parameters = {'volume_threshold': 1.3, 'rsi_threshold': 45, 'bollinger_window': 10, 'num_std': 1, 'ema_span': 8}
+    streamed, _ = replay(data, splits=(999,), **parameters)
+    batch = compute_signals(data, 'SYN', volume_threshold=1.3, rsi_threshold=45, bollinger_window=10, num_std=1, ema_span=8)
+    assert_same_signals(streamed, batch)
+
+
+def test_replay_matches_the_preprocessing_of_downloads():
+    # The moving averages and the RSI of the downloaded data (ta's RSIIndicator)
+    data = _add_indicators(make_ohlcv('SYN', 2000, seed=8).drop(columns=['SYN_50_day_ma', 'SYN_200_day_ma', 'SYN_rsi']), 'SYN')
+    streamed, streaming = replay(data, splits=(1234,))
+    assert_same_signals(streamed, compute_signals(data, 'SYN'))
+    values = streaming.values
+    assert values['ma_50'] == pytest.approx(data['SYN_50_day_ma'].iloc[-1], rel=1e-12)
+    assert values['ma_200'] == pytest.approx(data['SYN_200_day_ma'].iloc[-1], rel=1e-12)
+    assert values['rsi'] == pytest.approx(data['SYN_rsi'].iloc[-1], rel=1e-9)
+
+
+def stream(make_indicator, values, split=None, indicator=None):
+    """
+    Feed the values one by one to a new indicator, restoring it in another one from its JSON state at `split`.
+    """
+    indicator = indicator or make_indicator()
+    results = []
+    for i, value in enumerate(values):
+        if i == split:
+            restored = make_indicator()
+            restored.set_state(json_round_trip(indicator.get_state()))
+            indicator = restored
+        results.append(indicator.update(value))
+    return np.array(results, dtype=float)
+
+
+VALUES = pd.Series(100 * np.exp(np.cumsum(np.random.default_rng(9).normal(0, 0.02, 1200))))
+
+
+@pytest.mark.parametrize('split', [None, 1, 777])
+def test_indicators_match_pandas(split):
+    np.testing.assert_allclose(stream(lambda: RollingMean(50), VALUES, split), VALUES.rolling(50).mean(), rtol=1e-12)
+    np.testing.assert_allclose(stream(lambda: RollingMean(50, min_periods=1), VALUES, split),
+                               VALUES.rolling(50, min_periods=1).mean(), rtol=1e-12)
+    np.testing.assert_array_equal(stream(lambda: RollingMax(50), VALUES, split), VALUES.rolling(50, min_periods=1).max())
+    bands = stream(lambda: RollingMeanStd(20), VALUES, split)
+    np.testing.assert_allclose(bands[:, 0], VALUES.rolling(20).mean(), rtol=1e-12)
+    np.testing.assert_allclose(bands[:, 1], VALUES.rolling(20).std(), rtol=1e-9)
+    np.testing.assert_allclose(stream(lambda: AdjustedEMA(20), VALUES, split), VALUES.ewm(span=20).mean(), rtol=1e-12)
+
+
+@pytest.mark.parametrize('split', [None, 5, 600])
+def test_rsi_matches_ta(split):
+    from ta.momentum import RSIIndicator
+    expected = RSIIndicator(close=VALUES).rsi()
+    np.testing.assert_allclose(stream(lambda: WilderRSI(14), VALUES, split), expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize('level, noise', [(100, 1), (1e5, 0.01), (1e6, 0.001)])
+def test_rolling_std_does_not_drift(level, noise):
+    # Prices far from 0 with a small variance, where every removal from the running sum of squares loses precision
+    rng = np.random.default_rng(10)
+    values = level + np.cumsum(rng.normal(0, noise, 300000)) * 0.001 + rng.normal(0, noise, 300000)
+    bands = RollingMeanStd(20)
+    errors = []
+    for i, value in enumerate(values.tolist()):
+        _, std = bands.update(value)
+        if i >= 19 and i % 1009 == 0:
+            expected = values[i - 19:i + 1].std(ddof=1)
+            errors.append(abs(std - expected) / expected)
+    # The error stays at the precision of a single window, it doesn't grow with the length of the stream
+    first, last = np.max(errors[:30]), np.max(errors[-30:])
+    assert last < 1e-6
+    assert last < max(first, 1e-12) * 100
+
+
+def test_state_without_update_count_is_restored():
+    # States saved before the update count was kept
+    bands = RollingMeanStd(20)
+    stream(None, VALUES[:100], indicator=bands)
+    state = bands.get_state()
+    del state['updates']
+    restored = RollingMeanStd(20)
+    restored.set_state(state)
+    np.testing.assert_allclose(stream(None, VALUES[100:], indicator=restored)[:, 1], VALUES.rolling(20).std()[100:], rtol=1e-9)
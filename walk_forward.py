@@ -0,0 +1,194 @@
+"""
+Walk-forward replay of the overall score of calculate_score: the score every stock would have had on
+each historical bar, joined with the returns of the following bars, to measure how the recommendation
+of run_analysis (overall_score > 0.5) would have performed.
+
+Run from the project root over the stocks of the price store:
+    python walk_forward.py AAPL MSFT --days 10 --horizons 5 10 20
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from bullish_signals_indicators import SIGNALS, PATTERN_SIGNALS, compute_signals
+from backtest_strategy import weights_vector
+from metrics import timed
+
+# Forward returns joined to the scores, in bars
+HORIZONS = (5, 10, 20)
+# Edges of the score buckets of the summary, a bucket includes its upper edge
+SCORE_BUCKETS = (0, 0.25, 0.5, 0.75, 1)
+
+def _last_hit_indices(mask):
+    """
+    Index of the last True value at or before each bar, -1 before the first one.
+    """
+    return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), -1))
+
+def _forward_returns(close, horizon):
+    """
+    Return from the close of each bar to the close `horizon` bars later, NaN when there is no such bar.
+    """
+    returns = np.full(len(close), np.nan)
+    if horizon < len(close):
+        returns[:-horizon] = close[horizon:] / close[:-horizon] - 1
+    return returns
+
+def window_hits(data, stock, days, threshold, rsi_threshold, pattern_delay=50, signals=None):
+    """
+    This function finds, as of every bar, which signals appeared within the day range ending at that bar.
+    The last bar of each signal seen at each bar comes from a cumulative maximum over its mask, and the start
+    of each day range from a binary search on the dates, so nothing is recomputed bar by bar.
+
+    The chart patterns are found with the peaks of the whole history: a peak can only be confirmed once the
+    following bars are known. Their signals only count `pattern_delay` bars after the bar they end on, to
+    limit that look-ahead. With pattern_delay=0 the hits of the last bar are the ones of calculate_score.
+
+    Parameters:
+    data (DataFrame): The stock data, sorted by date
+    stock (str): The stock symbol
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    pattern_delay (int): The number of bars before a chart pattern counts. Default is 50, the pattern window.
+    signals (dict): The signals of compute_signals for the same data and thresholds. Default computes them.
+
+    Returns:
+    numpy.ndarray: A boolean (bars x SIGNALS) array, True when the signal appeared within the day range
+    """
+    masks = signals if signals is not None else compute_signals(data, stock, volume_threshold=threshold, rsi_threshold=rsi_threshold)
+
+    with timed('window_hits'):
+        dates = data['date'].to_numpy(dtype='datetime64[ns]')
+        # First bar of the day range ending at each bar
+        window_start = np.searchsorted(dates, dates - np.timedelta64(int(days), 'D'), side='left')
+
+        hits = np.empty((len(dates), len(SIGNALS)), dtype=bool)
+        for k, signal in enumerate(SIGNALS):
+            mask = masks[signal]
+            if signal in PATTERN_SIGNALS and pattern_delay:
+                mask = np.concatenate([np.zeros(min(pattern_delay, len(mask)), dtype=bool), mask[:-pattern_delay]])
+            hits[:, k] = _last_hit_indices(mask) >= window_start
+        return hits
+
+def walk_forward_scores(data, stock, days, threshold, rsi_threshold, weights: dict = None, horizons=HORIZONS,
+                        pattern_delay=50, signals=None):
+    """
+    This function calculates the overall score of calculate_score as of every bar of the data in one pass,
+    as the product of the window hits (see window_hits) with the weights.
+
+    Parameters:
+    data (DataFrame): The stock data, sorted by date
+    stock (str): The stock symbol
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    horizons (list): The numbers of bars of the forward returns
+    pattern_delay (int): The number of bars before a chart pattern counts. Default is 50, the pattern window.
+    signals (dict): The signals of compute_signals for the same data and thresholds. Default computes them.
+
+    Returns:
+    DataFrame: One row per bar with the date, the overall score, the recommendation and the forward return
+               of each horizon ('return_{horizon}')
+    """
+    hits = window_hits(data, stock, days, threshold, rsi_threshold, pattern_delay, signals)
+    weights = weights_vector(weights)
+    scores = hits @ weights / weights.sum()
+
+    replay = pd.DataFrame({'date': data['date'].to_numpy(dtype='datetime64[ns]'), 'overall_score': scores})
+    replay['recommendation'] = np.where(scores > 0.5, 'Trade', "Don't Trade")
+    close = data['close'].to_numpy(dtype=float)
+    for horizon in horizons:
+        replay[f'return_{horizon}'] = _forward_returns(close, horizon)
+    return replay
+
+def _replay_stock(stock, data, days, threshold, rsi_threshold, weights, horizons, pattern_delay):
+    replay = walk_forward_scores(data, stock, days, threshold, rsi_threshold, weights, horizons, pattern_delay)
+    replay.insert(0, 'stock', stock)
+    return replay
+
+def walk_forward_replay(data_by_stock, days, threshold, rsi_threshold, weights: dict = None, horizons=HORIZONS,
+                        pattern_delay=50, max_workers=None):
+    """
+    This function runs walk_forward_scores over many stocks, spread over a process pool.
+
+    Parameters:
+    data_by_stock (dict): The stock data (sorted by date) for each stock symbol
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    weights (dict): The weights for each indicator
+    horizons (list): The numbers of bars of the forward returns
+    pattern_delay (int): The number of bars before a chart pattern counts
+    max_workers (int): The number of processes. Default is the number of CPUs, 1 runs in this process.
+
+    Returns:
+    DataFrame: The rows of walk_forward_scores of every stock, with a 'stock' column
+    """
+    stocks = list(data_by_stock)
+    arguments = [days, threshold, rsi_threshold, weights, horizons, pattern_delay]
+    if max_workers == 1 or len(stocks) <= 1:
+        replays = [_replay_stock(stock, data_by_stock[stock], *arguments) for stock in stocks]
+    else:
+        chunksize = max(1, len(stocks) // (4 * (max_workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            replays = list(pool.map(_replay_stock, stocks, [data_by_stock[stock] for stock in stocks],
+                                    *[[argument] * len(stocks) for argument in arguments], chunksize=chunksize))
+    if not replays:
+        return pd.DataFrame(columns=['stock', 'date', 'overall_score', 'recommendation'] + [f'return_{h}' for h in horizons])
+    return pd.concat(replays, ignore_index=True)
+
+def summarize_replay(replay, buckets=SCORE_BUCKETS):
+    """
+    Summarize the forward returns of a replay by score bucket and by recommendation.
+    The returns of consecutive bars overlap, so the observations are not independent.
+
+    Parameters:
+    replay (DataFrame): The result of walk_forward_replay or walk_forward_scores
+    buckets (list): The edges of the score buckets
+
+    Returns:
+    DataFrame: One row per group (score bucket, then 'Trade' and "Don't Trade") and horizon with the
+               number of observations, the hit rate (share of positive returns), and the mean and median return
+    """
+    horizons = [int(column.split('_')[1]) for column in replay.columns if column.startswith('return_')]
+    score_bucket = pd.cut(replay['overall_score'], bins=list(buckets), include_lowest=True).astype(str)
+    rows = []
+    for grouping in (score_bucket, replay['recommendation']):
+        for group, rows_of_group in replay.groupby(grouping, sort=True):
+            for horizon in horizons:
+                returns = rows_of_group[f'return_{horizon}'].dropna()
+                rows.append({
+                    'group': group,
+                    'horizon': horizon,
+                    'observations': len(returns),
+                    'hit_rate': (returns > 0).mean() if len(returns) else np.nan,
+                    'mean_return': returns.mean(),
+                    'median_return': returns.median(),
+                })
+    return pd.DataFrame(rows)
+
+def main():
+    from price_store import list_stocks, load_prices
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stocks', nargs='*', help='Stock symbols of the price store. Default is every stored stock.')
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.05)
+    parser.add_argument('--rsi-threshold', type=float, default=30)
+    parser.add_argument('--horizons', type=int, nargs='*', default=list(HORIZONS))
+    parser.add_argument('--pattern-delay', type=int, default=50)
+    parser.add_argument('--workers', type=int, help='Number of processes. Default is the number of CPUs.')
+    args = parser.parse_args()
+
+    stocks = args.stocks or list_stocks()
+    # Copied out of the memory maps, each one keeps a file descriptor open while it is referenced
+    data_by_stock = {stock: load_prices(stock, columns=['close', 'high', 'volume', f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi']).copy()
+                     for stock in stocks}
+    replay = walk_forward_replay(data_by_stock, args.days, args.threshold, args.rsi_threshold, horizons=args.horizons,
+                                 pattern_delay=args.pattern_delay, max_workers=args.workers)
+    print(summarize_replay(replay).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Optimizer of the nine indicator weights of the analysis form: searches the weights that maximize a metric
+of the forward returns of the 'Trade' recommendations (overall_score > 0.5) over a universe of stocks.
+
+The window hits of every stock (see walk_forward.window_hits) are computed once, then each candidate weight
+vector is scored with a matrix product: the overall scores of all the bars are H @ w / sum(w). The candidates
+come from a random search over the simplex (Dirichlet samples) refined by coordinate descent, and are
+evaluated in batches over a process pool. The same seed gives the same candidates.
+
+Run from the project root over the stocks of the price store:
+    python weight_optimizer.py AAPL MSFT --metric mean_return --horizon 10 --time-limit 60 --seed 0
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from bullish_signals_indicators import SIGNALS
+from walk_forward import window_hits, _forward_returns
+
+# Metrics of the forward returns of the bars recommended as 'Trade'
+METRICS = ('mean_return', 'hit_rate', 'sharpe', 'excess_return')
+ROWS_PER_CHUNK = 16384  # Bars scored at once, bounds the memory of the (bars x candidates) products
+
+def _stock_matrices(stock, data, days, threshold, rsi_threshold, horizon, pattern_delay):
+    """
+    The window hits, forward returns and dates of the bars of one stock that have a forward return.
+    """
+    hits = window_hits(data, stock, days, threshold, rsi_threshold, pattern_delay)
+    returns = _forward_returns(data['close'].to_numpy(dtype=float), horizon)
+    dates = data['date'].to_numpy(dtype='datetime64[ns]')
+    known = ~np.isnan(returns)
+    return hits[known], returns[known], dates[known]
+
+def _trade_stats(hits, returns, candidates):
+    """
+    Number of trades, sum and sum of squares of their returns and number of positive returns, for each
+    candidate (column of `candidates`, a SIGNALS x candidates array).
+    """
+    totals = candidates.sum(axis=0)
+    # One matrix product gives the four sums: [1, r, r^2, r > 0] @ trades
+    moments = np.zeros((4, candidates.shape[1]))
+    for start in range(0, len(returns), ROWS_PER_CHUNK):
+        chunk = slice(start, start + ROWS_PER_CHUNK)
+        # Same comparison as the recommendation of run_analysis: overall_score > 0.5
+        trades = ((hits[chunk].astype(np.float64) @ candidates) / totals > 0.5).astype(np.float64)
+        r = returns[chunk]
+        moments += np.vstack([np.ones_like(r), r, r * r, (r > 0).astype(np.float64)]) @ trades
+    return moments
+
+def _metric(moments, metric, min_trades, overall_mean):
+    count, total, squares, positives = moments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        if metric == 'mean_return':
+            values = mean
+        elif metric == 'hit_rate':
+            values = positives / count
+        elif metric == 'sharpe':
+            values = mean / np.sqrt(np.maximum(squares / count - mean * mean, 0) * count / (count - 1))
+        else:
+            values = mean - overall_mean
+    # Too few trades say nothing about the weights
+    return np.where((count >= min_trades) & np.isfinite(values), values, -np.inf)
+
+def _evaluate(hits, returns, candidates, metric, min_trades):
+    """
+    The metric of each candidate weight vector (the rows of `candidates`), -inf with fewer than `min_trades` trades.
+    """
+    moments = _trade_stats(hits, returns, np.asarray(candidates, dtype=np.float64).T)
+    return _metric(moments, metric, min_trades, returns.mean() if len(returns) else np.nan)
+
+# Matrices of the worker processes, sent once by the pool initializer
+_worker_data = {}
+
+def _init_worker(hits, returns):
+    _worker_data['hits'], _worker_data['returns'] = hits, returns
+
+def _evaluate_in_worker(candidates, metric, min_trades):
+    return _evaluate(_worker_data['hits'], _worker_data['returns'], candidates, metric, min_trades)
+
+def _to_percentages(weights):
+    """
+    Round weights to whole percentages summing to 100, as the analysis form expects (largest remainders).
+    """
+    shares = np.asarray(weights, dtype=float) / np.sum(weights) * 100
+    percentages = np.floor(shares).astype(int)
+    remainders = shares - percentages
+    for k in np.argsort(-remainders, kind='stable')[:100 - percentages.sum()]:
+        percentages[k] += 1
+    return percentages
+
+def _coordinate_candidates(weights, grid):
+    """
+    The neighbours of a weight vector on the simplex: each weight set to every value of the grid,
+    the other weights rescaled to keep the sum at 1.
+    """
+    candidates = []
+    for k in range(len(weights)):
+        others = weights.sum() - weights[k]
+        if others <= 0:
+            continue
+        for value in grid:
+            candidate = weights * (1 - value) / others
+            candidate[k] = value
+            candidates.append(candidate)
+    return np.array(candidates)
+
+def optimize_weights(data_by_stock, days=10, threshold=0.05, rsi_threshold=30, horizon=10, metric='mean_return',
+                     samples=2000, rounds=5, grid_size=11, batch_size=256, min_trades=30, holdout=0.3,
+                     pattern_delay=50, time_limit=None, seed=0, max_workers=None):
+    """
+    This function searches the indicator weights that maximize a metric of the forward returns of the bars
+    recommended as 'Trade' over many stocks.
+    The latest `holdout` share of the bars (by date) is left out of the search and only used to report the
+    metric of the best weights, to show how much of the improvement is overfitting.
+
+    Parameters:
+    data_by_stock (dict): The stock data (sorted by date) for each stock symbol
+    days (int): The number of days over which to calculate the score
+    threshold (float): The threshold for the volume spikes indicator
+    rsi_threshold (float): The threshold for the RSI oversold indicator
+    horizon (int): The number of bars of the forward returns
+    metric (str): The metric to maximize, one of METRICS: the mean return of the trades, their hit rate
+                  (share of positive returns), their Sharpe ratio, or their mean return above the mean of all bars
+    samples (int): The number of random weight vectors of the random search
+    rounds (int): The maximum number of rounds of the coordinate descent
+    grid_size (int): The number of values tried for each weight by the coordinate descent
+    batch_size (int): The number of weight vectors evaluated by a worker at once
+    min_trades (int): The minimum number of trades for a weight vector to count
+    holdout (float): The share of the latest bars left out of the search, 0 uses every bar
+    pattern_delay (int): The number of bars before a chart pattern counts (see walk_forward.window_hits)
+    time_limit (float): The maximum time of the search in seconds, None has no limit. The search stops
+                        between batches, so a slower machine can stop with fewer candidates.
+    seed (int): The seed of the random search
+    max_workers (int): The number of processes. Default is the number of CPUs, 1 runs in this process.
+
+    Returns:
+    dict: The best weights as form percentages ('weights'), their metric on the searched and held out bars
+          ('train', 'holdout') and their numbers of trades, the same for equal weights ('baseline_train',
+          'baseline_holdout'), the number of evaluated weight vectors and the elapsed time
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}.")
+    start_time = time.perf_counter()
+
+    stocks = list(data_by_stock)
+    arguments = [days, threshold, rsi_threshold, horizon, pattern_delay]
+    if max_workers == 1 or len(stocks) <= 1:
+        matrices = [_stock_matrices(stock, data_by_stock[stock], *arguments) for stock in stocks]
+    else:
+        chunksize = max(1, len(stocks) // (4 * (max_workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            matrices = list(pool.map(_stock_matrices, stocks, [data_by_stock[stock] for stock in stocks],
+                                     *[[argument] * len(stocks) for argument in arguments], chunksize=chunksize))
+    if not matrices or not sum(len(returns) for _, returns, _ in matrices):
+        raise ValueError("There is no bar with a forward return to optimize on.")
+    hits = np.concatenate([hits for hits, _, _ in matrices])
+    returns = np.concatenate([returns for _, returns, _ in matrices])
+    dates = np.concatenate([dates for _, _, dates in matrices])
+
+    # The latest bars of every stock are held out, with one date cutoff for the whole universe
+    cutoff = np.datetime64(int(np.quantile(dates.astype('int64'), 1 - holdout)), 'ns') if holdout else None
+    train = dates < cutoff if holdout else np.ones(len(dates), dtype=bool)
+    train_hits, train_returns = hits[train], returns[train]
+
+    rng = np.random.default_rng(seed)
+    evaluations = 0
+    best_weights, best_value = np.ones(len(SIGNALS)) / len(SIGNALS), -np.inf
+
+    def out_of_time():
+        return time_limit is not None and time.perf_counter() - start_time > time_limit
+
+    pool = None
+    if max_workers != 1:
+        pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(train_hits, train_returns))
+    try:
+        def search(candidates):
+            """
+            Evaluate the candidates in batches, in order, and keep the best one.
+            """
+            nonlocal evaluations, best_weights, best_value
+            batches = [candidates[i:i + batch_size] for i in range(0, len(candidates), batch_size)]
+            improved = False
+            # One wave of batches per worker at a time, so the time limit is checked between waves
+            wave = 1 if pool is None else (max_workers or os.cpu_count() or 1)
+            for i in range(0, len(batches), wave):
+                if out_of_time():
+                    break
+                if pool is None:
+                    values = [_evaluate(train_hits, train_returns, batch, metric, min_trades) for batch in batches[i:i + wave]]
+                else:
+                    values = list(pool.map(_evaluate_in_worker, batches[i:i + wave], [metric] * wave, [min_trades] * wave))
+                for batch, batch_values in zip(batches[i:i + wave], values):
+                    evaluations += len(batch)
+                    j = int(np.argmax(batch_values))
+                    if batch_values[j] > best_value:
+                        best_weights, best_value = batch[j], batch_values[j]
+                        improved = True
+            return improved
+
+        # Random search over the simplex, starting with equal weights
+        search(np.vstack([np.ones(len(SIGNALS)) / len(SIGNALS), rng.dirichlet(np.ones(len(SIGNALS)), size=samples)]))
+
+        # Coordinate descent around the best weights, until a round doesn't improve them
+        grid = np.linspace(0, 1, grid_size)
+        for _ in range(rounds):
+            if out_of_time() or not search(_coordinate_candidates(best_weights, grid)):
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    percentages = _to_percentages(best_weights)
+    equal = np.ones(len(SIGNALS))
+    holdout_hits, holdout_returns = hits[~train], returns[~train]
+
+    def report(weights, hits, returns):
+        value = _evaluate(hits, returns, weights[None, :], metric, min_trades)[0]
+        trades = int(_trade_stats(hits, returns, weights[:, None].astype(float))[0, 0])
+        return (float(value) if np.isfinite(value) else None), trades
+
+    train_value, train_trades = report(percentages, train_hits, train_returns)
+    holdout_value, holdout_trades = report(percentages, holdout_hits, holdout_returns)
+    baseline_train, _ = report(equal, train_hits, train_returns)
+    baseline_holdout, _ = report(equal, holdout_hits, holdout_returns)
+    return {
+        'weights': {signal: int(percentage) for signal, percentage in zip(SIGNALS, percentages)},
+        'metric': metric,
+        'train': train_value,
+        'train_trades': train_trades,
+        'holdout': holdout_value,
+        'holdout_trades': holdout_trades,
+        'baseline_train': baseline_train,
+        'baseline_holdout': baseline_holdout,
+        'evaluations': evaluations,
+        'elapsed': time.perf_counter() - start_time,
+    }
+
+def main():
+    from price_store import list_stocks, load_prices
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stocks', nargs='*', help='Stock symbols of the price store. Default is every stored stock.')
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.05)
+    parser.add_argument('--rsi-threshold', type=float, default=30)
+    parser.add_argument('--horizon', type=int, default=10)
+    parser.add_argument('--metric', choices=METRICS, default='mean_return')
+    parser.add_argument('--samples', type=int, default=2000, help='Weight vectors of the random search')
+    parser.add_argument('--rounds', type=int, default=5, help='Maximum rounds of the coordinate descent')
+    parser.add_argument('--min-trades', type=int, default=30)
+    parser.add_argument('--holdout', type=float, default=0.3, help='Share of the latest bars left out of the search')
+    parser.add_argument('--time-limit', type=float, help='Maximum search time in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='Number of processes. Default is the number of CPUs.')
+    args = parser.parse_args()
+
+    stocks = args.stocks or list_stocks()
+    # Copied out of the memory maps, each one keeps a file descriptor open while it is referenced
+    data_by_stock = {stock: load_prices(stock, columns=['close', 'high', 'volume', f'{stock}_50_day_ma', f'{stock}_200_day_ma', f'{stock}_rsi']).copy()
+                     for stock in stocks}
+    result = optimize_weights(data_by_stock, args.days, args.threshold, args.rsi_threshold, args.horizon, args.metric,
+                              samples=args.samples, rounds=args.rounds, min_trades=args.min_trades, holdout=args.holdout,
+                              time_limit=args.time_limit, seed=args.seed, max_workers=args.workers)
+
+    print(pd.Series(result['weights'], name='weight (%)').to_string())
+    print(f"{result['metric']}: {result['train']} on the searched bars ({result['train_trades']} trades), "
+          f"{result['holdout']} on the held out bars ({result['holdout_trades']} trades)")
+    print(f"equal weights: {result['baseline_train']} on the searched bars, {result['baseline_holdout']} on the held out bars")
+    print(f"{result['evaluations']} weight vectors evaluated in {result['elapsed']:.1f} s")
+
+if __name__ == '__main__':
+    main()